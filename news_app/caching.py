@@ -0,0 +1,485 @@
+"""
+Caching the frontpage.
+
+Working out the frontpage means going through four weeks of news items
+and sorting them by ranking, but the order only changes when
+update_ranking.py re-ranks something.  So the ordered list of frontpage
+news items (their ranking, date_posted and id, so it can be paged 
+through with news.helpers.get_keyset_page() tokens) is kept in Django's 
+cache (whatever CACHE_BACKEND is set to, which
+is the local-memory cache if it isn't set), and only the news items on
+the page being shown are loaded.
+
+There are two lists, one with dead news items (for users with
+option_show_dead) and one without.  update_ranking.py refreshes them
+after it re-ranks things, and votes, new news items and deleted news
+items throw them away.  The local-memory cache is different for every
+process, so update_ranking.py can only refresh the lists the web
+server sees if they share a cache (file:// or memcached://).  Otherwise
+they are just NEWS_FRONTPAGE_CACHE_SECONDS out of date at most.
+
+With NEWS_FRONTPAGE_SNAPSHOT_SECONDS, update_ranking.py also writes the 
+top of both lists to a table, with the title, url, poster and so on of 
+each news item copied in (see write_frontpage_snapshot()).  A page of 
+the frontpage is then just the rows between two positions, with no 
+joins or sorting.  Pages past the end of the snapshot, and every page 
+once the snapshot is too old, come from the cached lists instead.
+
+Whole pages are cached too, for people who aren't logged in (see 
+cache_page_for_anonymous()).  Posting, editing or deleting a comment 
+purges the pages it shows up on.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.template.loader import render_to_string
+from django.utils.functional import wraps
+from django.utils.hashcompat import md5_constructor
+
+import datetime, re, time
+
+from news.models import NewsItem, FrontpageSnapshot, FrontpageEntry
+from news.helpers import get_frontpage_querymanager, get_keyset_page, \
+        decode_keyset_token, encode_keyset_token, KeysetPage, get_in_order
+from news.conf import NEWS_ITEMS_FRONTPAGE
+import news.conf as news_settings
+
+FRONTPAGE_CACHE_KEY = 'news_frontpage_ids_%s'
+
+
+def frontpage_cache_key(show_dead):
+    """ Return the cache key for the frontpage list with or without dead items. """
+    if show_dead:
+        return FRONTPAGE_CACHE_KEY % 'dead'
+    return FRONTPAGE_CACHE_KEY % 'live'
+
+FRONTPAGE_KEYS = ('ranking', 'date_posted', 'id')
+
+
+def calculate_frontpage_keys(show_dead=False):
+    """ 
+    Get the (ranking, date_posted, id) of each frontpage news item, in 
+    order, from the database.
+    """
+    return list(get_frontpage_querymanager(show_dead=show_dead).values_list(
+            *FRONTPAGE_KEYS))
+
+def get_frontpage_keys(show_dead=False):
+    """
+    Return the (ranking, date_posted, id) of each news item that could be
+    on the frontpage, in order, from the cache if they are there.
+    """
+    if not news_settings.NEWS_FRONTPAGE_CACHE_SECONDS:
+        return calculate_frontpage_keys(show_dead)
+
+    key = frontpage_cache_key(show_dead)
+    keys = cache.get(key)
+    if keys is None:
+        keys = calculate_frontpage_keys(show_dead)
+        cache.set(key, keys, news_settings.NEWS_FRONTPAGE_CACHE_SECONDS)
+    return keys
+
+def get_frontpage_ids(show_dead=False):
+    """
+    Return the ids of the news items that could be on the frontpage, in
+    order, from the cache if they are there.
+    """
+    return [id for ranking, date_posted, id in get_frontpage_keys(show_dead)]
+
+def refresh_frontpage_cache():
+    """ Work out both frontpage lists again and put them in the cache. """
+    if not news_settings.NEWS_FRONTPAGE_CACHE_SECONDS:
+        return
+    for show_dead in (False, True):
+        cache.set(frontpage_cache_key(show_dead),
+                calculate_frontpage_keys(show_dead),
+                news_settings.NEWS_FRONTPAGE_CACHE_SECONDS)
+
+def invalidate_frontpage_cache():
+    """ Throw away both frontpage lists. """
+    for show_dead in (False, True):
+        cache.delete(frontpage_cache_key(show_dead))
+
+# the columns of a FrontpageEntry, in the order they are written and read
+SNAPSHOT_COLUMNS = ('news_item', 'ranking', 'date_posted', 'dead', 'rating',
+        'num_live_comments', 'title', 'url', 'poster_username')
+
+
+class SnapshotPoster(object):
+    """ The poster of a SnapshotNewsItem.  Only the username is kept. """
+
+    def __init__(self, username):
+        self.username = username
+
+
+class SnapshotNewsItem(object):
+    """
+    A news item as it was in a frontpage snapshot.  It has everything
+    news_item_list.html uses from a NewsItem, without loading one.
+    """
+    def __init__(self, row):
+        (self.id, self.ranking, self.date_posted, self.dead, self.rating, 
+                self.num_live_comments, self.title, self.url, 
+                poster_username) = row
+        self.poster = SnapshotPoster(poster_username)
+
+    # this only uses self.url, so it works the same here
+    abbr_url = NewsItem.abbr_url.im_func
+
+    def num_child_comments(self):
+        return self.num_live_comments
+
+    def can_be_downvoted(self):
+        return True
+
+
+@transaction.commit_on_success
+def write_frontpage_snapshot():
+    """
+    Write the first NEWS_FRONTPAGE_SNAPSHOT_SIZE news items of both 
+    frontpage lists to a new FrontpageSnapshot, and delete the old ones.
+    It is all one transaction, so the frontpage never sees half of one.
+    Returns the new snapshot, or None if snapshots are turned off.
+
+    The one before the new snapshot is kept, since a request might have 
+    just picked it and not read its entries yet.  Only the ones before 
+    that are deleted.
+    """
+    if not news_settings.NEWS_FRONTPAGE_SNAPSHOT_SECONDS:
+        return None
+
+    qn = connection.ops.quote_name
+    columns = ['snapshot_id', 'show_dead', 'position'] + [
+            FrontpageEntry._meta.get_field(name).column 
+            for name in SNAPSHOT_COLUMNS]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+            qn(FrontpageEntry._meta.db_table), 
+            ', '.join([qn(column) for column in columns]),
+            ', '.join(['%s'] * len(columns)))
+    cursor = connection.cursor()
+
+    previous_ids = list(FrontpageSnapshot.objects.order_by('-id').values_list(
+            'id', flat=True)[:1])
+    snapshot = FrontpageSnapshot.objects.create()
+    size = news_settings.NEWS_FRONTPAGE_SNAPSHOT_SIZE
+    for show_dead in (False, True):
+        querymanager = get_frontpage_querymanager(show_dead=show_dead)
+        rows = list(querymanager.values_list('id', 'ranking', 
+                'date_posted', 'dead', 'rating', 'num_live_comments', 
+                'title', 'url', 'poster__user__username')[:size])
+        entries = []
+        for position, row in enumerate(rows):
+            row = list(row)
+            row[2] = connection.ops.value_to_db_datetime(row[2])
+            entries.append([snapshot.id, show_dead, position] + row)
+        cursor.executemany(sql, entries)
+        count = len(rows)
+        if count == size:
+            count = querymanager.count()
+        if show_dead:
+            snapshot.num_with_dead = count
+        else:
+            snapshot.num_live = count
+    snapshot.save()
+
+    # the old snapshots go with raw SQL, since delete() would load every 
+    # entry first
+    if previous_ids:
+        cursor.execute("DELETE FROM %s WHERE %s < %%s" % (
+                qn(FrontpageEntry._meta.db_table), qn('snapshot_id')), 
+                previous_ids)
+        cursor.execute("DELETE FROM %s WHERE %s < %%s" % (
+                qn(FrontpageSnapshot._meta.db_table), qn('id')), 
+                previous_ids)
+    transaction.set_dirty()
+    return snapshot
+
+def get_frontpage_snapshot():
+    """
+    Return the newest FrontpageSnapshot, or None if there isn't one new
+    enough to use (or they are turned off).
+    """
+    max_age = news_settings.NEWS_FRONTPAGE_SNAPSHOT_SECONDS
+    if not max_age:
+        return None
+    snapshots = list(FrontpageSnapshot.objects.order_by('-id')[:1])
+    if not snapshots or snapshots[0].date_created < \
+            datetime.datetime.now() - datetime.timedelta(seconds=max_age):
+        return None
+    return snapshots[0]
+
+def get_snapshot_page(snapshot, page=1, show_dead=False, after=None,
+        objs_per_page=NEWS_ITEMS_FRONTPAGE):
+    """
+    Return a KeysetPage like get_frontpage_page() does, read from 
+    snapshot.  Its object_list is SnapshotNewsItems.  Returns None if the 
+    page isn't all in the snapshot, or the token after is from a 
+    different order than the snapshot's.  It also returns None if the
+    snapshot's entries have been deleted since it was picked (by a newer
+    one being written), so the page never comes back empty by mistake.
+    """
+    if show_dead:
+        num_items = snapshot.num_with_dead
+    else:
+        num_items = snapshot.num_live
+    num_entries = min(num_items, news_settings.NEWS_FRONTPAGE_SNAPSHOT_SIZE)
+
+    decoded = after and decode_keyset_token(after, 
+            [0.0, datetime.datetime.now(), 0])
+    if decoded:
+        start_index, values = decoded
+        first = start_index - 1
+        # the token is for the news item just before the page, so read
+        # that too, to make sure it is still there
+        low = first - 1
+    else:
+        start_index = (max(page, 1) - 1) * objs_per_page + 1
+        first = low = start_index - 1
+        # a page past the end gets the last page, from the cached lists
+        if first > 0 and first >= num_items:
+            return None
+    if low < 0 or (first + objs_per_page > num_entries and 
+            num_entries < num_items):
+        return None
+
+    rows = list(FrontpageEntry.objects.filter(snapshot=snapshot, 
+            show_dead=show_dead, position__gte=low, 
+            position__lt=first + objs_per_page).order_by(
+            'position').values_list(*SNAPSHOT_COLUMNS))
+    if decoded:
+        if not rows or [rows[0][1], rows[0][2], rows[0][0]] != values:
+            return None
+        rows = rows[1:]
+    if len(rows) < min(objs_per_page, num_entries - first):
+        return None
+
+    news_items = [SnapshotNewsItem(row) for row in rows]
+    next_token = None
+    if news_items and first + objs_per_page < num_items:
+        last = news_items[-1]
+        next_token = encode_keyset_token(start_index + objs_per_page, 
+                (last.ranking, last.date_posted, last.id))
+    return KeysetPage(news_items, start_index, next_token)
+
+def get_frontpage_page(page=1, show_dead=False, after=None, 
+        objs_per_page=NEWS_ITEMS_FRONTPAGE):
+    """
+    Return a KeysetPage (see news.helpers.get_keyset_page()) for the 
+    frontpage, starting after the token after, or at page if there isn't 
+    one.  Its object_list is the news items on that page, in order.
+    They are SnapshotNewsItems if the page came from a frontpage snapshot.
+    """
+    snapshot = get_frontpage_snapshot()
+    if snapshot is not None:
+        snapshot_page = get_snapshot_page(snapshot, page, show_dead, after,
+                objs_per_page)
+        if snapshot_page is not None:
+            return snapshot_page
+
+    if not news_settings.NEWS_FRONTPAGE_CACHE_SECONDS:
+        return get_keyset_page(get_frontpage_querymanager(show_dead=show_dead),
+                FRONTPAGE_KEYS, after, page, objs_per_page)
+
+    keys = get_frontpage_keys(show_dead)
+    decoded = after and decode_keyset_token(after, 
+            [0.0, datetime.datetime.now(), 0])
+    if decoded:
+        # the list is biggest first, so find the first one after the 
+        # token's with a binary search
+        start_index, values = decoded
+        values = tuple(values)
+        low, high = 0, len(keys)
+        while low < high:
+            middle = (low + high) // 2
+            if tuple(keys[middle]) < values:
+                high = middle
+            else:
+                low = middle + 1
+        first = low
+    else:
+        start_index = (max(page, 1) - 1) * objs_per_page + 1
+        first = start_index - 1
+        # a page past the end gets the last page, like get_keyset_page()
+        if first > 0 and first >= len(keys):
+            first = max(0, len(keys) - 1) // objs_per_page * objs_per_page
+            start_index = first + 1
+
+    page_keys = keys[first:first + objs_per_page]
+    next_token = None
+    if first + objs_per_page < len(keys):
+        next_token = encode_keyset_token(start_index + objs_per_page, 
+                page_keys[-1])
+
+    # something in the list might have been deleted since it was cached,
+    # but get_in_order() leaves those out
+    return KeysetPage(get_in_order(NewsItem, 
+            [id for ranking, date_posted, id in page_keys]),
+            start_index, next_token)
+
+
+# Caching whole pages for people who aren't logged in.
+#
+# Each page is cached under its full path (so ?page=2 is a different 
+# page), plus a version number for its path.  Purging a path just gives 
+# it a new version, which throws away every page of it at once.
+
+PAGE_CACHE_KEY = 'news_page_%s_%s'
+PAGE_VERSION_KEY = 'news_page_version_%s'
+# This needs to be longer than NEWS_PAGE_CACHE_SECONDS and 
+# NEWS_THREAD_CACHE_SECONDS, so a version is never forgotten while there 
+# are still things cached with it.
+VERSION_SECONDS = 24 * 60 * 60
+
+
+def new_version():
+    """ Return a version number that hasn't been used before. """
+    return repr(time.time())
+
+def page_version_key(path):
+    """ Return the cache key for the version of the pages at path. """
+    # /news_item/1 and /news_item/1/ are the same page
+    return PAGE_VERSION_KEY % md5_constructor(path.rstrip('/')).hexdigest()
+
+def get_page_version(path):
+    """ Return the current version of the pages at path. """
+    key = page_version_key(path)
+    version = cache.get(key)
+    if version is None:
+        version = new_version()
+        cache.set(key, version, VERSION_SECONDS)
+    return version
+
+def purge_pages(paths):
+    """ Throw away the cached pages at paths. """
+    for path in paths:
+        cache.set(page_version_key(path), new_version(), VERSION_SECONDS)
+
+def purge_list_pages():
+    """ Throw away the cached frontpage and /new pages. """
+    purge_pages([reverse('news.views.news_items.index'),
+                 reverse('news.views.news_items.new_news_items')])
+
+def purge_thread_pages(comment):
+    """
+    Throw away the cached pages that show comment: its news item, the
+    comments above it, itself, and the lists (they show comment counts).
+    Its thread's cached fragments are thrown away too.
+    """
+    ancestor_ids = comment.get_ancestor_ids()
+    bump_thread_version(ancestor_ids[-1])
+    paths = [reverse('news.views.news_items.news_item', 
+                args=(ancestor_ids[-1],))]
+    for comment_id in [comment.id] + ancestor_ids[:-1]:
+        paths.append(reverse('news.views.comments.comment', 
+                args=(comment_id,)))
+    purge_pages(paths)
+    purge_list_pages()
+
+def page_is_cacheable(request):
+    """
+    Return True if request can be answered from the page cache.  It has 
+    to be a GET from someone who isn't logged in and doesn't have 
+    anything in their session (like a comment_posting_error to show).
+    """
+    if request.method != 'GET' or not news_settings.NEWS_PAGE_CACHE_SECONDS:
+        return False
+    # no session at all, so there's no need to look it up
+    if settings.SESSION_COOKIE_NAME not in request.COOKIES:
+        return True
+    return not request.user.is_authenticated() and \
+            not request.session.keys()
+
+def cache_page_for_anonymous(view):
+    """
+    Decorator for views that show the same thing to everyone who isn't
+    logged in.  Their pages are kept in the cache for 
+    NEWS_PAGE_CACHE_SECONDS, and served from there without running the
+    view (or touching the database) until they are purged.
+    """
+    def cached_view(request, *args, **kwargs):
+        if not page_is_cacheable(request):
+            return view(request, *args, **kwargs)
+
+        key = PAGE_CACHE_KEY % (get_page_version(request.path),
+                md5_constructor(request.get_full_path()).hexdigest())
+        response = cache.get(key)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response, news_settings.NEWS_PAGE_CACHE_SECONDS)
+        return response
+    return wraps(view)(cached_view)
+
+
+# Caching threads of comments.
+#
+# The news item and comment pages cache the HTML for their threads (see
+# the cachethread tag in news_extras.py), rendered the way someone who 
+# isn't logged in sees it.  The bits that are different for each user, 
+# the arrows and the edit and delete links, are marked in it, and 
+# filled in for whoever is looking at the page each time it is shown,
+# from the same templates the uncached page uses.
+# Each thread has a version number, which changes when one of its 
+# comments is posted, edited, deleted or voted on.
+
+THREAD_FRAGMENT_KEY = 'news_thread_%s_%s'
+THREAD_VERSION_KEY = 'news_thread_version_%s'
+
+ARROWS_MARK_RE = re.compile(r'<!--arrows (\d+)-->(.*?)<!--/arrows-->', 
+        re.DOTALL)
+EDIT_MARK_RE = re.compile(r'<!--edit (\d+)-->')
+
+
+def get_thread_version(news_item_id):
+    """ Return the current version of the thread under news_item_id. """
+    key = THREAD_VERSION_KEY % news_item_id
+    version = cache.get(key)
+    if version is None:
+        version = new_version()
+        cache.set(key, version, VERSION_SECONDS)
+    return version
+
+def bump_thread_version(news_item_id):
+    """ Throw away the cached fragments for the thread under news_item_id. """
+    cache.set(THREAD_VERSION_KEY % news_item_id, new_version(), 
+            VERSION_SECONDS)
+
+def get_thread_fragment_key(news_item_id, path):
+    """ 
+    Return the cache key for the thread under news_item_id as it is 
+    shown on the page at path.
+    """
+    return THREAD_FRAGMENT_KEY % (get_thread_version(news_item_id),
+            md5_constructor(path).hexdigest())
+
+def add_user_to_thread(html, comments, userprofile, voted_ids, next):
+    """
+    Fill in the bits of a cached thread (html) that are different for 
+    userprofile: the arrows on the comments they have voted on (the ids
+    in voted_ids) and the edit and delete links on the ones they can 
+    edit.  comments are the comments in the thread, and next is the 
+    page it is on.  userprofile is None if no one is logged in.
+    """
+    editable = {}
+    if userprofile is not None:
+        editable = dict([(com.id, com) for com in comments 
+                if com.poster_id == userprofile.id and 
+                com.can_be_edited(userprofile)])
+
+    def arrows(match):
+        if int(match.group(1)) in voted_ids:
+            return voted_arrow
+        return match.group(2)
+
+    def edit_links(match):
+        comment = editable.get(int(match.group(1)))
+        if comment is None:
+            return ''
+        return render_to_string('news/small_parts/edit_links.html',
+                {'comment': comment, 'next': next})
+
+    if voted_ids:
+        voted_arrow = render_to_string('news/small_parts/voted_arrow.html')
+        html = ARROWS_MARK_RE.sub(arrows, html)
+    return EDIT_MARK_RE.sub(edit_links, html)
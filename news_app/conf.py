@@ -83,6 +83,73 @@ NEWS_UPDATE_RANKING_LOCKFILE = getattr(settings, "NEWS_UPDATE_RANKING_LOCKFILE",
 # tells how many items should be shown on the frontpage
 NEWS_ITEMS_FRONTPAGE = getattr(settings, "NEWS_ITEMS_FRONTPAGE", 15)
 
+# If this is True, every comment stores its place in its thread
+# (Comment.thread_path), so a thread can be read in order straight from
+# the database instead of being put together in memory.  The paths are
+# updated when comments are posted and when update_ranking.py re-ranks
+# a comment.
+NEWS_USE_COMMENT_PATHS = getattr(settings, "NEWS_USE_COMMENT_PATHS", False)
+
+# If this is True, votes and new comments don't update rankings right
+# away.  They put the rankable in a queue (news.models.RerankRequest)
+# and news_app/scripts/update_ranking.py updates them.  Only turn this
+# off if update_ranking.py isn't running.
+NEWS_QUEUE_RERANKS = getattr(settings, "NEWS_QUEUE_RERANKS", True)
+
+# When NEWS_QUEUE_RERANKS is True, viewing a news item or comment puts it 
+# in the rerank queue if its ranking is older than this many seconds.
+# Each web server process only does this once every this many seconds 
+# for each rankable, so busy pages don't fill up the queue.
+NEWS_VIEW_RERANK_SECONDS = getattr(settings, "NEWS_VIEW_RERANK_SECONDS", 300)
+
+# The frontpage order is kept in Django's cache for at most this many
+# seconds (see news/caching.py).  update_ranking.py and votes refresh it
+# before then.  Set this to 0 to work out the frontpage on every request.
+NEWS_FRONTPAGE_CACHE_SECONDS = getattr(settings, 
+        "NEWS_FRONTPAGE_CACHE_SECONDS", 60)
+
+# update_ranking.py works out the cached frontpage again at least this 
+# often.
+NEWS_FRONTPAGE_REFRESH_SECONDS = getattr(settings, 
+        "NEWS_FRONTPAGE_REFRESH_SECONDS", 10)
+
+# If this is more than 0, update_ranking.py also writes the first 
+# NEWS_FRONTPAGE_SNAPSHOT_SIZE news items on the frontpage, with their
+# titles, urls and so on, to a table (news.models.FrontpageEntry) every 
+# NEWS_FRONTPAGE_REFRESH_SECONDS (or every half of this, if that is 
+# shorter).  The frontpage is then read from there while it is at most 
+# this many seconds old, and from the cache (or the database) when it 
+# is older.
+NEWS_FRONTPAGE_SNAPSHOT_SECONDS = getattr(settings, 
+        "NEWS_FRONTPAGE_SNAPSHOT_SECONDS", 0)
+NEWS_FRONTPAGE_SNAPSHOT_SIZE = getattr(settings, 
+        "NEWS_FRONTPAGE_SNAPSHOT_SIZE", 300)
+
+# The frontpage, /new, and news item and comment pages are cached for 
+# this many seconds for people who aren't logged in (see news/caching.py).
+# By default this is how often update_ranking.py refreshes the frontpage,
+# so they are about as up to date as the rankings.  Set this to 0 to
+# turn it off.
+NEWS_PAGE_CACHE_SECONDS = getattr(settings, "NEWS_PAGE_CACHE_SECONDS",
+        NEWS_FRONTPAGE_REFRESH_SECONDS)
+
+# The HTML for a thread of comments is cached for at most this many 
+# seconds (see the cachethread tag).  Posting, editing, deleting or voting
+# on a comment throws its thread away before then.  The "posted 5 minutes
+# ago" times in it can be this far off.  Set this to 0 to turn it off.
+NEWS_THREAD_CACHE_SECONDS = getattr(settings, "NEWS_THREAD_CACHE_SECONDS", 
+        300)
+
+# news.middleware.InstrumentationMiddleware logs a warning when a request
+# runs the same query more than this many times.
+NEWS_REPEATED_QUERY_LIMIT = getattr(settings, "NEWS_REPEATED_QUERY_LIMIT", 
+        10)
+
+# If this is True, news.middleware.InstrumentationMiddleware logs one line
+# for every request with its number of queries and how long it took.
+NEWS_INSTRUMENTATION_LOG = getattr(settings, "NEWS_INSTRUMENTATION_LOG", 
+        False)
+
 
 # Should we use the Paypal sandbox when accepting payments or the real site?
 NEWS_PAYPAL_USE_SANDBOX = getattr(settings, "NEWS_PAYPAL_USE_SANDBOX", True)
@@ -2,23 +2,42 @@
 Helper functions to assist the views.
 """
 from django.http import Http404
+from django.db import transaction
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.db import models
+from django.db.models import Q
 
-from urlparse import urlparse
+from django.utils.hashcompat import md5_constructor
+
+from urlparse import urlparse, urlunparse
 from urllib import urlencode
-import datetime
+import cgi, datetime, operator
 
-from news.models import NewsItem
+from news.models import NewsItem, Comment, Rated, THREAD_PATH_STEP_LENGTH
 from news.conf import NEWS_ITEMS_FRONTPAGE
+import news.conf as news_settings
+
+# Some databases (sqlite) can only take so many parameters in one query,
+# so big "id IN (...)" lookups get split into chunks of this size.
+MAX_IN_CLAUSE_IDS = 500
+
 
+def shows_dead(request):
+    """ Return True if the logged in user wants to see dead things. """
+    return bool(request and request.user.is_authenticated() and
+            request.user.get_profile().option_show_dead)
 
-def get_frontpage_querymanager(request=None):
+def get_frontpage_querymanager(request=None, show_dead=None):
     """
     Get the querymanager containing all of the news items that could be on
-    the frontpage.
+    the frontpage.  Dead ones are left out unless show_dead is True (or
+    if it isn't given, unless the user logged in to request wants to 
+    see them).
     """
-    if request and request.user.is_authenticated() and \
-            request.user.get_profile().option_show_dead:
+    if show_dead is None:
+        show_dead = shows_dead(request)
+
+    if show_dead:
         querymanager = \
                 NewsItem.objects.filter(date_posted__gt=(datetime_ago(weeks=4)))
     else:
@@ -26,40 +45,188 @@ def get_frontpage_querymanager(request=None):
                 NewsItem.objects.filter(date_posted__gt=(datetime_ago(weeks=4)),
                         dead=False)
 
-    querymanager = querymanager.order_by('-ranking', '-date_posted')
+    # the id is there so news items never tie (see get_keyset_page())
+    querymanager = querymanager.order_by('-ranking', '-date_posted', 
+            '-id').select_related('poster__user')
 
     return querymanager
 
-def get_child_comments(comment_set, depth=0, return_dead=True):
+def get_child_comments(parent, depth=0, return_dead=True):
     """ 
-    Return a list of all the comments in comment_set, 
-    along with all of the children of these comments.
-    Return dead comment if return_dead is true.
+    Return a list of all the comments posted to parent (a news item
+    or a comment), along with all of the children of these comments.
+    Each item in the list is a dictionary holding the comment and 
+    its depth.  Return dead comments if return_dead is true.
+
+    The whole thread is fetched in one query (using the news item each 
+    comment is stored with).  If NEWS_USE_COMMENT_PATHS is set, the 
+    database hands the thread back already in order.  Otherwise (or if 
+    some of the paths haven't been worked out yet) the tree is put 
+    together in memory.
+    """
+    if isinstance(parent, NewsItem):
+        news_item_id = parent.id
+    elif isinstance(parent, Comment) and parent.news_item_id is not None:
+        news_item_id = parent.news_item_id
+    else:
+        news_item_id = parent.get_parent_news_item().id
+
+    coms = Comment.objects.filter(news_item=news_item_id).select_related(
+            'poster__user')
+
+    if news_settings.NEWS_USE_COMMENT_PATHS:
+        coms = list(coms.order_by('thread_path'))
+        if all(com.thread_path for com in coms):
+            return get_child_comments_by_path(coms, parent, depth, 
+                    return_dead)
+        coms.sort(key=lambda cm: cm.date_posted, reverse=True)
+    else:
+        coms = coms.order_by('-date_posted')
+
+    # maps a parent id to the list of its comments, newest first
+    children = {}
+    for com in coms:
+        children.setdefault(com.parent_id, []).append(com)
+
+    return build_comment_tree(children, parent.id, depth, return_dead)
+
+def get_child_comments_by_path(thread, parent, depth=0, return_dead=True):
+    """
+    Return the same thing as get_child_comments(), but using a thread
+    that is already sorted by thread_path.  thread is every comment 
+    posted under parent's news item.
     """
+    prefix = ''
+    if not isinstance(parent, NewsItem):
+        prefix = [com.thread_path for com in thread if com.id == parent.id][0]
+    # the depth of the comments directly under parent
+    base_depth = len(prefix) // THREAD_PATH_STEP_LENGTH + 1
+
     comments = []
+    for com in thread:
+        if com.thread_path.startswith(prefix) and com.id != parent.id and \
+                (return_dead or not com.dead):
+            com_depth = len(com.thread_path) // THREAD_PATH_STEP_LENGTH
+            comments.append({'comment': com, 
+                             'depth': depth + com_depth - base_depth})
+    return comments
+
+def build_comment_tree(children, parent_id, depth=0, return_dead=True):
+    """
+    Flatten the comments in children into the list returned by
+    get_child_comments().  children is a dictionary mapping a parent id 
+    to a list of its comments, newest first.  Siblings are put in order
+    of their ranking.
 
-    for com in sorted(comment_set.all().order_by('-date_posted'), key=lambda cm: -cm.ranking):
+    This walks the tree with a stack instead of recursing, so really
+    deep threads are fine.
+    """
+    def ranked(coms):
+        # sorted() is stable, so comments with the same 
+        # ranking stay newest first
+        return iter(sorted(coms, key=lambda cm: -cm.ranking))
+
+    comments = []
+    stack = [ranked(children.get(parent_id, []))]
 
-        if return_dead or not com.dead:
-            comments.append({'comment': com, 'depth': depth})
+    while stack:
+        for com in stack[-1]:
+            if return_dead or not com.dead:
+                comments.append({'comment': com, 
+                                 'depth': depth + len(stack) - 1})
+            if com.id in children:
+                stack.append(ranked(children[com.id]))
+            break
+        else:
+            stack.pop()
 
-        if com.child_set.count():
-            comments.extend(get_child_comments(com.child_set, depth+1, return_dead))
-    
     return comments
 
-def get_next_with_pages(url, page):
+@transaction.commit_on_success
+def update_thread_paths(news_item_id):
+    """
+    Work out Comment.thread_path for every comment posted under 
+    the news item with id news_item_id, and save the ones that changed.
+    """
+    coms = Comment.objects.filter(news_item=news_item_id)
+    children = {}
+    all_coms = []
+    for com in coms.order_by('-date_posted'):
+        children.setdefault(com.parent_id, []).append(com)
+        all_coms.append(com)
+
+    paths = calculate_thread_paths(children, news_item_id)
+    for com in all_coms:
+        if com.thread_path != paths[com.id]:
+            Comment.objects.filter(id=com.id).update(thread_path=paths[com.id])
+
+def calculate_thread_paths(children, news_item_id):
+    """
+    Return a dictionary mapping the id of every comment in children (a
+    dictionary like the one build_comment_tree() takes) to its 
+    Comment.thread_path in the thread under news_item_id.  The comments
+    only need id, parent_id, ranking and dead, so they don't have to be
+    in the database yet.
+    """
+    max_length = Comment._meta.get_field('thread_path').max_length
+    paths = {news_item_id: ''}
+    # the number of comments under each parent we have given a path so far
+    positions = {}
+
+    for com_data in build_comment_tree(children, news_item_id):
+        com = com_data['comment']
+        position = positions.get(com.parent_id, 0)
+        positions[com.parent_id] = position + 1
+        paths[com.id] = paths[com.parent_id] + \
+                str(position).zfill(THREAD_PATH_STEP_LENGTH)
+
+    # If the thread is too deep for a comment's path to fit, leave it 
+    # blank.  get_child_comments() will work without it.
+    for com_id, path in paths.items():
+        if len(path) > max_length:
+            paths[com_id] = ''
+    del paths[news_item_id]
+    return paths
+
+def get_voted_ids(request, rankables):
+    """
+    Return a set of the ids of the rankables in rankables that the 
+    logged in user has already voted on, or None if no one is logged in.
+
+    This is put in the template context as 'voted_ids', so the 
+    ifalreadyvoted tag doesn't need a query for every arrow it draws.
+    """
+    if not request.user.is_authenticated():
+        return None
+
+    rankable_ids = [rankable.id for rankable in rankables]
+    userprofile = request.user.get_profile()
+
+    voted_ids = set()
+    for i in range(0, len(rankable_ids), MAX_IN_CLAUSE_IDS):
+        rated = Rated.objects.filter(userprofile=userprofile,
+                rankable__in=rankable_ids[i:i + MAX_IN_CLAUSE_IDS])
+        voted_ids.update(rated.values_list('rankable', flat=True))
+    return voted_ids
+
+def get_next_with_pages(url, page, after=None):
     """
     Takes url as a base, and urlencodes a "?page=NUM"
     part onto it, but only if it's not the first page.
+    If after (a keyset page token) is given, "?after=TOKEN"
+    is used instead.
 
     Example:
     >>> get_next_with_pages('/', 1)
     '/'
     >>> get_next_with_pages('/', 2) 
     '%2F%3Fpage%3D2'
+    >>> get_next_with_pages('/', 1, '16_4')
+    '%2F%3Fafter%3D16_4'
     """
-    if page == 1:
+    if after:
+        return urlencode({'next': url + "?" + urlencode({'after': after})})[5:]
+    elif page == 1:
         return url
     else:
         return urlencode({'next': url + "?page=" + str(page)})[5:]
@@ -90,6 +257,145 @@ def get_paginator_page(objects, page=1, objs_per_page=NEWS_ITEMS_FRONTPAGE):
 
     return front_page
 
+def get_in_order(model, ids, related=('poster__user',)):
+    """
+    Return the model objects with ids, in the same order as ids.  Ones 
+    that don't exist (any more) are left out.  The related objects come
+    along in the same query (by default the poster, since every list 
+    shows who posted each thing).
+    """
+    queryset = model.objects.select_related(*related)
+    objects = {}
+    for i in range(0, len(ids), MAX_IN_CLAUSE_IDS):
+        objects.update(queryset.in_bulk(ids[i:i + MAX_IN_CLAUSE_IDS]))
+    return [objects[id] for id in ids if id in objects]
+
+class KeysetPage(object):
+    """
+    One page of a list, found by where the last page ended instead of by
+    page number (see get_keyset_page()).  It can be used in templates like 
+    a paginator page: object_list, has_next and start_index are the same.  
+    next_token goes in the "after" GET variable to get the next page.
+    """
+    def __init__(self, object_list, start_index, next_token):
+        self.object_list = object_list
+        self._start_index = start_index
+        self.next_token = next_token
+
+    def has_next(self):
+        return self.next_token is not None
+
+    def start_index(self):
+        return self._start_index
+
+def encode_keyset_value(value):
+    """ Turn a value in a keyset page token into a string. """
+    if isinstance(value, datetime.datetime):
+        return '%04d%02d%02d%02d%02d%02d%06d' % (value.year, value.month,
+                value.day, value.hour, value.minute, value.second, 
+                value.microsecond)
+    return repr(value)
+
+def decode_keyset_value(string, example):
+    """ 
+    Turn string back into a value of the same type as example.
+    Raises ValueError if it isn't one.
+    """
+    if isinstance(example, datetime.datetime):
+        if len(string) != 20 or not string.isdigit():
+            raise ValueError("Bad datetime in keyset token: " + string)
+        return datetime.datetime(int(string[0:4]), int(string[4:6]), 
+                int(string[6:8]), int(string[8:10]), int(string[10:12]), 
+                int(string[12:14]), int(string[14:20]))
+    elif isinstance(example, float):
+        return float(string)
+    return int(string.rstrip('L'))
+
+def encode_keyset_token(start_index, values):
+    """
+    Make the token for the page starting at start_index, right after 
+    the row whose keys are values.
+    """
+    return '_'.join([str(start_index)] + 
+            [encode_keyset_value(value) for value in values])
+
+def decode_keyset_token(token, examples):
+    """
+    Undo encode_keyset_token().  examples are values with the same types 
+    as the keys.  Returns (start index, values), or None if the token 
+    isn't a good one.
+    """
+    bits = token.split('_')
+    if len(bits) != len(examples) + 1:
+        return None
+    try:
+        return (max(int(bits[0]), 1), [decode_keyset_value(bit, example) 
+                for bit, example in zip(bits[1:], examples)])
+    except ValueError:
+        return None
+
+def keyset_examples(queryset, keys):
+    """ Return values with the same types as keys in queryset's model. """
+    examples = []
+    for key in keys:
+        field = queryset.model._meta.get_field(key)
+        if isinstance(field, models.DateTimeField):
+            examples.append(datetime.datetime.now())
+        elif isinstance(field, models.FloatField):
+            examples.append(0.0)
+        else:
+            examples.append(0)
+    return examples
+
+def get_keyset_page(queryset, keys, after=None, page=1, 
+        objs_per_page=NEWS_ITEMS_FRONTPAGE):
+    """
+    Return a KeysetPage of queryset, ordered by keys (field names, 
+    biggest first, and the last one should be 'id' so rows never tie).  
+
+    If after is a token from the last page's next_token, the page starts 
+    right after the row that page ended on, with a WHERE on the keys, so 
+    this costs the same no matter how far down the list it is.  Otherwise 
+    page is used like a page number (for old links), with an OFFSET.  
+    Either way there is no COUNT(*); one extra row is fetched to tell if 
+    there is a next page.  The only exception is a page number past the 
+    end, which gets the last page instead, like the paginator used to.
+    """
+    queryset = queryset.order_by(*['-' + key for key in keys])
+    decoded = after and decode_keyset_token(after, 
+            keyset_examples(queryset, keys))
+
+    if decoded:
+        start_index, values = decoded
+        # (a, b, id) < (x, y, z) is 
+        # a < x or (a = x and b < y) or (a = x and b = y and id < z)
+        terms = []
+        for i in range(len(keys)):
+            term = Q(**{keys[i] + '__lt': values[i]})
+            for key, value in zip(keys[:i], values[:i]):
+                term &= Q(**{key: value})
+            terms.append(term)
+        objects = list(queryset.filter(reduce(operator.or_, terms))[
+                :objs_per_page + 1])
+    else:
+        start_index = (max(page, 1) - 1) * objs_per_page + 1
+        objects = list(queryset[start_index - 1:
+                start_index + objs_per_page])
+        # If page request (9999) is out of range, deliver last page of results.
+        if not objects and start_index > 1:
+            num_pages = max(1, (queryset.count() + objs_per_page - 1) // 
+                    objs_per_page)
+            start_index = (num_pages - 1) * objs_per_page + 1
+            objects = list(queryset[start_index - 1:
+                    start_index + objs_per_page])
+
+    next_token = None
+    if len(objects) > objs_per_page:
+        objects = objects[:objs_per_page]
+        next_token = encode_keyset_token(start_index + objs_per_page,
+                [getattr(objects[-1], key) for key in keys])
+    return KeysetPage(objects, start_index, next_token)
+
 def datetime_ago(weeks=0, days=0, hours=0, minutes=0, seconds=0):
     """ 
     Get a datetime object for some amount of time ago.
@@ -110,6 +416,44 @@ def improve_url(url):
             url = "http://" + url
     return url
 
+# the ports that can be left out of a url without changing where it goes
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+def canonicalize_url(url):
+    """
+    Return url in a form where urls that go to the same page (as far as
+    we can tell) come out the same.  The scheme and host are lowercased, 
+    "www.", default ports, the fragment, tracking parameters (utm_*) and 
+    trailing slashes are taken off, and the rest of the query is sorted.
+    This is only for finding duplicates; the url shown is never changed.
+    """
+    url = improve_url(url.strip())
+    (scheme, netloc, path, params, query, fragment) = urlparse(url)
+    scheme = scheme.lower()
+    netloc = netloc.lower()
+    if netloc.startswith('www.'):
+        netloc = netloc[len('www.'):]
+    if ':' in netloc:
+        host, port = netloc.rsplit(':', 1)
+        if DEFAULT_PORTS.get(scheme) == port:
+            netloc = host
+    path = path.rstrip('/')
+    query_args = [(name, value) for name, value in 
+            cgi.parse_qsl(query, keep_blank_values=True)
+            if not name.startswith('utm_')]
+    query = urlencode(sorted(query_args))
+    return urlunparse((scheme, netloc, path, params, query, ''))
+
+def hash_url(url):
+    """
+    Return the hash of url's canonical form (see canonicalize_url()), which 
+    is what NewsItem.url_hash holds.  It's a lot shorter than the url, so 
+    every database can index it.
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return md5_constructor(canonicalize_url(url)).hexdigest()
+
 def assert_or_404(boolean_val):
     """
     This is to assert something and raise an Http404 if it is false.
@@ -0,0 +1,256 @@
+"""
+Measuring what each view costs.
+
+Put 'news.middleware.InstrumentationMiddleware' first in
+MIDDLEWARE_CLASSES, and for every request it keeps track of:
+
+  the number of SQL queries and the time spent running them
+  the time spent rendering templates (this includes any queries run
+      from the templates)
+  the time for the whole request
+  SQL that was run more than NEWS_REPEATED_QUERY_LIMIT times (usually
+      a loop doing one query per object, when it could do one for all
+      of them)
+
+With DEBUG on, these are added to the response as X-News-* headers.
+They are always added up per view in each process (see
+get_view_stats()), and with NEWS_INSTRUMENTATION_LOG each request is
+logged as one line to the "news.instrumentation" logger.  Repeated
+queries are always logged as warnings.
+"""
+from django.conf import settings
+from django.db import connection
+from django.template import Template
+
+import logging, re, threading, time
+
+import news.conf as news_settings
+
+logger = logging.getLogger('news.instrumentation')
+
+
+class NullHandler(logging.Handler):
+    """ 
+    Throws log records away, so there's no "No handlers could be found"
+    message if logging isn't set up. 
+    """
+    def emit(self, record):
+        pass
+
+logger.addHandler(NullHandler())
+
+# the stats for the request each thread is working on
+_current = threading.local()
+
+# the totals for each view, in this process
+_view_stats = {}
+_view_stats_lock = threading.Lock()
+
+# "id IN (%s, %s, %s)" is the same query however many ids there are
+IN_LIST_RE = re.compile(r'\(%s(?:, %s)*\)')
+
+
+class RequestStats(object):
+    """ What one request has cost so far. """
+
+    def __init__(self):
+        self.start = time.time()
+        self.view_name = None
+        self.num_queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        # templates render other templates ({% include %}), so only the
+        # outermost one is timed
+        self.render_depth = 0
+        self.query_counts = {}
+
+    def record_query(self, sql, elapsed):
+        """ Count a query that took elapsed seconds. """
+        self.num_queries += 1
+        self.db_time += elapsed
+        shape = IN_LIST_RE.sub('(...)', sql)
+        self.query_counts[shape] = self.query_counts.get(shape, 0) + 1
+
+    def get_repeated_queries(self, limit):
+        """
+        Return (count, sql) for each query that was run more than limit
+        times, most first.
+        """
+        repeated = [(count, sql) for sql, count in self.query_counts.items()
+                if count > limit]
+        repeated.sort(reverse=True)
+        return repeated
+
+
+class StatsCursorWrapper(object):
+    """ A database cursor that records its queries in a RequestStats. """
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.stats.record_query(sql, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.stats.record_query(sql, time.time() - start)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def get_current_stats():
+    """ Return the RequestStats for this thread's request, or None. """
+    return getattr(_current, 'stats', None)
+
+def start_recording():
+    """
+    Start recording a request in this thread.  Returns its RequestStats.
+    """
+    stats = RequestStats()
+    _current.stats = stats
+    # connection is different in each thread, so this only changes the
+    # cursors for this request
+    original_cursor = connection.__class__.cursor
+    connection.cursor = lambda: StatsCursorWrapper(
+            original_cursor(connection), stats)
+    return stats
+
+def stop_recording():
+    """
+    Stop recording the request in this thread.  Returns its RequestStats,
+    or None if there wasn't one.
+    """
+    stats = get_current_stats()
+    _current.stats = None
+    if 'cursor' in connection.__dict__:
+        del connection.cursor
+    return stats
+
+def install_template_timer():
+    """ Make Template.render() add its time to the current request's. """
+    original_render = Template.render
+    if getattr(original_render, 'news_instrumented', False):
+        return
+
+    def timed_render(self, context):
+        stats = get_current_stats()
+        if stats is None or stats.render_depth:
+            return original_render(self, context)
+        stats.render_depth += 1
+        start = time.time()
+        try:
+            return original_render(self, context)
+        finally:
+            stats.render_depth -= 1
+            stats.render_time += time.time() - start
+    timed_render.news_instrumented = True
+    Template.render = timed_render
+
+def record_view_stats(view_name, stats, total_time, num_repeated):
+    """ Add a request's stats to the totals for view_name. """
+    _view_stats_lock.acquire()
+    try:
+        totals = _view_stats.setdefault(view_name, {'requests': 0,
+                'queries': 0, 'db_time': 0.0, 'render_time': 0.0,
+                'total_time': 0.0, 'max_total_time': 0.0,
+                'max_queries': 0, 'repeated': 0})
+        totals['requests'] += 1
+        totals['queries'] += stats.num_queries
+        totals['db_time'] += stats.db_time
+        totals['render_time'] += stats.render_time
+        totals['total_time'] += total_time
+        totals['max_total_time'] = max(totals['max_total_time'], total_time)
+        totals['max_queries'] = max(totals['max_queries'], stats.num_queries)
+        if num_repeated:
+            totals['repeated'] += 1
+    finally:
+        _view_stats_lock.release()
+
+def get_view_stats():
+    """
+    Return a dictionary of the totals for each view since this process
+    started (or reset_view_stats() was called).  Each one is a
+    dictionary of the number of requests, queries, db_time,
+    render_time, total_time (all in seconds), max_total_time,
+    max_queries and how many requests repeated a query.
+    """
+    _view_stats_lock.acquire()
+    try:
+        return dict([(view_name, dict(totals))
+                for view_name, totals in _view_stats.items()])
+    finally:
+        _view_stats_lock.release()
+
+def reset_view_stats():
+    """ Throw away the totals for every view. """
+    _view_stats_lock.acquire()
+    try:
+        _view_stats.clear()
+    finally:
+        _view_stats_lock.release()
+
+def format_stats_line(view_name, status_code, stats, total_time,
+        num_repeated):
+    """ Return a request's stats as one key=value line for the log. """
+    return 'view=%s status=%d queries=%d db_ms=%.1f render_ms=%.1f ' \
+            'total_ms=%.1f repeated=%d' % (view_name, status_code,
+            stats.num_queries, stats.db_time * 1000,
+            stats.render_time * 1000, total_time * 1000, num_repeated)
+
+
+class InstrumentationMiddleware(object):
+    """ Records what each request costs.  See the top of this file. """
+
+    def __init__(self):
+        install_template_timer()
+
+    def process_request(self, request):
+        # just in case the last request didn't get to process_response
+        stop_recording()
+        start_recording()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = get_current_stats()
+        if stats is not None:
+            stats.view_name = '%s.%s' % (view_func.__module__,
+                    view_func.__name__)
+
+    def process_response(self, request, response):
+        stats = stop_recording()
+        if stats is None:
+            return response
+
+        total_time = time.time() - stats.start
+        view_name = stats.view_name or 'unknown'
+        repeated = stats.get_repeated_queries(
+                news_settings.NEWS_REPEATED_QUERY_LIMIT)
+        record_view_stats(view_name, stats, total_time, len(repeated))
+
+        if settings.DEBUG:
+            response['X-News-View'] = view_name
+            response['X-News-Queries'] = str(stats.num_queries)
+            response['X-News-DB-Time'] = '%.1fms' % (stats.db_time * 1000)
+            response['X-News-Render-Time'] = '%.1fms' % (
+                    stats.render_time * 1000)
+            response['X-News-Total-Time'] = '%.1fms' % (total_time * 1000)
+            response['X-News-Repeated-Queries'] = str(len(repeated))
+
+        if news_settings.NEWS_INSTRUMENTATION_LOG:
+            logger.info(format_stats_line(view_name, response.status_code,
+                    stats, total_time, len(repeated)))
+        for count, sql in repeated:
+            logger.warning('%s ran the same query %d times: %s' % (
+                    view_name, count, sql))
+        return response
@@ -2,6 +2,7 @@
 These are models for news that are in the database.
 """
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
 
 import news.conf as news_settings
@@ -59,13 +60,23 @@ class Rated(models.Model):
     direction = models.CharField(max_length=4, choices=DIRECTION_CHOICES)
     ranked_from_ip = models.IPAddressField(null=True)
 
+    class Meta:
+        # Someone can only vote on something once.  news.votes.record_vote()
+        # counts on the database enforcing this.  Databases created before
+        # this was here can get it with news/scripts/migrate_rated_unique.py.
+        unique_together = (('rankable', 'userprofile'),)
+
 class Rankable(models.Model):
     """
     This is anything that can be ranked (i.e., have a rating).
     Mainly this is just for Comment and NewsItem.
     """
+    KIND_CHOICES = (('news_item', 'News item'), ('comment', 'Comment'))
+
     poster = models.ForeignKey(UserProfile)
-    date_posted = models.DateTimeField(default=datetime.datetime.now)
+    # the frontpage and the /new pages look things up by this
+    date_posted = models.DateTimeField(default=datetime.datetime.now,
+            db_index=True)
 
     # if a rankable has been deleted
     dead = models.BooleanField(default=False)
@@ -85,6 +96,20 @@ class Rankable(models.Model):
 
     posted_from_ip = models.IPAddressField(null=True)
 
+    # The number of comments posted under this rankable (at any depth),
+    # and how many of those are not dead.  These are kept up to date when
+    # comments are posted and deleted, so we never have to count a whole
+    # thread.  news/scripts/repair_comment_counts.py recounts them.
+    num_comments = models.IntegerField(default=0)
+    num_live_comments = models.IntegerField(default=0)
+
+    # Whether this is a news item or a comment.  It is set when a NewsItem
+    # or Comment is saved, so we can tell what a rankable is without
+    # looking in the other tables.  It is blank for rankables saved before
+    # this field existed (news/scripts/migrate_rankable_kind.py fills it in).
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default='',
+            blank=True)
+
     def calculate_ranking(self):
         """
         Easy algorithm:
@@ -92,25 +117,28 @@ class Rankable(models.Model):
         More complicated algorithm:
         http://arcfn.com/2009/06/how-does-newsyc-ranking-work.html
         """
+        from news.ranking import ranking_for
         delta = datetime.datetime.now() - self.date_posted
         hours = (delta.days * 24.0) + (delta.seconds / 3600.0)
-        # simpler way
-        return (self.rating - 1.0) / ((hours + 2.0) ** 1.5)
-        # more compllicated way
-        # return ((rating - 1.0) ** .8) / ((hours + 2.0) ** 1.8)
+        # the formula is in news.ranking so the bulk updates use it too
+        return ranking_for(self.rating, hours)
 
     def update_ranking(self):
         """
         Update the ranking for the Rankable.
-        The rankable is saved to the database after updating.
+        Only the ranking columns are written to the database, so this
+        doesn't put back an old rating or comment count over a vote or a
+        reply that happened since the rankable was loaded.
         """
         self.ranking = self.calculate_ranking()
         self.last_ranked_date = datetime.datetime.now()
-        # TODO: should this save?
-        self.save()
+        Rankable.objects.filter(id=self.id).update(ranking=self.ranking,
+                last_ranked_date=self.last_ranked_date)
 
     def is_news_item(self):
         """Returns true if this rankable is a news item."""
+        if self.kind:
+            return self.kind == 'news_item'
         if NewsItem.objects.filter(id=self.id):
             return True
         else:
@@ -118,17 +146,34 @@ class Rankable(models.Model):
 
     def is_comment(self):
         """Returns true if this rankable is a comment."""
+        if self.kind:
+            return self.kind == 'comment'
         if Comment.objects.filter(id=self.id):
             return True
         else:
             return False
 
+    def downcast(self):
+        """
+        Returns this rankable as the NewsItem or Comment that it really is,
+        or None if it is neither.  If it already is a NewsItem or Comment 
+        it is just returned.  Otherwise this only needs to look in the 
+        one table it is really in.
+        """
+        if isinstance(self, (NewsItem, Comment)):
+            return self
+        if self.is_news_item():
+            return self.newsitem
+        elif self.is_comment():
+            return self.comment
+        return None
+
     def __unicode__(self):
         uni_string = "" 
         if self.is_news_item():
-            uni_string += "NewsItem: " + unicode(self.newsitem)
+            uni_string += "NewsItem: " + unicode(self.downcast())
         elif self.is_comment():
-            uni_string += "Comment: " + unicode(self.comment)
+            uni_string += "Comment: " + unicode(self.downcast())
         else:
             uni_string += "id " + unicode(self.id)
         return uni_string
@@ -137,32 +182,35 @@ class Rankable(models.Model):
         """
         This returns the number of comments a news item (or a comment) has
         """
-        if hasattr(self, 'child_set'):
-            from news.helpers import get_child_comments
-            return len(get_child_comments(self.child_set, return_dead=False))
-        else:
-            return 0
+        return self.num_live_comments
 
     def has_children(self):
         """
         This returns wheter or not a news item (or comment) has children.
         """
-        if hasattr(self, 'child_set'):
-            from news.helpers import get_child_comments
-            return len(get_child_comments(self.child_set)) > 0
-        else:
-            return False
+        return self.num_comments > 0
 
     def has_nondead_children(self):
         """
         This returns wheter or not a news item (or comment) has children and
         at least one of them is not dead.
         """
-        if hasattr(self, 'child_set'):
-            from news.helpers import get_child_comments
-            return len(get_child_comments(self.child_set, return_dead=False)) > 0
-        else:
+        return self.num_live_comments > 0
+
+    def kill(self):
+        """
+        Mark this rankable as dead (deleted).  If it is a comment, the 
+        comment counts above it are updated.  Returns False if it was 
+        already dead.
+        """
+        # Only one request can actually change dead, so the counts 
+        # can't be taken off twice.
+        if not Rankable.objects.filter(id=self.id, dead=False).update(dead=True):
             return False
+        self.dead = True
+        if self.is_comment():
+            self.downcast().update_ancestor_comment_counts(0, -1)
+        return True
 
     def can_be_edited(self, userprofile):
         """ Return whether the given userprofile can edit a rankable. """
@@ -184,9 +232,9 @@ class Rankable(models.Model):
         return the news item this comment is posted to.
         """
         if self.is_news_item():
-            return self.newsitem
+            return self.downcast()
         elif self.is_comment():
-            return self.comment.get_newsitem()
+            return self.downcast().get_newsitem()
         else:
             return None
 
@@ -252,7 +300,8 @@ class Rankable(models.Model):
 
     def already_voted(self, userprofile):
         """ Returns True if userprofile already voted on this rankable. """
-        return len(self.raters.filter(id=userprofile.id)) > 0
+        return bool(Rated.objects.filter(rankable=self.id, 
+                userprofile=userprofile.id)[:1])
 
 
 class NewsItem(Rankable):
@@ -265,6 +314,10 @@ class NewsItem(Rankable):
     url = models.URLField(null=True, verify_exists=False, 
                           max_length=news_settings.NEWS_MAX_URL_LENGTH)
     text = models.TextField(null=True)
+    # The hash of the url's canonical form (see news.helpers.hash_url()), 
+    # so a url that has already been submitted can be found with an index.
+    url_hash = models.CharField(max_length=32, null=True, db_index=True, 
+            editable=False)
 
     def __unicode__(self):
         if self.url:
@@ -274,6 +327,13 @@ class NewsItem(Rankable):
         else:
             return '%s (%s)' % (self.title, "ERROR! No URL or text!")
 
+    def save(self, *args, **kwargs):
+        # this can't be imported at the top, since news.helpers imports us
+        from news.helpers import hash_url
+        self.kind = 'news_item'
+        self.url_hash = self.url and hash_url(self.url) or None
+        super(NewsItem, self).save(*args, **kwargs)
+
     def is_normal_news_item(self):
         """ 
         Returns true if this is a normal news item.  It's not a 
@@ -311,6 +371,9 @@ class NewsItem(Rankable):
         else:
             return 0
 
+# the number of digits used for each level of Comment.thread_path
+THREAD_PATH_STEP_LENGTH = 6
+
 class Comment(Rankable):
     """
     This represents a comment to a news item or a comment to a comment.
@@ -320,14 +383,142 @@ class Comment(Rankable):
 
     parent = models.ForeignKey(Rankable, related_name='child_set')
 
+    # The news item at the top of this comment's thread.  This is filled in
+    # when the comment is saved, so we don't have to walk up the parents
+    # every time we want it.  Comments posted before this field existed can
+    # be filled in with news/scripts/migrate_comment_news_item.py.
+    news_item = models.ForeignKey(NewsItem, null=True, 
+            related_name='thread_comment_set')
+
+    # Where this comment goes in its thread.  It is made up of one
+    # THREAD_PATH_STEP_LENGTH digit position for each level, starting from 
+    # the top of the thread, so sorting a thread by this puts it in the
+    # same order as news.helpers.get_child_comments().  It is only kept up 
+    # to date when news.conf.NEWS_USE_COMMENT_PATHS is True.  
+    # A blank path means it hasn't been worked out yet.
+    thread_path = models.CharField(max_length=255, default='', blank=True)
+
+    def save(self, *args, **kwargs):
+        is_new = self.id is None
+        self.kind = 'comment'
+        if self.news_item_id is None:
+            self.news_item = self.find_newsitem()
+        super(Comment, self).save(*args, **kwargs)
+        if is_new:
+            self.update_ancestor_comment_counts(1, not self.dead and 1 or 0)
+
+    def get_ancestor_ids(self):
+        """ 
+        Return the ids of the comments above this one (nearest first),
+        followed by the id of the news item at the top of the thread.
+        """
+        parents = dict(Comment.objects.filter(news_item=self.news_item_id
+                ).values_list('id', 'parent'))
+        ancestor_ids = [self.parent_id]
+        while ancestor_ids[-1] in parents:
+            ancestor_ids.append(parents[ancestor_ids[-1]])
+        return ancestor_ids
+
+    def update_ancestor_comment_counts(self, num_comments, num_live_comments):
+        """
+        Add num_comments and num_live_comments to the comment counts
+        of everything above this comment in its thread.
+        """
+        Rankable.objects.filter(id__in=self.get_ancestor_ids()).update(
+                num_comments=F('num_comments') + num_comments,
+                num_live_comments=F('num_live_comments') + num_live_comments)
+
     def get_newsitem(self):
         """ Get the newsitem that this is posted to."""
-        if self.parent.is_news_item():
-            return self.parent.newsitem
+        if self.news_item_id is not None:
+            return self.news_item
+        return self.find_newsitem()
+
+    def find_newsitem(self):
+        """ 
+        Find the newsitem that this is posted to by walking up the parents.
+        get_newsitem() should be used instead of this.
+        """
+        parent = self.parent.downcast()
+        if parent.is_news_item():
+            return parent
         else: 
-            return self.parent.comment.get_newsitem()
+            return parent.get_newsitem()
 
     def __unicode__(self):
         return '%s ("%s")' % (self.poster.username, self.text[0:20])
 
 
+class RerankRequest(models.Model):
+    """
+    A rankable whose ranking needs to be updated (because it was just
+    voted on, for instance).  Views add these with 
+    news.ranking.queue_rerank() instead of updating the ranking right
+    away, and update_ranking.py works through them in batches.
+    """
+    rankable = models.ForeignKey(Rankable)
+    date_requested = models.DateTimeField(default=datetime.datetime.now)
+
+    def __unicode__(self):
+        return 'RerankRequest for %d' % self.rankable_id
+
+
+class FrontpageSnapshot(models.Model):
+    """
+    The order of the frontpage at one moment, written by update_ranking.py
+    (see news.caching.write_frontpage_snapshot()).  Only the newest one is
+    kept, and the frontpage is read from it while it is new enough.
+    """
+    date_created = models.DateTimeField(default=datetime.datetime.now)
+    # how many news items were on the frontpage, without and with dead
+    # ones.  Only the first NEWS_FRONTPAGE_SNAPSHOT_SIZE of them are in 
+    # the snapshot.
+    num_live = models.IntegerField(default=0)
+    num_with_dead = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return 'FrontpageSnapshot from %s' % self.date_created
+
+class FrontpageEntry(models.Model):
+    """
+    A news item in a FrontpageSnapshot, with everything the frontpage 
+    shows about it copied in, so a page of the frontpage can be read with
+    one query and no joins.
+    """
+    snapshot = models.ForeignKey(FrontpageSnapshot)
+    # whether this is in the list with dead news items or the one without
+    show_dead = models.BooleanField(default=False)
+    # where it is in the list, starting at 0
+    position = models.IntegerField()
+
+    news_item = models.ForeignKey(NewsItem)
+    ranking = models.FloatField()
+    date_posted = models.DateTimeField()
+    dead = models.BooleanField(default=False)
+    rating = models.IntegerField()
+    num_live_comments = models.IntegerField()
+    title = models.CharField(max_length=news_settings.NEWS_MAX_TITLE_LENGTH)
+    url = models.URLField(null=True, verify_exists=False, 
+                          max_length=news_settings.NEWS_MAX_URL_LENGTH)
+    poster_username = models.CharField(max_length=30)
+
+    class Meta:
+        # this is also the index a page is read with
+        unique_together = (('snapshot', 'show_dead', 'position'),)
+
+    def __unicode__(self):
+        return 'FrontpageEntry %d for %d' % (self.position, self.news_item_id)
+
+
+# Indexes that can't be declared on the fields above, because they are on
+# more than one column (Django can't do that yet).  news.signals creates 
+# them after syncdb, and news/scripts/migrate_indexes.py adds them to 
+# older databases.  If one of them can't be created it is just left out.
+EXTRA_INDEXES = (
+    # /new and /new_comments (see news.helpers.get_keyset_page())
+    (Rankable, ('kind', 'date_posted')),
+    # a thread read in order (NEWS_USE_COMMENT_PATHS)
+    (Comment, ('news_item', 'thread_path')),
+)
+
+
@@ -0,0 +1,231 @@
+"""
+Query budgets for every page.
+
+This fills the database with a lot of made up users, news items, comments
+and votes (see news/synthetic.py), then goes to every url in news/urls.py,
+once without logging in and once logged in, and measures each one with
+news.middleware: the number of queries, the time spent in them, and the
+time spent rendering templates.
+
+query_budgets.json has the size of the made up data, the most queries
+each url is allowed to run, and the status code each one should return.
+testQueryBudgets (in tests.py) fails if one goes over, which catches 
+things like a template tag that runs a query for every comment.  It 
+also fails if one returns a different status, since a url that 404s or
+sends you to log in (because the made up data isn't what it expects)
+would stay under its budget without really being measured.  
+news/scripts/query_budgets.py prints all the numbers, and can write 
+them out as the new budgets.
+
+The caches are turned off while measuring, so the numbers are for the
+slowest case, and they are the same every time.
+"""
+from django.core.urlresolvers import reverse, RegexURLPattern
+from django.test.client import Client
+from django.utils import simplejson
+
+import os
+
+from news.models import UserProfile, NewsItem, Comment
+from news.synthetic import generate_dataset
+from news.middleware import start_recording, stop_recording, \
+        install_template_timer
+import news.conf as news_settings
+
+BUDGET_FILE = os.path.join(os.path.dirname(__file__), 'query_budgets.json')
+
+# the user that is logged in for the logged in half
+BENCHMARK_USERNAME = 'benchmark'
+BENCHMARK_PASSWORD = 'benchmark'
+
+# the caches that are turned off while measuring
+CACHE_SETTINGS = ('NEWS_FRONTPAGE_CACHE_SECONDS', 'NEWS_PAGE_CACHE_SECONDS',
+        'NEWS_THREAD_CACHE_SECONDS')
+
+
+def load_budget_file(filename=BUDGET_FILE):
+    """ Return the dataset size, budgets and statuses from filename. """
+    budget_file = open(filename)
+    try:
+        return simplejson.load(budget_file)
+    finally:
+        budget_file.close()
+
+def write_budget_file(dataset, budgets, statuses, filename=BUDGET_FILE):
+    """ Write the dataset size, budgets and statuses to filename. """
+    budget_file = open(filename, 'w')
+    try:
+        simplejson.dump({'dataset': dataset, 'budgets': budgets,
+                'statuses': statuses},
+                budget_file, indent=2, sort_keys=True, 
+                separators=(',', ': '))
+        budget_file.write('\n')
+    finally:
+        budget_file.close()
+
+def seed_benchmark_data(news_items=60, comments=300, users=20, votes=600,
+        seed=0):
+    """
+    Fill the database with made up data from news.synthetic, always the
+    same for the same arguments.  It is all posted in the last month, so
+    most of it is on the frontpage.  One of the made up users becomes 
+    the benchmark user.  Returns a dictionary of the things the urls 
+    need: the benchmark user's profile, the news item with the biggest 
+    thread and the biggest comment thread in it, and a comment by the
+    benchmark user.
+    """
+    dataset = generate_dataset(news_items, comments, users, votes, seed,
+            months=1)
+
+    benchmark_profile = UserProfile.objects.get(
+            id=dataset['userprofile_ids'][0])
+    user = benchmark_profile.user
+    user.username = BENCHMARK_USERNAME
+    user.set_password(BENCHMARK_PASSWORD)
+    user.save()
+    UserProfile.objects.filter(id=benchmark_profile.id).update(
+            comment_points=1000000)
+
+    big_news_item = NewsItem.objects.filter(id__in=dataset['news_item_ids'],
+            dead=False).order_by('-num_comments', 'id')[0]
+    own_comment = Comment.objects.create(poster=benchmark_profile,
+            text='benchmark comment', parent=big_news_item)
+    return {'profile': benchmark_profile,
+            'news_item': big_news_item,
+            'comment': Comment.objects.filter(parent=big_news_item, 
+                dead=False).order_by('-num_comments', 'id')[0],
+            'own_comment': own_comment}
+
+def get_routes(data):
+    """
+    Return (view name, method, path, parameters) for a request to each
+    url in news/urls.py, using the things from seed_benchmark_data().
+    """
+    news_item_path = reverse('news.views.news_items.news_item',
+            args=(data['news_item'].id,))
+    comment_id = data['comment'].id
+    own_comment_id = data['own_comment'].id
+    simple_views = [
+        'news.views.news_items.index',
+        'news.views.news_items.new_news_items',
+        'news.views.news_items.submit',
+        'news.views.comments.new_comments',
+        'news.views.login.login_view',
+        'news.views.login.create_account',
+        'news.views.login.change_password',
+        'news.views.payment.buy_points',
+        'news.views.payment.cancel',
+        'news.views.payment.success',
+        'news.views.text.about',
+        'news.views.text.guidelines',
+        'news.views.text.faq',
+        'news.views.text.bookmarklet',
+        'news.views.text.price',
+    ]
+    routes = [(view_name, 'GET', reverse(view_name), {})
+            for view_name in simple_views]
+    routes += [
+        ('news.views.news_items.news_item', 'GET', news_item_path, {}),
+        ('news.views.comments.comment', 'GET',
+            reverse('news.views.comments.comment', args=(comment_id,)), {}),
+        ('news.views.comments.edit_comment', 'GET',
+            reverse('news.views.comments.edit_comment',
+                args=(own_comment_id,)), {}),
+        ('news.views.rankables.delete_rankable', 'GET',
+            reverse('news.views.rankables.delete_rankable',
+                args=(own_comment_id,)), {}),
+        ('news.views.users.user', 'GET',
+            reverse('news.views.users.user',
+                args=(data['profile'].user.username,)), {}),
+        ('news.views.comments.submit_comment', 'POST',
+            reverse('news.views.comments.submit_comment'),
+            {'parent_id': comment_id, 'comment_text': 'a reply',
+             'next': news_item_path}),
+        ('news.views.voting.vote', 'GET', reverse('news.views.voting.vote'),
+            {'id': comment_id, 'direction': 'up', 'next': news_item_path}),
+        ('news.views.voting.vote_batch', 'POST',
+            reverse('news.views.voting.vote_batch'),
+            {'votes': ['%d:up' % data['news_item'].id,
+                       '%d:up' % comment_id]}),
+        # last, since it logs out
+        ('news.views.login.logout_view', 'GET',
+            reverse('news.views.login.logout_view'), {}),
+    ]
+    return routes
+
+def get_url_view_names():
+    """
+    Return the view names for the urls in news/urls.py.  The urls
+    included from other apps (Paypal's) are left out.
+    """
+    from news import urls
+    return [pattern._callback_str for pattern in urls.urlpatterns
+            if isinstance(pattern, RegexURLPattern)]
+
+def measure_request(client, method, path, params):
+    """
+    Make a request with client and return its status code, number of
+    queries, and milliseconds spent in the database and rendering.
+    """
+    stats = start_recording()
+    try:
+        if method == 'POST':
+            response = client.post(path, params)
+        else:
+            response = client.get(path, params)
+    finally:
+        stop_recording()
+    return {'status': response.status_code,
+            'queries': stats.num_queries,
+            'db_ms': stats.db_time * 1000,
+            'render_ms': stats.render_time * 1000}
+
+def measure_routes(data):
+    """
+    Measure every route from get_routes(), first without logging in and
+    then logged in as the benchmark user.  Returns a list of (name,
+    measurements) where name is the view name followed by "anonymous"
+    or "logged_in".
+    """
+    install_template_timer()
+    old_settings = [(name, getattr(news_settings, name))
+            for name in CACHE_SETTINGS]
+    for name in CACHE_SETTINGS:
+        setattr(news_settings, name, 0)
+
+    results = []
+    try:
+        for logged_in in (False, True):
+            client = Client()
+            for view_name, method, path, params in get_routes(data):
+                if logged_in:
+                    client.login(username=BENCHMARK_USERNAME,
+                            password=BENCHMARK_PASSWORD)
+                    name = view_name + ' logged_in'
+                else:
+                    name = view_name + ' anonymous'
+                results.append((name, measure_request(client, method, path,
+                        params)))
+    finally:
+        for name, value in old_settings:
+            setattr(news_settings, name, value)
+    return results
+
+def find_over_budget(results, budgets, statuses):
+    """
+    Return a message for each result from measure_routes() that ran
+    more queries than its budget, or has no budget at all, and for each
+    one that didn't return the status in statuses.
+    """
+    messages = []
+    for name, measurements in results:
+        if name not in budgets:
+            messages.append('%s has no budget (it ran %d queries)' % (name,
+                    measurements['queries']))
+        elif measurements['queries'] > budgets[name]:
+            messages.append('%s ran %d queries, but its budget is %d' % (
+                    name, measurements['queries'], budgets[name]))
+        if measurements['status'] != statuses.get(name):
+            messages.append('%s returned %d, but it should return %s' % (
+                    name, measurements['status'], statuses.get(name)))
+    return messages
@@ -0,0 +1,387 @@
+"""
+Functions for updating the rankings of lots of rankables at once.
+
+Rankable.update_ranking() loads and saves one rankable at a time.  
+rerank_window() works out the rankings for a whole set of rankables in 
+one go (with numpy, if it is installed) and writes them back with a few 
+big UPDATEs.  rerank_window_sql() does the same thing with a single UPDATE,
+so the rows never have to come back to python at all.
+
+Most of these can also work on just one shard of the rankables, so
+update_ranking.py --workers can split the work between processes.  A
+shard is an (index, count) pair, and it is every rankable whose
+id % count == index.  Going by id like this spreads the new rankables
+(the ones that need re-ranking the most) evenly over the shards.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+
+import datetime, time, heapq
+
+from news.models import Rankable, RerankRequest
+from news.helpers import MAX_IN_CLAUSE_IDS
+import news.conf as news_settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# how many rankings get written back with one executemany()
+RERANK_BATCH_SIZE = 1000
+
+# how many requests drain_rerank_queue() takes from the queue at a time
+RERANK_QUEUE_BATCH_SIZE = 500
+
+# Maps a rankable id to the time (from time.time()) rerank_from_view()
+# last queued it in this process.
+_view_rerank_times = {}
+# how big _view_rerank_times can get before the old times are cleared out
+MAX_VIEW_RERANK_TIMES = 10000
+
+
+def get_shard_where(shard, column='id', model=Rankable):
+    """
+    Return SQL (and its parameters) that is true for the rows of model
+    that are in shard, going by column.  It is safe to use as a where
+    in QuerySet.extra() and with a cursor.
+    """
+    qn = connection.ops.quote_name
+    index, count = shard
+    return "%s.%s %%%% %%s = %%s" % (qn(model._meta.db_table), qn(column)), \
+            [count, index]
+
+def filter_shard(queryset, shard, column='id'):
+    """ Return the part of queryset that is in shard (or all of it). """
+    if shard is None:
+        return queryset
+    where, params = get_shard_where(shard, column, queryset.model)
+    return queryset.extra(where=[where], params=params)
+
+def ranking_for(rating, hours):
+    """
+    Return the ranking for something with the given rating that was
+    posted hours ago.  This is the formula Rankable.calculate_ranking()
+    uses.  rating and hours can also be numpy arrays.
+    """
+    # simpler way
+    return (rating - 1.0) / ((hours + 2.0) ** 1.5)
+    # more compllicated way
+    # return ((rating - 1.0) ** .8) / ((hours + 2.0) ** 1.8)
+
+def calculate_rankings(ratings, hours):
+    """
+    Return a list of the rankings for the lists ratings and hours
+    (the same length), the same as calling ranking_for() on each pair.
+    """
+    if numpy is not None:
+        ratings = numpy.array(ratings, dtype=float)
+        hours = numpy.array(hours, dtype=float)
+        return ranking_for(ratings, hours).tolist()
+    return [ranking_for(rating, hour) for rating, hour in zip(ratings, hours)]
+
+def hours_since(dates, now):
+    """ Return a list of how many hours before now each date in dates is. """
+    hours = []
+    for date in dates:
+        delta = now - date
+        hours.append((delta.days * 24.0) + (delta.seconds / 3600.0))
+    return hours
+
+@transaction.commit_on_success
+def save_rankings(rankings, ranked_date, batch_size=RERANK_BATCH_SIZE):
+    """
+    Write rankings (a list of (rankable id, ranking) pairs) to the
+    database, setting last_ranked_date to ranked_date.  The rows are
+    updated with one executemany() for every batch_size rankables,
+    all in one transaction.
+    """
+    qn = connection.ops.quote_name
+    sql = "UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s" % (
+            qn(Rankable._meta.db_table), qn('ranking'),
+            qn('last_ranked_date'), qn('id'))
+    db_date = connection.ops.value_to_db_datetime(ranked_date)
+
+    cursor = connection.cursor()
+    for i in range(0, len(rankings), batch_size):
+        cursor.executemany(sql, [(ranking, db_date, rankable_id) for
+                rankable_id, ranking in rankings[i:i + batch_size]])
+    # django doesn't know a raw cursor changed anything
+    transaction.set_dirty()
+
+def rerank_window(weeks=4, batch_size=RERANK_BATCH_SIZE, shard=None):
+    """
+    Update the ranking of every rankable posted in the last weeks weeks
+    (the ones that can be on the frontpage) in one pass.  With shard,
+    only the ones in that shard are updated.
+    Returns the number of rankables updated.
+    """
+    now = datetime.datetime.now()
+    return rerank_queryset(filter_shard(Rankable.objects.filter(
+            date_posted__gt=now - datetime.timedelta(weeks=weeks)), shard),
+            now, batch_size)
+
+def rerank_queryset(queryset, now, batch_size=RERANK_BATCH_SIZE):
+    """
+    Update the ranking of every rankable in queryset, working out the
+    rankings in python.  Returns the number of rankables updated.
+    """
+    rows = list(queryset.values_list('id', 'rating', 'date_posted'))
+    if not rows:
+        return 0
+
+    ids, ratings, dates = zip(*rows)
+    rankings = calculate_rankings(ratings, hours_since(dates, now))
+    save_rankings(zip(ids, rankings), now, batch_size)
+    return len(rows)
+
+def get_ranking_sql():
+    """
+    Return SQL that works out ranking_for() for a row of the rankable
+    table.  It takes one parameter, the time to work out the ranking at.
+    Returns None if the database doesn't have the math functions needed.
+    """
+    qn = connection.ops.quote_name
+    engine = settings.DATABASE_ENGINE
+    if engine == 'sqlite3':
+        # sqlite can't do powers, so the formula is done by a python
+        # function (see register_sqlite_functions()).
+        return "news_ranking(%s, (julianday(%%s) - julianday(%s)) * 24.0)" % (
+                qn('rating'), qn('date_posted'))
+    elif engine.startswith('postgresql'):
+        return "(%s - 1.0) / power(extract(epoch from (%%s::timestamp - %s)) " \
+                "/ 3600.0 + 2.0, 1.5)" % (qn('rating'), qn('date_posted'))
+    elif engine == 'mysql':
+        return "(%s - 1.0) / pow(timestampdiff(second, %s, %%s) " \
+                "/ 3600.0 + 2.0, 1.5)" % (qn('rating'), qn('date_posted'))
+    return None
+
+def register_sqlite_functions():
+    """ Make ranking_for() callable from SQL as news_ranking() in sqlite. """
+    connection.connection.create_function('news_ranking', 2, ranking_for)
+
+def rerank_where_sql(where, params, now):
+    """
+    Update the ranking of every rankable matching the SQL where
+    (which uses params) with one UPDATE.  Returns the number of 
+    rankables updated, or None if the database doesn't support this.
+    """
+    ranking_sql = get_ranking_sql()
+    if ranking_sql is None:
+        return None
+
+    qn = connection.ops.quote_name
+    sql = "UPDATE %s SET %s = %s, %s = %%s WHERE %s" % (
+            qn(Rankable._meta.db_table), qn('ranking'), ranking_sql,
+            qn('last_ranked_date'), where)
+    db_now = connection.ops.value_to_db_datetime(now)
+
+    cursor = connection.cursor()
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        register_sqlite_functions()
+    cursor.execute(sql, [db_now, db_now] + list(params))
+    transaction.set_dirty()
+    return cursor.rowcount
+
+@transaction.commit_on_success
+def rerank_window_sql(weeks=4, shard=None):
+    """
+    Update the ranking of every rankable posted in the last weeks weeks
+    (in shard, if it is given) with one UPDATE statement.  Returns the 
+    number of rankables updated.
+
+    If the database doesn't support this, rerank_window() is used instead.
+    """
+    now = datetime.datetime.now()
+    db_start = connection.ops.value_to_db_datetime(
+            now - datetime.timedelta(weeks=weeks))
+    where = "%s > %%s" % connection.ops.quote_name('date_posted')
+    params = [db_start]
+    if shard is not None:
+        shard_where, shard_params = get_shard_where(shard)
+        where += " AND " + shard_where
+        params += shard_params
+    num_rankables = rerank_where_sql(where, params, now)
+    if num_rankables is None:
+        return rerank_window(weeks, shard=shard)
+    return num_rankables
+
+@transaction.commit_on_success
+def rerank_ids(ids):
+    """
+    Update the rankings of the rankables with ids, using their ratings
+    as they are in the database right now.  This uses one UPDATE for 
+    every MAX_IN_CLAUSE_IDS rankables.  Returns the number updated.
+    """
+    ids = list(ids)
+    now = datetime.datetime.now()
+    qn = connection.ops.quote_name
+    num_rankables = 0
+    for i in range(0, len(ids), MAX_IN_CLAUSE_IDS):
+        chunk = ids[i:i + MAX_IN_CLAUSE_IDS]
+        where = "%s IN (%s)" % (qn('id'), ', '.join(['%s'] * len(chunk)))
+        num_updated = rerank_where_sql(where, chunk, now)
+        if num_updated is None:
+            num_updated = rerank_queryset(
+                    Rankable.objects.filter(id__in=chunk), now)
+        num_rankables += num_updated
+    return num_rankables
+
+def queue_rerank(rankable_id):
+    """
+    Ask for the ranking of the rankable with rankable_id to be updated.
+    update_ranking.py will get to it in a moment.
+    """
+    RerankRequest.objects.create(rankable_id=rankable_id)
+
+def queue_reranks(rankable_ids):
+    """ 
+    Ask for the rankings of all the rankables with rankable_ids to be
+    updated.  This inserts all the requests with one executemany().
+    """
+    qn = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s, %s) VALUES (%%s, %%s)" % (
+            qn(RerankRequest._meta.db_table), 
+            qn(RerankRequest._meta.get_field('rankable').column), 
+            qn('date_requested'))
+    db_now = connection.ops.value_to_db_datetime(datetime.datetime.now())
+    connection.cursor().executemany(sql, 
+            [(rankable_id, db_now) for rankable_id in rankable_ids])
+    transaction.set_dirty()
+
+def rerank_from_view(rankable):
+    """
+    Called by views that show rankable.  If NEWS_QUEUE_RERANKS is set,
+    rankable is put in the rerank queue if its ranking is out of date 
+    (and it hasn't been queued by this process lately), so looking at a
+    page doesn't write to the rankable.  Otherwise the ranking is
+    updated right away.
+    """
+    if not news_settings.NEWS_QUEUE_RERANKS:
+        rankable.update_ranking()
+        return
+
+    stale_seconds = news_settings.NEWS_VIEW_RERANK_SECONDS
+    if rankable.last_ranked_date > \
+            datetime.datetime.now() - datetime.timedelta(seconds=stale_seconds):
+        return
+
+    now = time.time()
+    if now - _view_rerank_times.get(rankable.id, 0) < stale_seconds:
+        return
+
+    if len(_view_rerank_times) >= MAX_VIEW_RERANK_TIMES:
+        for rankable_id, queued_time in _view_rerank_times.items():
+            if now - queued_time >= stale_seconds:
+                del _view_rerank_times[rankable_id]
+    _view_rerank_times[rankable.id] = now
+    queue_rerank(rankable.id)
+
+@transaction.commit_on_success
+def drain_rerank_queue_batch(batch_size=RERANK_QUEUE_BATCH_SIZE, shard=None):
+    """
+    Take up to batch_size of the oldest requests off the rerank queue and
+    update the rankings they ask for.  A rankable that is in the batch
+    more than once is only updated once.  With shard, only the requests
+    for rankables in that shard are taken.  Returns the number of
+    requests taken off the queue and a set of the ids of the rankables
+    updated.
+    """
+    queue = filter_shard(RerankRequest.objects.all(), shard,
+            RerankRequest._meta.get_field('rankable').column)
+    requests = list(queue.order_by('id').values_list(
+            'id', 'rankable')[:batch_size])
+    if not requests:
+        return 0, set()
+
+    request_ids = [request_id for request_id, rankable_id in requests]
+    rankable_ids = set([rankable_id for request_id, rankable_id in requests])
+    rerank_ids(rankable_ids)
+    for i in range(0, len(request_ids), MAX_IN_CLAUSE_IDS):
+        RerankRequest.objects.filter(
+                id__in=request_ids[i:i + MAX_IN_CLAUSE_IDS]).delete()
+    return len(requests), rankable_ids
+
+def drain_rerank_queue(batch_size=RERANK_QUEUE_BATCH_SIZE, shard=None):
+    """
+    Update the rankings asked for by everything in the rerank queue (or
+    just the requests for shard), batch_size requests at a time.  
+    Returns the number of requests taken off the queue and a set of the
+    ids of the rankables updated.
+    """
+    num_requests = 0
+    rankable_ids = set()
+    while True:
+        batch_requests, batch_ids = drain_rerank_queue_batch(batch_size,
+                shard)
+        num_requests += batch_requests
+        rankable_ids.update(batch_ids)
+        if batch_requests < batch_size:
+            return num_requests, rankable_ids
+
+
+class RerankScheduler(object):
+    """
+    This decides which rankables to re-rank next, one at a time.
+
+    It keeps a heap of the live rankables posted in the last weeks 
+    weeks, keyed by how far each one's stored ranking has drifted from 
+    what it should be now.  That is biggest for new rankables with lots
+    of votes, since their rankings change the fastest, and it is zero 
+    for rankables no one has voted on, so those are never re-ranked.
+    Rankables that have drifted less than min_drift are left alone too.
+    The heap is rebuilt (with one query) every refresh_seconds seconds,
+    so rankables that have been voted on since get picked up.  With
+    shard, only the rankables in that shard are in the heap.
+    """
+    def __init__(self, weeks=4, refresh_seconds=60, min_drift=0, shard=None):
+        self.weeks = weeks
+        self.refresh_seconds = refresh_seconds
+        self.min_drift = min_drift
+        self.shard = shard
+        self.heap = []
+        self.last_refresh = None
+
+    def refresh(self):
+        """ Rebuild the heap from the database. """
+        now = datetime.datetime.now()
+        rows = filter_shard(Rankable.objects.filter(dead=False,
+                date_posted__gt=now - datetime.timedelta(weeks=self.weeks)),
+                self.shard).values_list('id', 'rating', 'date_posted', 
+                'ranking')
+
+        heap = []
+        if rows:
+            ids, ratings, dates, rankings = zip(*rows)
+            new_rankings = calculate_rankings(ratings, hours_since(dates, now))
+            for rankable_id, ranking, new_ranking in \
+                    zip(ids, rankings, new_rankings):
+                drift = abs(new_ranking - ranking)
+                if drift > self.min_drift:
+                    heap.append((-drift, rankable_id))
+        heapq.heapify(heap)
+
+        self.heap = heap
+        self.last_refresh = time.time()
+
+    def next_id(self):
+        """
+        Return the id of the rankable that most needs re-ranking,
+        or None if none of them do right now.
+        """
+        if self.last_refresh is None or \
+                time.time() - self.last_refresh >= self.refresh_seconds:
+            self.refresh()
+        if not self.heap:
+            return None
+        return heapq.heappop(self.heap)[1]
+
+    def rerank_next(self):
+        """
+        Re-rank the rankable that most needs it.  Returns its id, or None
+        if none of them need it right now.
+        """
+        rankable_id = self.next_id()
+        if rankable_id is not None:
+            rerank_ids([rankable_id])
+        return rankable_id
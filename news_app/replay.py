@@ -0,0 +1,430 @@
+"""
+Replaying traffic against a running server, for capacity testing.
+
+A replay is a list of requests, each one a Request.  They either come
+from an access log (parse_access_log()), or are made up from what is in
+the database (build_request_mix()) with about the mix of pages real
+people ask for: mostly the frontpage and threads, some /new and
+/new_comments, and some votes and comments.
+
+run_replay() sends them to a server with a number of worker threads.
+Every worker has two sessions, one that never logs in, and one that
+logs in through /login/ the same way a browser does.  Requests that
+need a user (voting, posting comments) go through the logged in one,
+everything else through the anonymous one, so the page caches for
+anonymous users get used like they would be.  Redirects aren't
+followed, so each request is timed on its own.
+
+Report.format() prints the throughput and latency percentiles for each
+route.  news/scripts/replay_load.py is the command line tool for this.
+"""
+from django.core.urlresolvers import reverse, resolve, Resolver404
+
+import cookielib, math, random, re, socket, threading, time, urllib, urllib2, \
+        urlparse
+
+from django.contrib.auth.models import User
+from news.models import UserProfile, NewsItem, Comment
+from news.synthetic import WeightedChooser
+
+# how often each kind of request happens in a made up mix
+DEFAULT_MIX = (
+    ('news.views.news_items.index', 30),
+    ('news.views.news_items.news_item', 25),
+    ('news.views.news_items.new_news_items', 10),
+    ('news.views.comments.comment', 8),
+    ('news.views.comments.new_comments', 5),
+    ('news.views.users.user', 5),
+    ('news.views.voting.vote', 10),
+    ('news.views.voting.vote_batch', 2),
+    ('news.views.comments.submit_comment', 5),
+)
+
+# the views that only do something for a logged in user
+LOGGED_IN_VIEWS = (
+    'news.views.news_items.submit',
+    'news.views.comments.submit_comment',
+    'news.views.comments.edit_comment',
+    'news.views.rankables.delete_rankable',
+    'news.views.login.change_password',
+    'news.views.voting.vote',
+    'news.views.voting.vote_batch',
+)
+
+# the workers log in and out themselves, so these are left out of a
+# replayed access log
+SKIPPED_VIEWS = (
+    'news.views.login.login_view',
+    'news.views.login.logout_view',
+    'news.views.login.create_account',
+)
+
+# how many of the newest news items and comments a made up mix uses
+RECENT_LIMIT = 500
+
+# the accounts the workers log in as
+ACCOUNT_USERNAME = 'replay_%d'
+ACCOUNT_PASSWORD = 'replay'
+ACCOUNT_COMMENT_POINTS = 1000000
+
+# "1.2.3.4 - - [20/Jul/2009:10:00:00 -0700] "GET /new HTTP/1.1" 200 ..."
+ACCESS_LOG_RE = re.compile(r'^\S+ \S+ \S+ \[[^\]]*\] "(\w+) (\S+)[^"]*"')
+
+# the route for things that aren't in news/urls.py
+UNKNOWN_ROUTE = 'unknown'
+
+
+class Request(object):
+    """ One request to replay. """
+
+    def __init__(self, route, method, path, params=None, logged_in=False):
+        self.route = route
+        self.method = method
+        self.path = path
+        self.params = params or {}
+        self.logged_in = logged_in
+
+    def __repr__(self):
+        return '<Request %s %s>' % (self.method, self.path)
+
+
+class NoRedirectHandler(urllib2.HTTPRedirectHandler):
+    """ Lets the redirect come back as the response instead of following it. """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def get_route(path):
+    """
+    Return the name of the view that path goes to, or UNKNOWN_ROUTE.
+    """
+    try:
+        view_func = resolve(urlparse.urlsplit(path)[2])[0]
+    except Resolver404:
+        return UNKNOWN_ROUTE
+    return '%s.%s' % (view_func.__module__, view_func.__name__)
+
+def parse_access_log(lines):
+    """
+    Return a Request for each GET in lines, which are in the common (or
+    combined) log format that Apache and nginx write.  POSTs are left
+    out, since the log doesn't have what was posted, and so are logging
+    in and out.  Returns the requests and how many lines were skipped.
+    """
+    requests = []
+    num_skipped = 0
+    for line in lines:
+        match = ACCESS_LOG_RE.match(line)
+        if not match or match.group(1) != 'GET':
+            num_skipped += 1
+            continue
+        # some servers log the whole url
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(
+                match.group(2))
+        if query:
+            path += '?' + query
+        route = get_route(path)
+        if route in SKIPPED_VIEWS:
+            num_skipped += 1
+            continue
+        requests.append(Request(route, 'GET', path,
+                logged_in=route in LOGGED_IN_VIEWS))
+    return requests, num_skipped
+
+def build_request_mix(count, mix=DEFAULT_MIX, seed=0):
+    """
+    Make up count requests from what is in the database, picking the
+    kind of each one with the weights in mix.  The newest news items and
+    comments get most of the traffic, like on a real site.  The same seed
+    makes the same requests for the same database.
+    """
+    rand = random.Random(seed)
+    news_item_ids = list(NewsItem.objects.filter(dead=False).order_by(
+            '-id').values_list('id', flat=True)[:RECENT_LIMIT])
+    comment_ids = list(Comment.objects.filter(dead=False).order_by(
+            '-id').values_list('id', flat=True)[:RECENT_LIMIT])
+    usernames = list(UserProfile.objects.order_by('-id').values_list(
+            'user__username', flat=True)[:RECENT_LIMIT])
+
+    def popular(things):
+        """ A chooser that likes the things at the start of the list. """
+        return WeightedChooser(things, [1.0 / (i + 1)
+                for i in range(len(things))], rand)
+    news_items = news_item_ids and popular(news_item_ids)
+    comments = comment_ids and popular(comment_ids)
+    users = usernames and popular(usernames)
+    frontpage = reverse('news.views.news_items.index')
+
+    # there is nothing to link to the kinds that need something that
+    # isn't in the database
+    needs = {'news.views.news_items.news_item': news_items,
+             'news.views.comments.comment': comments,
+             'news.views.users.user': users,
+             'news.views.voting.vote': news_items and comments,
+             'news.views.voting.vote_batch': news_items and comments,
+             'news.views.comments.submit_comment': news_items and comments}
+    mix = [(route, weight) for route, weight in mix
+            if needs.get(route, True)]
+    routes = WeightedChooser([route for route, weight in mix],
+            [weight for route, weight in mix], rand)
+
+    requests = []
+    for i in range(count):
+        route = routes.choose()
+        method = 'GET'
+        params = {}
+        if route == 'news.views.news_items.news_item':
+            path = reverse(route, args=(news_items.choose(),))
+        elif route == 'news.views.comments.comment':
+            path = reverse(route, args=(comments.choose(),))
+        elif route == 'news.views.users.user':
+            path = reverse(route, args=(users.choose(),))
+        elif route == 'news.views.voting.vote':
+            path = reverse(route)
+            params = {'id': rand.choice((news_items, comments)).choose(),
+                      'direction': 'up', 'next': frontpage}
+        elif route == 'news.views.voting.vote_batch':
+            method = 'POST'
+            path = reverse(route)
+            params = {'votes': ['%d:up' % news_items.choose(),
+                                '%d:up' % comments.choose()]}
+        elif route == 'news.views.comments.submit_comment':
+            method = 'POST'
+            path = reverse(route)
+            params = {'parent_id': rand.choice((news_items,
+                                                comments)).choose(),
+                      'comment_text': 'replayed comment %d' % i}
+        else:
+            path = reverse(route)
+        requests.append(Request(route, method, path, params,
+                logged_in=route in LOGGED_IN_VIEWS))
+    return requests
+
+def percentile(sorted_values, percent):
+    """
+    Return the value that percent percent of sorted_values are at or
+    below (the nearest rank), or None if there aren't any.
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(0, min(rank, len(sorted_values)) - 1)]
+
+
+class Report(object):
+    """ The latency and status of every request in a replay. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+        self.elapsed = 0.0
+
+    def record(self, route, status, latency):
+        """
+        Record a request to route that came back with status (None if it
+        didn't come back at all) after latency seconds.
+        """
+        self.lock.acquire()
+        try:
+            self.latencies.setdefault(route, []).append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if status is None or status >= 400:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        finally:
+            self.lock.release()
+
+    def get_route_stats(self):
+        """
+        Return (route, stats) for every route, most requests first.
+        stats is a dictionary of the number of requests and errors,
+        requests per second, and the 50th, 90th and 99th percentile and
+        the most milliseconds a request took.
+        """
+        stats = []
+        for route, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            stats.append((route, {
+                'requests': len(latencies),
+                'errors': self.errors.get(route, 0),
+                'per_second': self.elapsed and len(latencies) / self.elapsed,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p90_ms': percentile(latencies, 90) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000}))
+        stats.sort(key=lambda (route, route_stats):
+                (-route_stats['requests'], route))
+        return stats
+
+    def format(self):
+        """ Return the report as a table. """
+        lines = ['%-40s %7s %6s %7s %8s %8s %8s %8s' % ('route', 'count',
+                'errors', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+        total = 0
+        for route, stats in self.get_route_stats():
+            total += stats['requests']
+            lines.append('%-40s %7d %6d %7.1f %8.1f %8.1f %8.1f %8.1f' % (
+                    route.replace('news.views.', ''), stats['requests'],
+                    stats['errors'], stats['per_second'], stats['p50_ms'],
+                    stats['p90_ms'], stats['p99_ms'], stats['max_ms']))
+        lines.append('')
+        lines.append('%d requests in %.1f seconds (%.1f per second)' % (
+                total, self.elapsed, self.elapsed and total / self.elapsed))
+        lines.append('statuses: ' + ', '.join(['%s: %d' % (status, count)
+                for status, count in sorted(self.statuses.items())]))
+        return '\n'.join(lines)
+
+
+class ReplayWorker(threading.Thread):
+    """
+    Sends requests from a shared list until it is empty.  username and
+    password are the account the logged in session uses; without them
+    the requests that need a user are sent without logging in.
+    """
+
+    def __init__(self, base_url, requests, requests_lock, report,
+            username=None, password=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.base_url = base_url.rstrip('/')
+        self.requests = requests
+        self.requests_lock = requests_lock
+        self.report = report
+        self.username = username
+        self.password = password
+        self.anonymous = self.make_opener()
+        self.logged_in = None
+
+    def make_opener(self):
+        """ Return an opener with its own cookies (so its own session). """
+        return urllib2.build_opener(NoRedirectHandler(),
+                urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+
+    def send(self, opener, method, path, params):
+        """
+        Send a request and return its status and the response headers,
+        or None and the error if it didn't come back.
+        """
+        url = self.base_url + path
+        data = urllib.urlencode(params, doseq=True)
+        if method == 'POST':
+            request = urllib2.Request(url, data)
+        else:
+            request = urllib2.Request(data and url + '?' + data or url)
+        try:
+            response = opener.open(request)
+        except urllib2.HTTPError, response:
+            # this is any status that isn't 200, redirects included
+            pass
+        except (urllib2.URLError, IOError), e:
+            return None, e
+        try:
+            response.read()
+        finally:
+            response.close()
+        return response.code, response.info()
+
+    def log_in(self):
+        """
+        Log in like a browser does with views/login.py: get the login
+        page, then post the username and password to it.  Returns the
+        opener with the logged in session, or the anonymous one if
+        logging in didn't work.
+        """
+        opener = self.make_opener()
+        login_path = reverse('news.views.login.login_view')
+        start = time.time()
+        status, headers = self.send(opener, 'GET', login_path, {})
+        self.report.record('login', status, time.time() - start)
+
+        start = time.time()
+        status, headers = self.send(opener, 'POST', login_path,
+                {'username': self.username, 'password': self.password,
+                 'next': reverse('news.views.news_items.index')})
+        self.report.record('login', status, time.time() - start)
+        # a failed login is sent back to the login page
+        if status != 302 or login_path in headers.get('Location', ''):
+            self.report.record('login failed', None, 0.0)
+            return self.anonymous
+        return opener
+
+    def next_request(self):
+        """ Return the next request to send, or None if there aren't any. """
+        self.requests_lock.acquire()
+        try:
+            if not self.requests:
+                return None
+            return self.requests.pop()
+        finally:
+            self.requests_lock.release()
+
+    def run(self):
+        while True:
+            request = self.next_request()
+            if request is None:
+                break
+            opener = self.anonymous
+            if request.logged_in and self.username:
+                if self.logged_in is None:
+                    self.logged_in = self.log_in()
+                opener = self.logged_in
+            start = time.time()
+            status, headers = self.send(opener, request.method, request.path,
+                    request.params)
+            self.report.record(request.route, status, time.time() - start)
+
+
+def get_accounts(count):
+    """
+    Return (username, password) for count accounts for the workers to
+    log in as, creating the ones that don't exist yet.  They have plenty
+    of comment points, so they never run out while voting.
+    """
+    accounts = []
+    for i in range(count):
+        username = ACCOUNT_USERNAME % i
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            user = User.objects.create_user(username, '', ACCOUNT_PASSWORD)
+        else:
+            user.set_password(ACCOUNT_PASSWORD)
+            user.save()
+        profile, created = UserProfile.objects.get_or_create(user=user)
+        UserProfile.objects.filter(id=profile.id).update(
+                comment_points=ACCOUNT_COMMENT_POINTS)
+        accounts.append((username, ACCOUNT_PASSWORD))
+    return accounts
+
+def run_replay(base_url, requests, workers=10, accounts=(), timeout=30):
+    """
+    Send requests to the server at base_url (like
+    "http://localhost:8000") with workers threads, in order.  accounts is
+    a list of (username, password) for the workers to log in as, shared
+    out between them.  A request that takes longer than timeout seconds
+    counts as an error.  Returns a Report.
+    """
+    # urllib2 can't be given a timeout for each request on older pythons
+    socket.setdefaulttimeout(timeout)
+    report = Report()
+    # the workers pop from the end
+    remaining = list(requests)
+    remaining.reverse()
+    requests_lock = threading.Lock()
+    worker_threads = []
+    for i in range(workers):
+        username = password = None
+        if accounts:
+            username, password = accounts[i % len(accounts)]
+        worker_threads.append(ReplayWorker(base_url, remaining,
+                requests_lock, report, username, password))
+
+    start = time.time()
+    for worker in worker_threads:
+        worker.start()
+    for worker in worker_threads:
+        worker.join()
+    report.elapsed = time.time() - start
+    return report
@@ -0,0 +1,198 @@
+"""
+Helpers for updating the layout of a database that already exists.
+
+`manage.py syncdb` only creates tables that aren't there yet.  When a field
+or an index gets added to one of the models, databases that were created
+before that need the new column or index added by hand.  The scripts in
+news/scripts/ use these functions to do that, so they can be run on any
+database (new or old) without breaking anything.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from django.core.management.color import no_style
+
+
+def get_column_names(model):
+    """ Return the names of the columns in model's table. """
+    cursor = connection.cursor()
+    description = connection.introspection.get_table_description(cursor,
+            model._meta.db_table)
+    return [row[0] for row in description]
+
+def sql_literal(value):
+    """
+    Return value as something that can be put right into an SQL statement.
+    This is only used for column defaults, which can't be passed as
+    parameters.
+    """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        if settings.DATABASE_ENGINE.startswith('postgresql'):
+            return value and 'true' or 'false'
+        return value and '1' or '0'
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    return "'%s'" % unicode(value).replace("'", "''")
+
+def add_column(model, field_name):
+    """
+    Add the column for field_name to model's table if it isn't there,
+    along with its index if it has one.  Returns True if the column
+    was added.
+    """
+    field = model._meta.get_field(field_name)
+    if field.column in get_column_names(model):
+        return False
+
+    qn = connection.ops.quote_name
+    sql = 'ALTER TABLE %s ADD COLUMN %s %s' % (qn(model._meta.db_table),
+            qn(field.column), field.db_type())
+    if field.null:
+        sql += ' NULL'
+    else:
+        sql += ' NOT NULL DEFAULT %s' % sql_literal(field.get_default())
+
+    cursor = connection.cursor()
+    cursor.execute(sql)
+    for index_sql in connection.creation.sql_indexes_for_field(model, field,
+            no_style()):
+        cursor.execute(index_sql)
+    transaction.commit_unless_managed()
+    return True
+
+def add_index(model, field_names, unique=False):
+    """
+    Create an index on the columns for field_names in model's table,
+    if there isn't already an index with the same name.  Returns True if
+    the index was created.
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    columns = [model._meta.get_field(name).column for name in field_names]
+    index_name = '%s_%s' % (table, '_'.join(columns))
+    if unique:
+        index_name += '_uniq'
+    # Most databases don't allow index names longer than this.
+    index_name = index_name[:connection.ops.max_name_length() or 63]
+
+    sql = 'CREATE %sINDEX %s ON %s (%s)' % (unique and 'UNIQUE ' or '',
+            qn(index_name), qn(table), ', '.join([qn(c) for c in columns]))
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql)
+    except Exception:
+        # the index is (probably) already there
+        transaction.rollback_unless_managed()
+        return False
+    transaction.commit_unless_managed()
+    return True
+
+def add_field_indexes(model):
+    """
+    Create the indexes for model's fields that have db_index set, if the
+    columns aren't indexed already.  Columns that haven't been added yet
+    are skipped.  Returns the number created.
+    """
+    cursor = connection.cursor()
+    indexed = connection.introspection.get_indexes(cursor, 
+            model._meta.db_table)
+    columns = get_column_names(model)
+    num_created = 0
+    for field in model._meta.local_fields:
+        if field.column in indexed or field.column not in columns:
+            continue
+        for index_sql in connection.creation.sql_indexes_for_field(model, 
+                field, no_style()):
+            cursor.execute(index_sql)
+            num_created += 1
+    transaction.commit_unless_managed()
+    return num_created
+
+
+# Checking that the queries the site runs all the time can use an index.
+
+def get_hot_queries():
+    """
+    Return (name, queryset) for each of the queries that run on nearly 
+    every request or in update_ranking.py's loop.  The querysets use 
+    made up ids and dates; only their query plans matter.
+    """
+    from django.db.models import Q
+    from news.models import Rankable, NewsItem, Comment, Rated, \
+            FrontpageEntry
+    from news.helpers import get_frontpage_querymanager, datetime_ago, \
+            hash_url
+
+    return [
+        ('frontpage', get_frontpage_querymanager(show_dead=False)[:16]),
+        ('frontpage with dead', get_frontpage_querymanager(show_dead=True)[:16]),
+        ('frontpage for the cache', get_frontpage_querymanager(
+                show_dead=False).values_list('ranking', 'date_posted', 'id')),
+        ('frontpage snapshot page', FrontpageEntry.objects.filter(
+                snapshot=1, show_dead=False, position__gte=15, 
+                position__lt=30).order_by('position')),
+        ('new news items', Rankable.objects.filter(kind='news_item', 
+                dead=False).order_by('-date_posted', '-id')[:16]),
+        ('new comments', Rankable.objects.filter(kind='comment', 
+                dead=False).order_by('-date_posted', '-id')[:16]),
+        ('new comments after a token', Rankable.objects.filter(
+                Q(date_posted__lt=datetime_ago(hours=1)) | 
+                Q(date_posted=datetime_ago(hours=1), id__lt=100), 
+                kind='comment', dead=False).order_by('-date_posted', 
+                '-id')[:16]),
+        ('thread', Comment.objects.filter(news_item=1)),
+        ('thread by path', Comment.objects.filter(news_item=1).order_by(
+                'thread_path')),
+        ('rerank window', Rankable.objects.filter(dead=False, 
+                date_posted__gt=datetime_ago(weeks=4)).values_list('id', 
+                'rating', 'date_posted')),
+        ('submitted url', NewsItem.objects.filter(
+                url_hash=hash_url('http://example.com'))[:1]),
+        ('already voted', Rated.objects.filter(rankable=1, userprofile=1)),
+        ('voted ids', Rated.objects.filter(userprofile=1, 
+                rankable__in=[1, 2, 3]).values_list('rankable', flat=True)),
+        ('user\'s rankables', Rankable.objects.filter(poster=1).order_by(
+                '-date_posted')[:16]),
+    ]
+
+def explain(queryset):
+    """ Return the database's query plan for queryset, as a list of lines. """
+    sql, params = queryset.query.as_sql()
+    cursor = connection.cursor()
+    engine = settings.DATABASE_ENGINE
+    if engine == 'sqlite3':
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        # the last column is the description, like "SCAN TABLE news_rated"
+        return [row[-1] for row in cursor.fetchall()]
+    elif engine.startswith('postgresql'):
+        # postgres picks a sequential scan for small tables even if there 
+        # is an index, so tell it not to unless there's no other way
+        cursor.execute('SET enable_seqscan = off')
+        try:
+            cursor.execute('EXPLAIN ' + sql, params)
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.execute('SET enable_seqscan = on')
+    elif engine == 'mysql':
+        cursor.execute('EXPLAIN ' + sql, params)
+        columns = [column[0] for column in cursor.description]
+        return [' '.join(['%s=%s' % (column, value) for column, value in
+                zip(columns, row)]) for row in cursor.fetchall()]
+    return []
+
+def find_full_scans(queryset):
+    """
+    Return the lines of queryset's query plan where a whole table is read
+    without an index.  Scanning an index in order (for an ORDER BY with a 
+    LIMIT) is fine.  This only knows sqlite, postgres and MySQL; on 
+    anything else it returns [].
+    """
+    full_scans = []
+    for line in explain(queryset):
+        if line.startswith('SCAN') and 'USING' not in line:
+            full_scans.append(line)
+        elif 'Seq Scan' in line or 'type=ALL ' in line + ' ':
+            full_scans.append(line)
+    return full_scans
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+"""
+This compares the different ways of getting a threaded list of comments:
+
+  recursive  the old get_child_comments(), which does a query for every
+             comment (copied below so it can still be timed)
+  in-memory  get_child_comments() putting the tree together in memory
+  path       get_child_comments() reading the thread in order using
+             Comment.thread_path (NEWS_USE_COMMENT_PATHS)
+
+For each size it creates a news item with that many comments in a random
+tree, times each way of reading it, and then deletes the thread again.
+It could be run like this:
+$ ./benchmark_comment_tree.py --sizes=100,1000,10000
+
+WARNING, DO NOT RUN THIS ON A PRODUCTION DATABASE!
+"""
+
+import sys, random, time
+import base
+
+usage_explanation =["Time the different ways of reading a comment thread."]
+usage_commands = ["-r, --repeat=N\t\t\ttime each way N times (default 3)",
+                  "-s, --sizes=N,N,...\t\tthread sizes (default 100,1000,10000)"]
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  It then processes the additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    sizes = [100, 1000, 10000]
+    repeat = 3
+
+    opts = base.get_paths_options("r:s:", ["repeat=", "sizes="], usage)
+
+    for opt, arg in opts:
+        if opt in ("--repeat", "-r"):
+            repeat = base.get_int_arg(arg,
+                    "ERROR! Argument to --repeat must be a positive integer.",
+                    usage, must_be_pos=True)
+        elif opt in ("--sizes", "-s"):
+            sizes = [base.get_int_arg(size,
+                    "ERROR! Argument to --sizes must be positive integers.",
+                    usage, must_be_pos=True) for size in arg.split(',')]
+
+    return {'sizes': sizes, 'repeat': repeat}
+
+
+def recursive_get_child_comments(comment_set, depth=0, return_dead=True):
+    """
+    This is what news.helpers.get_child_comments() used to be.
+    It is only here so it can be compared with the new one.
+    """
+    comments = []
+
+    for com in sorted(comment_set.all().order_by('-date_posted'), key=lambda cm: -cm.ranking):
+
+        if return_dead or not com.dead:
+            comments.append({'comment': com, 'depth': depth})
+
+        if com.child_set.count():
+            comments.extend(recursive_get_child_comments(com.child_set, depth+1, return_dead))
+
+    return comments
+
+
+def benchmark_comment_tree(sizes=[100, 1000, 10000], repeat=3):
+    """ Create a thread of each size and time reading it each way. """
+    from news.models import UserProfile, NewsItem, Comment
+    from news.helpers import get_child_comments, update_thread_paths
+    import news.conf as news_settings
+    from django.conf import settings
+    from django import db
+
+    # queries are only counted when DEBUG is on
+    settings.DEBUG = True
+
+    poster = UserProfile.objects.all()[0]
+
+    def time_it(func):
+        """
+        Run func repeat times.  Returns the best time, the number of
+        queries the last run took, and what it returned.
+        """
+        best = None
+        for i in range(repeat):
+            db.reset_queries()
+            start = time.time()
+            result = func()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best, len(db.connection.queries), result
+
+    print "%8s  %-10s %10s %10s" % ("comments", "method", "seconds", "queries")
+
+    for size in sizes:
+        news_item = NewsItem.objects.create(poster=poster,
+                title="benchmark_comment_tree", url="http://example.com")
+        try:
+            # build a random tree of comments
+            com_ids = [news_item.id]
+            for i in range(size):
+                com = Comment.objects.create(poster=poster, text=str(i),
+                        parent_id=random.choice(com_ids), news_item=news_item,
+                        ranking=random.random())
+                com_ids.append(com.id)
+
+            update_thread_paths(news_item.id)
+
+            news_settings.NEWS_USE_COMMENT_PATHS = False
+            recursive = time_it(
+                    lambda: recursive_get_child_comments(news_item.child_set))
+            in_memory = time_it(lambda: get_child_comments(news_item))
+            news_settings.NEWS_USE_COMMENT_PATHS = True
+            path = time_it(lambda: get_child_comments(news_item))
+
+            for name, (seconds, queries, result) in (('recursive', recursive),
+                    ('in-memory', in_memory), ('path', path)):
+                print "%8d  %-10s %10.4f %10d" % (size, name, seconds, queries)
+
+            # make sure every way gives back the same thread
+            expected = [(d['comment'].id, d['depth']) for d in recursive[2]]
+            for name, result in (('in-memory', in_memory[2]),
+                                 ('path', path[2])):
+                if [(d['comment'].id, d['depth']) for d in result] != expected:
+                    print >>sys.stderr, "Warning! The " + name + \
+                            " thread is different from the recursive one."
+        finally:
+            Comment.objects.filter(news_item=news_item).delete()
+            news_item.delete()
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, benchmark_comment_tree, usage)
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+"""
+This compares the different ways update_ranking.py can update the rankings
+of everything that could be on the frontpage:
+
+  per-object  call Rankable.update_ranking() on each rankable
+  vectorized  news.ranking.rerank_window()
+  sql         news.ranking.rerank_window_sql()
+
+For each size it creates that many news items posted in the last four
+weeks with random ratings, times each way of re-ranking them, and then
+deletes them again.  It could be run like this:
+$ ./benchmark_ranking.py --sizes=1000,10000
+
+The rankables already in the database are re-ranked too, so the numbers
+are a little off on a database that has other recent rankables in it.
+
+WARNING, DO NOT RUN THIS ON A PRODUCTION DATABASE!
+"""
+
+import sys, random, time
+import base
+
+usage_explanation =["Time the different ways of updating the rankings."]
+usage_commands = ["-s, --sizes=N,N,...\t\tnumber of news items (default 1000,10000)"]
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  It then processes the additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    sizes = [1000, 10000]
+
+    opts = base.get_paths_options("s:", ["sizes="], usage)
+
+    for opt, arg in opts:
+        if opt in ("--sizes", "-s"):
+            sizes = [base.get_int_arg(size,
+                    "ERROR! Argument to --sizes must be positive integers.",
+                    usage, must_be_pos=True) for size in arg.split(',')]
+
+    return {'sizes': sizes}
+
+
+def benchmark_ranking(sizes=[1000, 10000]):
+    """ Create news items and time re-ranking them each way. """
+    from news.models import UserProfile, NewsItem, Rankable
+    from news.helpers import datetime_ago
+    from news.ranking import rerank_window, rerank_window_sql, ranking_for, \
+            hours_since
+    from django.db import transaction
+
+    poster = UserProfile.objects.all()[0]
+
+    def per_object(weeks=4):
+        """ Update the rankings one at a time like update_ranking.py does. """
+        rankables = Rankable.objects.filter(
+                date_posted__gt=datetime_ago(weeks=weeks))
+        num_rankables = 0
+        for rankable in rankables:
+            rankable.update_ranking()
+            num_rankables += 1
+        return num_rankables
+
+    def rankings_are_right(ids):
+        """
+        Check that the rankables with ids have the ranking they should
+        have had when they were last ranked.
+        """
+        for rating, date_posted, ranking, ranked_date in \
+                Rankable.objects.filter(id__in=ids).values_list('rating',
+                        'date_posted', 'ranking', 'last_ranked_date'):
+            right = ranking_for(rating, hours_since([date_posted], 
+                    ranked_date)[0])
+            # The python rankings ignore fractions of a second and the sql
+            # ones don't, so they can be a little different.
+            if abs(ranking - right) > 0.001 * max(abs(right), 1):
+                return False
+        return True
+
+    print "%8s  %-10s %10s %12s" % ("items", "mode", "seconds", "rows/s")
+
+    for size in sizes:
+        item_ids = []
+
+        def create_news_items():
+            for i in range(size):
+                item = NewsItem.objects.create(poster=poster,
+                        title="benchmark_ranking", url="http://example.com",
+                        rating=random.randint(1, 100),
+                        date_posted=datetime_ago(hours=random.uniform(0, 670)))
+                item_ids.append(item.id)
+        transaction.commit_on_success(create_news_items)()
+
+        try:
+            for name, rerank in (('per-object', per_object),
+                    ('vectorized', rerank_window), ('sql', rerank_window_sql)):
+                start = time.time()
+                num_rankables = rerank(weeks=4)
+                elapsed = time.time() - start
+                print "%8d  %-10s %10.4f %12.0f" % (size, name, elapsed,
+                        num_rankables / max(elapsed, 0.000001))
+                if not rankings_are_right(item_ids[:100]):
+                    print >>sys.stderr, "Warning! The " + name + \
+                            " rankings are wrong."
+        finally:
+            for i in range(0, len(item_ids), 500):
+                NewsItem.objects.filter(id__in=item_ids[i:i + 500]).delete()
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, benchmark_ranking, usage)
@@ -21,6 +21,13 @@ anything existing in the database.  (Although, all the variables still
 get initialized like they did the first time the script is run, so it
 is still good for debugging even after being run the first time.)
 
+For capacity testing, --synthetic=N writes N more news items, with
+ten comments and twenty votes for each one and a user for every ten,
+using the bulk generator in news/synthetic.py.  It is a lot faster than
+--extra-news and --extra-comments, and it makes the same data every
+time for the same --seed.  It could be run like this:
+$ ./init_db_vals.py --synthetic=100000 --seed=1
+
 WARNING, DO NOT RUN THIS ON A PRODUCTION DATABASE!
 """
 
@@ -32,7 +39,10 @@ usage_explanation =["Initialize the database with default values.",
                     "By default, nothing is created."]
 usage_commands = ["-c, --extra-comments=N\t\tcreate N extra comments",
                   "-e, --extra-news=N\t\tcreate N extra news items",
-                  "-X, --create-new\t\tcreate new items that don't exist"]
+                  "-X, --create-new\t\tcreate new items that don't exist",
+                  "-S, --synthetic=N\t\tbulk create N made up news items with",
+                  "\t\t\t\tcomments, votes and users",
+                  "-r, --seed=N\t\t\tseed for --synthetic (default 0)"]
 
 # Here are our global variables that we want available when 
 # running from ipython.
@@ -80,9 +90,11 @@ def setup_path_and_args():
     extra_news_items = 0
     extra_comments = 0
     create_new_objects = False
+    synthetic_news_items = 0
+    seed = 0
 
-    opts = base.get_paths_options("e:c:X", ["extra-news=", "extra-comments=", "create-new"], 
-            usage)
+    opts = base.get_paths_options("e:c:XS:r:", ["extra-news=", "extra-comments=", 
+            "create-new", "synthetic=", "seed="], usage)
 
     for opt, arg in opts:
         if opt in ("--extra-news", "-e"):
@@ -95,16 +107,27 @@ def setup_path_and_args():
                     usage)
         elif opt in ("--create-new", "-X"):
             create_new_objects = True
+        elif opt in ("--synthetic", "-S"):
+            synthetic_news_items = base.get_int_arg(arg,
+                    "ERROR! Argument to --synthetic must be a non-negative integer.",
+                    usage)
+        elif opt in ("--seed", "-r"):
+            seed = base.get_int_arg(arg,
+                    "ERROR! Argument to --seed must be a non-negative integer.",
+                    usage)
 
     return {'extra_news_items':extra_news_items, 'extra_comments':extra_comments,
-            'create_new_objects': create_new_objects}
+            'create_new_objects': create_new_objects, 
+            'synthetic_news_items': synthetic_news_items, 'seed': seed}
 
 
-def init_db(extra_news_items=0, extra_comments=0, create_new_objects=False):
+def init_db(extra_news_items=0, extra_comments=0, create_new_objects=False,
+        synthetic_news_items=0, seed=0):
     """
     Add initial data to the database if it is not already in it.
     Just get variables that point to the initial data if it has already been
-    created.
+    created.  If synthetic_news_items is given, that many made up news
+    items (and their comments, votes and users) are added too.
     """
 
     # Here are our global values that we want available when 
@@ -286,6 +309,17 @@ def init_db(extra_news_items=0, extra_comments=0, create_new_objects=False):
     com8 = create_comment(ice_userprofile, 'this is com8', com2,
             create_new_objects)
 
+    if synthetic_news_items:
+        from news.synthetic import generate_dataset
+        import time
+        start = time.time()
+        dataset = generate_dataset(synthetic_news_items, seed=seed, 
+                verbose=True)
+        print "Made %d users, %d news items, %d comments and %d votes " \
+                "in %.1f seconds" % (len(dataset['userprofile_ids']),
+                len(dataset['news_item_ids']), len(dataset['comment_ids']),
+                dataset['num_votes'], time.time() - start)
+
     # make a client available to use
     client = Client()
 
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+"""
+This is used to bring a database created before Comment.news_item existed
+up to date.  It adds the column (and its index) to the comment table if it
+is not there, and then fills in the news item for every comment that
+doesn't have one yet.  It could be run like this:
+$ ./migrate_comment_news_item.py
+
+It is safe to run this more than once.  Comments that already have their
+news item set are not touched.
+"""
+
+import sys
+import base
+
+usage_explanation =["Add Comment.news_item to an existing database",
+                    "and fill it in for every comment."]
+usage_commands = []
+
+# how many comments get updated with one query
+UPDATE_CHUNK_SIZE = 500
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  There are no additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    base.get_paths_options("", [], usage)
+    return {}
+
+
+def migrate_comment_news_item():
+    """ Add the news_item column and fill it in for all comments. """
+    from news.models import NewsItem, Comment
+    from news.schema import add_column
+
+    if add_column(Comment, 'news_item'):
+        print "Added the news_item column to " + Comment._meta.db_table
+
+    # Load the whole parent structure once and walk it in memory, instead
+    # of walking up the parents with a query for every level.
+    news_item_ids = set(NewsItem.objects.values_list('id', flat=True))
+    parents = dict(Comment.objects.values_list('id', 'parent'))
+    missing_ids = Comment.objects.filter(news_item__isnull=True).values_list(
+            'id', flat=True)
+
+    # maps a news item id to the comments in its thread
+    threads = {}
+    for com_id in missing_ids:
+        rankable_id = com_id
+        while rankable_id in parents:
+            rankable_id = parents[rankable_id]
+        if rankable_id in news_item_ids:
+            threads.setdefault(rankable_id, []).append(com_id)
+        else:
+            print >>sys.stderr, "Warning! Comment " + str(com_id) + \
+                    " does not belong to a news item."
+
+    num_updated = 0
+    for news_item_id, com_ids in threads.items():
+        for i in range(0, len(com_ids), UPDATE_CHUNK_SIZE):
+            chunk = com_ids[i:i + UPDATE_CHUNK_SIZE]
+            Comment.objects.filter(id__in=chunk).update(news_item=news_item_id)
+            num_updated += len(chunk)
+
+    print "Set the news item for " + str(num_updated) + " comments"
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, migrate_comment_news_item, usage)
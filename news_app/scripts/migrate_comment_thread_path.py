@@ -0,0 +1,59 @@
+#!/usr/bin/python
+"""
+This is used to bring a database created before Comment.thread_path existed
+up to date.  It adds the column to the comment table if it is not there,
+and then works out the path of every comment, one thread at a time.
+It could be run like this:
+$ ./migrate_comment_thread_path.py
+
+Run migrate_comment_news_item.py first.  This can also be run at any time
+to fix up the paths after turning on NEWS_USE_COMMENT_PATHS.
+"""
+
+import sys
+import base
+
+usage_explanation =["Add Comment.thread_path to an existing database",
+                    "and work it out for every comment."]
+usage_commands = []
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  There are no additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    base.get_paths_options("", [], usage)
+    return {}
+
+
+def migrate_comment_thread_path():
+    """ Add the thread_path column and fill it in for all comments. """
+    from news.models import Comment
+    from news.helpers import update_thread_paths
+    from news.schema import add_column
+
+    if add_column(Comment, 'thread_path'):
+        print "Added the thread_path column to " + Comment._meta.db_table
+
+    news_item_ids = Comment.objects.filter(news_item__isnull=False).values_list(
+            'news_item', flat=True).distinct()
+    for news_item_id in news_item_ids:
+        update_thread_paths(news_item_id)
+
+    print "Updated the thread paths for " + str(len(news_item_ids)) + \
+            " news items"
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, migrate_comment_thread_path, usage)
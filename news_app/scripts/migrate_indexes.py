@@ -0,0 +1,63 @@
+#!/usr/bin/python
+"""
+This is used to add the indexes the frontpage, /new, /new_comments and
+the comment threads need to a database that was created before they
+were there.  That's the index on Rankable's date_posted, plus the ones
+in news.models.EXTRA_INDEXES, which Django can't create itself.  It
+could be run like this:
+$ ./migrate_indexes.py
+
+It is safe to run this more than once.  `./manage.py syncdb` creates
+the indexes in EXTRA_INDEXES (see news/signals.py), but it won't add
+date_posted's index to a table that already exists.
+"""
+
+import sys
+import base
+
+usage_explanation =["Add the indexes for the queries run on every page",
+                    "to an existing database."]
+usage_commands = []
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  There are no additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    base.get_paths_options("", [], usage)
+    return {}
+
+
+def migrate_indexes():
+    """ Add any of the indexes that aren't there yet. """
+    from news.models import Rankable, NewsItem, Comment, Rated, \
+            RerankRequest, EXTRA_INDEXES
+    from news.schema import add_field_indexes, add_index
+
+    for model in (Rankable, NewsItem, Comment, Rated, RerankRequest):
+        num_created = add_field_indexes(model)
+        print "Added " + str(num_created) + " field indexes to " + \
+                model._meta.db_table
+
+    for model, field_names in EXTRA_INDEXES:
+        if add_index(model, field_names):
+            print "Added the index on " + ", ".join(field_names) + \
+                    " to " + model._meta.db_table
+        else:
+            print "The index on " + ", ".join(field_names) + \
+                    " was already on " + model._meta.db_table
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, migrate_indexes, usage)
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+"""
+This is used to bring a database created before Rankable.kind existed
+up to date.  It adds the column to the rankable table if it is not there,
+and then sets the kind of every rankable that doesn't have one yet,
+using the ids in the news item and comment tables.
+It could be run like this:
+$ ./migrate_rankable_kind.py
+
+It is safe to run this more than once.
+"""
+
+import sys
+import base
+
+usage_explanation =["Add Rankable.kind to an existing database",
+                    "and fill it in for every news item and comment."]
+usage_commands = []
+
+# how many rankables get updated with one query
+UPDATE_CHUNK_SIZE = 500
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  There are no additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    base.get_paths_options("", [], usage)
+    return {}
+
+
+def migrate_rankable_kind():
+    """ Add the kind column and fill it in for all rankables. """
+    from news.models import Rankable, NewsItem, Comment
+    from news.schema import add_column
+
+    if add_column(Rankable, 'kind'):
+        print "Added the kind column to " + Rankable._meta.db_table
+
+    missing_ids = set(Rankable.objects.filter(kind='').values_list(
+            'id', flat=True))
+
+    for kind, model in (('news_item', NewsItem), ('comment', Comment)):
+        ids = [rankable_id for rankable_id in
+                model.objects.values_list('id', flat=True)
+                if rankable_id in missing_ids]
+        for i in range(0, len(ids), UPDATE_CHUNK_SIZE):
+            Rankable.objects.filter(id__in=ids[i:i + UPDATE_CHUNK_SIZE]
+                    ).update(kind=kind)
+        missing_ids.difference_update(ids)
+        print "Set the kind for " + str(len(ids)) + " " + kind + "s"
+
+    if missing_ids:
+        print >>sys.stderr, "Warning! " + str(len(missing_ids)) + \
+                " rankables are neither news items nor comments."
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, migrate_rankable_kind, usage)
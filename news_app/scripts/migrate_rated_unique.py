@@ -0,0 +1,68 @@
+#!/usr/bin/python
+"""
+This is used to bring a database created before someone could only vote
+on something once (enforced by the database) up to date.  It deletes any
+extra votes someone has on the same rankable (keeping the first one) and
+then adds the unique index on Rated's rankable and userprofile columns.
+It could be run like this:
+$ ./migrate_rated_unique.py
+
+The ratings aren't changed when the extra votes are deleted.
+It is safe to run this more than once.  Databases created with syncdb
+after unique_together was added to Rated already have the constraint,
+so this doesn't need to be run on them.
+"""
+
+import sys
+import base
+
+usage_explanation =["Make sure no one can vote on the same thing twice",
+                    "in an existing database."]
+usage_commands = []
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  There are no additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    base.get_paths_options("", [], usage)
+    return {}
+
+
+def migrate_rated_unique():
+    """ Delete duplicate votes and add the unique index. """
+    from news.models import Rated
+    from news.schema import add_index
+
+    seen = set()
+    extra_ids = []
+    for rated_id, rankable_id, userprofile_id in Rated.objects.order_by(
+            'id').values_list('id', 'rankable', 'userprofile'):
+        if (rankable_id, userprofile_id) in seen:
+            extra_ids.append(rated_id)
+        else:
+            seen.add((rankable_id, userprofile_id))
+
+    for i in range(0, len(extra_ids), 500):
+        Rated.objects.filter(id__in=extra_ids[i:i + 500]).delete()
+    print "Deleted " + str(len(extra_ids)) + " extra votes"
+
+    if add_index(Rated, ['rankable', 'userprofile'], unique=True):
+        print "Added the unique index to " + Rated._meta.db_table
+    else:
+        print "The unique index was already there"
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, migrate_rated_unique, usage)
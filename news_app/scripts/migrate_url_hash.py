@@ -0,0 +1,76 @@
+#!/usr/bin/python
+"""
+This is used to bring a database created before NewsItem.url_hash existed
+up to date.  It adds the column (and its index) to the news item table if
+it is not there, and then fills in the hash for every news item with a
+url that doesn't have one yet.  It could be run like this:
+$ ./migrate_url_hash.py
+
+It is safe to run this more than once.  Running it with --all works out
+every hash again, which is needed if news.helpers.canonicalize_url()
+changes.
+"""
+
+import sys
+import base
+
+usage_explanation =["Add NewsItem.url_hash to an existing database",
+                    "and fill it in for every news item."]
+usage_commands = ["-a, --all\t\t\twork out the hash again for every news item"]
+
+# how many news items are read at once
+CHUNK_SIZE = 500
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  It then processes the additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    all = False
+
+    opts = base.get_paths_options("a", ["all"], usage)
+
+    for opt, arg in opts:
+        if opt in ("--all", "-a"):
+            all = True
+
+    return {'all': all}
+
+
+def migrate_url_hash(all=False):
+    """ Add the url_hash column and fill it in for all news items. """
+    from news.models import NewsItem
+    from news.schema import add_column
+    from news.helpers import hash_url
+
+    if add_column(NewsItem, 'url_hash'):
+        print "Added the url_hash column to " + NewsItem._meta.db_table
+
+    news_items = NewsItem.objects.filter(url__isnull=False).exclude(url='')
+    if not all:
+        news_items = news_items.filter(url_hash__isnull=True)
+    ids = list(news_items.values_list('id', flat=True))
+
+    num_updated = 0
+    for i in range(0, len(ids), CHUNK_SIZE):
+        for news_item_id, url in NewsItem.objects.filter(
+                id__in=ids[i:i + CHUNK_SIZE]).values_list('id', 'url'):
+            # update() so this doesn't touch anything else in the row
+            num_updated += NewsItem.objects.filter(id=news_item_id).update(
+                    url_hash=hash_url(url))
+    print "Set the url hash for " + str(num_updated) + " news items"
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, migrate_url_hash, usage)
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+"""
+This measures every url in news/urls.py against a big made up dataset
+and prints the number of queries, the time spent in the database and
+the time spent rendering templates for each one (see
+news/query_budgets.py).  It creates a test database for this, like
+`manage.py test` does, so it doesn't touch the real one.  It could be
+run like this:
+$ ./query_budgets.py
+
+With --write, the numbers it measured (and the status codes) become 
+the new budgets in news/query_budgets.json.  Only do that after making
+sure a url that went over really needs the extra queries, and that
+each status is the one the url should return.  It exits with an error if
+any url is over its budget (and --write wasn't given).
+"""
+
+import sys
+import base
+
+usage_explanation =["Measure the queries every url runs and compare them",
+                    "to the budgets in news/query_budgets.json."]
+usage_commands = ["-w, --write\t\t\twrite the numbers measured as the new budgets"]
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  It then processes the additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    write = False
+
+    opts = base.get_paths_options("w", ["write"], usage)
+
+    for opt, arg in opts:
+        if opt in ("--write", "-w"):
+            write = True
+
+    return {'write': write}
+
+
+def query_budgets(write=False):
+    """ Measure every url and check (or write) the budgets. """
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment, \
+            teardown_test_environment
+    from news.query_budgets import load_budget_file, write_budget_file, \
+            seed_benchmark_data, measure_routes, find_over_budget
+
+    budget_file = load_budget_file()
+    dataset = budget_file['dataset']
+
+    setup_test_environment()
+    old_name = settings.DATABASE_NAME
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        data = seed_benchmark_data(**dict([(str(key), value)
+                for key, value in dataset.items()]))
+        results = measure_routes(data)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    print "%-50s %6s %8s %8s %9s %6s" % ('url', 'status', 'queries',
+            'budget', 'db ms', 'render ms')
+    for name, measurements in results:
+        print "%-50s %6d %8d %8s %9.1f %9.1f" % (name,
+                measurements['status'], measurements['queries'],
+                budget_file['budgets'].get(name, '-'),
+                measurements['db_ms'], measurements['render_ms'])
+    print
+
+    if write:
+        write_budget_file(dataset, dict([(name, measurements['queries'])
+                for name, measurements in results]), 
+                dict([(name, measurements['status']) 
+                for name, measurements in results]))
+        print "Wrote the new budgets."
+        return
+
+    messages = find_over_budget(results, budget_file['budgets'],
+            budget_file.get('statuses', {}))
+    if messages:
+        for message in messages:
+            print >>sys.stderr, "ERROR! " + message
+        sys.exit(1)
+    print "Every url is within its budget."
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, query_budgets, usage)
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""
+This is used to bring a database created before Rankable.num_comments and
+Rankable.num_live_comments existed up to date, or to fix the counts if
+they have gotten out of sync with the comments (for instance if comments
+were deleted straight from the database).  It adds the columns if they are
+not there, counts all the comments at once in memory, and saves only the
+counts that are wrong.  It could be run like this:
+$ ./repair_comment_counts.py
+
+Run migrate_comment_news_item.py first.
+"""
+
+import sys
+import base
+
+usage_explanation =["Add Rankable.num_comments and Rankable.num_live_comments",
+                    "to an existing database and recount them all."]
+usage_commands = []
+
+# how many rankables get updated with one query
+UPDATE_CHUNK_SIZE = 500
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  There are no additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    base.get_paths_options("", [], usage)
+    return {}
+
+
+def repair_comment_counts():
+    """ Add the comment count columns and recount them for everything. """
+    from news.models import Rankable, Comment
+    from news.schema import add_column
+    from django.db import transaction
+
+    for field_name in ('num_comments', 'num_live_comments'):
+        if add_column(Rankable, field_name):
+            print "Added the " + field_name + " column to " + \
+                    Rankable._meta.db_table
+
+    parents = {}
+    dead = {}
+    for com_id, parent_id, com_dead in Comment.objects.values_list(
+            'id', 'parent', 'dead'):
+        parents[com_id] = parent_id
+        dead[com_id] = com_dead
+
+    # maps a rankable id to its (num_comments, num_live_comments)
+    counts = {}
+    for com_id in parents:
+        rankable_id = parents[com_id]
+        while rankable_id is not None:
+            num, num_live = counts.get(rankable_id, (0, 0))
+            counts[rankable_id] = (num + 1, num_live + (not dead[com_id]))
+            rankable_id = parents.get(rankable_id)
+
+    # Group the rankables whose counts are wrong by what the counts should
+    # be, so they can be fixed a chunk at a time.
+    fixes = {}
+    for rankable_id, num, num_live in Rankable.objects.values_list(
+            'id', 'num_comments', 'num_live_comments'):
+        right_counts = counts.get(rankable_id, (0, 0))
+        if (num, num_live) != right_counts:
+            fixes.setdefault(right_counts, []).append(rankable_id)
+
+    @transaction.commit_on_success
+    def save_fixes():
+        num_fixed = 0
+        for (num, num_live), rankable_ids in fixes.items():
+            for i in range(0, len(rankable_ids), UPDATE_CHUNK_SIZE):
+                chunk = rankable_ids[i:i + UPDATE_CHUNK_SIZE]
+                Rankable.objects.filter(id__in=chunk).update(
+                        num_comments=num, num_live_comments=num_live)
+                num_fixed += len(chunk)
+        return num_fixed
+
+    num_fixed = save_fixes()
+    print "Fixed the comment counts for " + str(num_fixed) + " rankables"
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, repair_comment_counts, usage)
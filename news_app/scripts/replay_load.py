@@ -0,0 +1,112 @@
+#!/usr/bin/python
+"""
+This sends lots of requests at once to a running server and prints how
+many it handled each second and how long they took, for each url (see
+news/replay.py).  The requests either come from an access log, or are
+made up from what is in the database with about the mix real people
+send: mostly the frontpage and threads, and some votes and comments.
+It could be run like this, with the server running on port 8000:
+$ ./replay_load.py --url=http://localhost:8000 --workers=20 --requests=5000
+$ ./replay_load.py --log=/var/log/nginx/access.log
+
+Votes and comments are sent logged in, as accounts named replay_N that
+this creates (or resets) in the database the server is using.  They
+really do get posted, so this is best run on a database filled with
+init_db_vals.py --synthetic.
+
+WARNING, DO NOT RUN THIS ON A PRODUCTION DATABASE!
+"""
+
+import sys
+import base
+
+usage_explanation =["Replay requests against a running server and report",
+                    "the throughput and latency for each url."]
+usage_commands = ["-u, --url=URL\t\t\tthe server (default http://localhost:8000)",
+                  "-w, --workers=N\t\tnumber of requests at once (default 10)",
+                  "-r, --requests=N\t\tnumber of made up requests (default 1000)",
+                  "-l, --log=FILE\t\t\treplay the GETs in an access log instead",
+                  "-c, --accounts=N\t\tnumber of accounts to log in as (default one per worker)",
+                  "-s, --seed=N\t\t\tseed for making up the requests (default 0)"]
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  It then processes the additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    url = 'http://localhost:8000'
+    workers = 10
+    requests = 1000
+    log = None
+    accounts = None
+    seed = 0
+
+    opts = base.get_paths_options("u:w:r:l:c:s:", ["url=", "workers=",
+            "requests=", "log=", "accounts=", "seed="], usage)
+
+    for opt, arg in opts:
+        if opt in ("--url", "-u"):
+            url = arg
+        elif opt in ("--workers", "-w"):
+            workers = base.get_int_arg(arg,
+                    "ERROR! Argument to --workers must be a positive integer.",
+                    usage, must_be_pos=True)
+        elif opt in ("--requests", "-r"):
+            requests = base.get_int_arg(arg,
+                    "ERROR! Argument to --requests must be a positive integer.",
+                    usage, must_be_pos=True)
+        elif opt in ("--log", "-l"):
+            log = arg
+        elif opt in ("--accounts", "-c"):
+            accounts = base.get_int_arg(arg,
+                    "ERROR! Argument to --accounts must be an integer.",
+                    usage)
+        elif opt in ("--seed", "-s"):
+            seed = base.get_int_arg(arg,
+                    "ERROR! Argument to --seed must be an integer.", usage)
+
+    return {'url': url, 'workers': workers, 'requests': requests,
+            'log': log, 'accounts': accounts, 'seed': seed}
+
+
+def replay_load(url='http://localhost:8000', workers=10, requests=1000,
+        log=None, accounts=None, seed=0):
+    """ Replay the requests against the server and print the report. """
+    from news.replay import parse_access_log, build_request_mix, \
+            get_accounts, run_replay
+
+    if log:
+        log_file = open(log)
+        try:
+            request_list, num_skipped = parse_access_log(log_file)
+        finally:
+            log_file.close()
+        print "Read %d requests from %s (skipped %d lines)" % (
+                len(request_list), log, num_skipped)
+    else:
+        request_list = build_request_mix(requests, seed=seed)
+        print "Made up %d requests" % len(request_list)
+
+    if accounts is None:
+        accounts = workers
+    logins = get_accounts(accounts)
+
+    print "Sending them to %s with %d workers..." % (url, workers)
+    report = run_replay(url, request_list, workers, logins)
+    print
+    print report.format()
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, replay_load, usage)
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+"""
+This checks that votes are counted correctly when lots of them happen at
+the same time.  It creates some users and a comment, then has a bunch
+of threads all vote on the comment with news.votes.record_vote() at
+once, each user voting more than once.  When they are done it checks that
+each user's vote was counted exactly once, that everyone paid for exactly
+one vote, and that the rating is right.  Then it deletes everything it
+created.  It could be run like this:
+$ ./stress_votes.py --users=50 --threads=10 --tries=3
+
+With sqlite, some votes may fail with "database is locked".  Those are
+tried again.
+
+WARNING, DO NOT RUN THIS ON A PRODUCTION DATABASE!
+"""
+
+import sys, random, threading, time
+import base
+
+usage_explanation =["Vote on the same comment from lots of threads at once",
+                    "and make sure every vote is counted exactly once."]
+usage_commands = ["-u, --users=N\t\t\tnumber of users voting (default 50)",
+                  "-t, --threads=N\t\tnumber of threads voting (default 10)",
+                  "-r, --tries=N\t\t\thow many times each user votes (default 3)"]
+
+# how many times a vote is tried if the database is busy
+MAX_ATTEMPTS = 20
+
+
+def usage():
+    """ Print usage. """
+    base.usage(usage_explanation, usage_commands)
+
+def setup_path_and_args():
+    """
+    This uses base.py to setup the correct paths, in case
+    this is being called on the command line and not being
+    imported. It also uses base.py to get all of the command line
+    arguments.  It then processes the additional args.
+
+    Returns a dictionary of the extra args we are reading from the
+    command line.  This gets passed to our main function.
+    """
+    users = 50
+    threads = 10
+    tries = 3
+
+    opts = base.get_paths_options("u:t:r:", ["users=", "threads=", "tries="],
+            usage)
+
+    for opt, arg in opts:
+        if opt in ("--users", "-u"):
+            users = base.get_int_arg(arg,
+                    "ERROR! Argument to --users must be a positive integer.",
+                    usage, must_be_pos=True)
+        elif opt in ("--threads", "-t"):
+            threads = base.get_int_arg(arg,
+                    "ERROR! Argument to --threads must be a positive integer.",
+                    usage, must_be_pos=True)
+        elif opt in ("--tries", "-r"):
+            tries = base.get_int_arg(arg,
+                    "ERROR! Argument to --tries must be a positive integer.",
+                    usage, must_be_pos=True)
+
+    return {'users': users, 'threads': threads, 'tries': tries}
+
+
+def stress_votes(users=50, threads=10, tries=3):
+    """ Vote from lots of threads at once and check the results. """
+    from news.models import UserProfile, NewsItem, Comment, Rated, Rankable, \
+            RerankRequest
+    from news.votes import record_vote, VOTED
+    from django.contrib.auth.models import User
+    from django.db import connection, DatabaseError
+
+    points = 10
+    poster = UserProfile.objects.all()[0]
+    news_item = NewsItem.objects.create(poster=poster, title="stress_votes",
+            url="http://example.com")
+    # voting on comments costs comment points, so those get checked too
+    comment = Comment.objects.create(poster=poster, text="stress_votes",
+            parent=news_item)
+    cost = None
+
+    profile_ids = []
+    for i in range(users):
+        user = User.objects.create(username="stress_votes_%d_%d" %
+                (news_item.id, i))
+        profile = UserProfile.objects.create(user=user, comment_points=points)
+        profile_ids.append(profile.id)
+        if cost is None:
+            cost = comment.vote_cost(profile)
+
+    # every user votes tries times, in a random order
+    votes = profile_ids * tries
+    random.shuffle(votes)
+    lock = threading.Lock()
+    results = {}
+    errors = []
+
+    def voter():
+        while True:
+            lock.acquire()
+            try:
+                if not votes:
+                    break
+                profile_id = votes.pop()
+            finally:
+                lock.release()
+
+            for attempt in range(MAX_ATTEMPTS):
+                try:
+                    result = record_vote(Rankable.objects.get(id=comment.id),
+                            UserProfile.objects.get(id=profile_id), 'up')
+                    break
+                except DatabaseError, e:
+                    # the database is busy (sqlite), so try again
+                    result = str(e)
+                    time.sleep(random.random() / 10)
+            lock.acquire()
+            results[result] = results.get(result, 0) + 1
+            lock.release()
+        connection.close()
+
+    start = time.time()
+    voter_threads = [threading.Thread(target=voter) for i in range(threads)]
+    for thread in voter_threads:
+        thread.start()
+    for thread in voter_threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    try:
+        print "%d votes from %d threads in %.3f seconds" % (users * tries,
+                threads, elapsed)
+        for result, count in sorted(results.items()):
+            print "  %-20s %d" % (result, count)
+
+        rating = Rankable.objects.get(id=comment.id).rating
+        num_rated = Rated.objects.filter(rankable=comment).count()
+        points_left = [profile.comment_points for profile in
+                UserProfile.objects.filter(id__in=profile_ids)]
+
+        if rating != 1 + users:
+            errors.append("the rating is %d, not %d" % (rating, 1 + users))
+        if num_rated != users:
+            errors.append("there are %d votes, not %d" % (num_rated, users))
+        if points_left != [points - cost] * users:
+            errors.append("the comment points are wrong: " + str(points_left))
+        if results.get(VOTED) != users:
+            errors.append("%s votes were recorded, not %d" %
+                    (results.get(VOTED), users))
+    finally:
+        RerankRequest.objects.filter(rankable__in=[comment, news_item]).delete()
+        Rated.objects.filter(rankable=comment).delete()
+        comment.delete()
+        news_item.delete()
+        for profile in UserProfile.objects.filter(id__in=profile_ids):
+            user = profile.user
+            profile.delete()
+            user.delete()
+
+    if errors:
+        for error in errors:
+            print >>sys.stderr, "ERROR! " + error
+        sys.exit(1)
+    print "Every vote was counted exactly once."
+
+
+
+if __name__ == '__main__':
+    base.main(setup_path_and_args, stress_votes, usage)
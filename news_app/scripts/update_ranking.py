@@ -2,14 +2,66 @@
 """
 This is used to update the ranking for objects that are ranked.
 This includes comments and news items.
+
+There are three ways it can do this (--mode):
+
+  per-object  update one rankable at a time (this is the default),
+              starting with the ones whose rankings have drifted the most
+              (see news.ranking.RerankScheduler), at most --rate a second
+  vectorized  update every rankable that could be on the frontpage in one 
+              pass, working out the rankings in python (see news/ranking.py)
+  sql         the same, but the database works out the rankings with 
+              one UPDATE
+  consume     only update the rankables in the rerank queue
+
+Votes and new comments put rankables in a queue (news.models.RerankRequest)
+instead of updating their rankings right away.  Every mode works through
+the queue as it goes, updating each rankable in it once.
+
+The bulk modes wait --milliseconds between passes, and consume mode waits
+--milliseconds when the queue is empty.  In per-object mode
+--milliseconds still works as the time between updates if --rate isn't
+given.
+benchmark_ranking.py compares how fast they are.
+
+After anything is re-ranked, the cached frontpage is worked out again
+(see news/caching.py), and in any case every 
+NEWS_FRONTPAGE_REFRESH_SECONDS.  With NEWS_FRONTPAGE_SNAPSHOT_SECONDS,
+the frontpage snapshot table is written then too.
+
+With --workers=N, the rankables are split into N shards by id (see
+news/ranking.py), and each one gets its own process doing the same as
+above, so re-ranking can use every core.  Each shard takes its own lock
+(NEWS_UPDATE_RANKING_LOCKFILE followed by .shard0, .shard1, ...) and
+writes how far it has got into it, so
+$ cat /var/lock/swoosh_news.update_ranking.lock.shard*
+shows what every shard is doing.  The first process supervises the
+shards: it starts a shard again if it dies, refreshes the cached 
+frontpage after they re-rank things, and prints their progress every
+PROGRESS_SECONDS.  This only goes faster with a database that can do 
+more than one write at a time (postgresql or mysql, not sqlite).
+--rate is for each shard.
 """
 
-import getopt, sys, traceback
+import errno, getopt, os, signal, sys, time, traceback
 import base
 
 usage_explanation =["Constantly update the ranking for objects that are ranked."]
-usage_commands = ["-s, --milliseconds=N\t\tupdate a rankable every N milliseconds", 
-                  "-d, --daemonize\t\trun the process in the background",]
+usage_commands = ["-s, --milliseconds=N\t\twait N milliseconds between updates", 
+                  "-r, --rate=N\t\t\tupdate at most N rankables a second",
+                  "-d, --daemonize\t\trun the process in the background",
+                  "-m, --mode=MODE\t\tper-object, vectorized, sql or consume",
+                  "-b, --bulk\t\t\tthe same as --mode=vectorized",
+                  "-w, --workers=N\t\tsplit the rankables between N processes",]
+
+MODES = ('per-object', 'vectorized', 'sql', 'consume')
+
+# how often the supervisor prints the progress of the shards
+PROGRESS_SECONDS = 10
+
+# a shard that dies is started again after at least this many seconds
+# since it was last started, so one that can't start doesn't spin
+RESTART_SECONDS = 5
 
 
 def usage():
@@ -27,46 +79,131 @@ def setup_path_and_args():
     command line.  This gets passed to our main function (init_db).
     """
     milliseconds = 500
+    rate = None
     daemonize = False
+    mode = 'per-object'
+    workers = 1
     
 
-    opts = base.get_paths_options("s:d", ["milliseconds=", "daemonize"], usage)
+    opts = base.get_paths_options("s:r:dbm:w:", ["milliseconds=", "rate=",
+        "daemonize", "bulk", "mode=", "workers="], usage)
 
     for opt, arg in opts:
         if opt in ("--milliseconds", "-s"):
             milliseconds = base.get_int_arg(arg,
                     "ERROR! Argument to --milliseconds must be a positive integer.",
                     usage, must_be_pos=True)
+        elif opt in ("--rate", "-r"):
+            rate = base.get_int_arg(arg,
+                    "ERROR! Argument to --rate must be a positive integer.",
+                    usage, must_be_pos=True)
         elif opt in ("-d", "--daemonize"):
             daemonize = True
+        elif opt in ("-b", "--bulk"):
+            mode = 'vectorized'
+        elif opt in ("-m", "--mode"):
+            if arg not in MODES:
+                print "ERROR! Argument to --mode must be one of " + \
+                        ", ".join(MODES) + "."
+                print
+                usage()
+                sys.exit(2)
+            mode = arg
+        elif opt in ("-w", "--workers"):
+            workers = base.get_int_arg(arg,
+                    "ERROR! Argument to --workers must be a positive integer.",
+                    usage, must_be_pos=True)
 
-    return {'milliseconds':milliseconds, 'daemonize':daemonize}
-
+    return {'milliseconds':milliseconds, 'rate':rate, 'daemonize':daemonize, 
+            'mode':mode, 'workers':workers}
 
-def update_ranking(milliseconds=500, daemonize=False):
-    """ Update a random rankable every arg milliseconds.  """
-    from random import randint
-    import time
-    import os, sys, fcntl
-    from news.models import Rankable
-    from news.helpers import get_frontpage_querymanager
-    from news.conf import NEWS_UPDATE_RANKING_LOCKFILE
-    from django import db
 
+def lock_or_exit(lockfile):
+    """
+    Lock lockfile so only one of these can be running at a time.  Exits
+    if it is already locked.  Returns the open lockfile, which needs to 
+    be kept around (the lock goes away when it is closed).
+    """
+    import fcntl
 
-    # if this is a daemon, make sure it can only be run once
     try:
-        fp = open(NEWS_UPDATE_RANKING_LOCKFILE, 'w')
+        fp = open(lockfile, 'w')
     except IOError:
-        print >>sys.stderr, "Error! Could not open lockfile " + NEWS_UPDATE_RANKING_LOCKFILE
+        print >>sys.stderr, "Error! Could not open lockfile " + lockfile
         sys.exit(1)
 
     try:
         fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
     except IOError:
-        print >>sys.stderr, "Error! Could not lock lockfile " + NEWS_UPDATE_RANKING_LOCKFILE
+        print >>sys.stderr, "Error! Could not lock lockfile " + lockfile
         sys.exit(1)
 
+    return fp
+
+def shard_lockfile(lockfile, index):
+    """ Return the name of the lockfile for shard number index. """
+    return "%s.shard%d" % (lockfile, index)
+
+def snapshot_seconds():
+    """
+    Return how often to write a frontpage snapshot: every 
+    NEWS_FRONTPAGE_REFRESH_SECONDS, or more often if that is needed to 
+    keep the snapshot new enough to use.
+    """
+    from news.conf import NEWS_FRONTPAGE_REFRESH_SECONDS, \
+            NEWS_FRONTPAGE_SNAPSHOT_SECONDS
+    return min(NEWS_FRONTPAGE_REFRESH_SECONDS, 
+            NEWS_FRONTPAGE_SNAPSHOT_SECONDS / 2.0)
+
+def write_progress(fp, shard, passes, num_queued, num_updated, 
+        last_pass_seconds):
+    """
+    Replace what is in fp (a shard's open lockfile) with one line
+    saying how far the shard has got.  num_queued is how many requests
+    it has taken from the rerank queue so far.
+    """
+    fp.seek(0)
+    fp.truncate()
+    fp.write("shard=%d/%d pid=%d passes=%d queued=%d updated=%d "
+            "last_pass_ms=%.1f time=%.1f\n" % (shard[0], shard[1], 
+            os.getpid(), passes, num_queued, num_updated, 
+            last_pass_seconds * 1000, time.time()))
+    fp.flush()
+
+def read_progress(filename):
+    """
+    Return a dictionary of what write_progress() wrote to filename, or
+    None if there isn't anything there yet.
+    """
+    try:
+        fp = open(filename)
+        try:
+            line = fp.readline()
+        finally:
+            fp.close()
+        progress = dict([item.split('=', 1) for item in line.split()])
+        return {'shard': progress['shard'], 'pid': int(progress['pid']),
+                'passes': int(progress['passes']),
+                'queued': int(progress['queued']),
+                'updated': int(progress['updated']),
+                'last_pass_ms': float(progress['last_pass_ms']),
+                'time': float(progress['time'])}
+    except (IOError, ValueError, KeyError):
+        return None
+
+def update_ranking(milliseconds=500, rate=None, daemonize=False, 
+        mode='per-object', workers=1):
+    """ 
+    Keep updating the rankings, either rate rankables a second or
+    every rankable in the frontpage window every milliseconds.  With
+    more than one worker, this supervises that many shard processes.
+    """
+    from news.conf import NEWS_UPDATE_RANKING_LOCKFILE
+
+
+    # if this is a daemon, make sure it can only be run once
+    lockfile = lock_or_exit(NEWS_UPDATE_RANKING_LOCKFILE)
+
 
     if daemonize:
         if os.fork() == 0:
@@ -94,31 +231,324 @@ def update_ranking(milliseconds=500, daemonize=False):
     #print "sys.argv = " + str(sys.argv)
     #print "__name__ = " + __name__
 
+    if workers > 1:
+        supervise_shards(workers, milliseconds, rate, daemonize, mode,
+                NEWS_UPDATE_RANKING_LOCKFILE)
+    else:
+        rank_forever(milliseconds, rate, daemonize, mode)
+
+def run_shard(index, workers, milliseconds, rate, daemonize, mode, 
+        lockfile_name):
+    """
+    Fork a process that updates the rankings for shard number index.
+    Returns its pid.  The process never returns from here.
+    """
+    from django import db
+
+    # the shard can't share the database connection with this process
+    db.connection.close()
+    pid = os.fork()
+    if pid:
+        return pid
+
+    exit_code = 1
+    try:
+        try:
+            # the supervisor handles ctrl-c and stopping the shards
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            lockfile = lock_or_exit(shard_lockfile(lockfile_name, index))
+            rank_forever(milliseconds, rate, daemonize, mode, 
+                    shard=(index, workers), progress_file=lockfile)
+        except SystemExit, e:
+            exit_code = e.code
+        except:
+            if not daemonize:
+                traceback.print_exc(file=sys.stderr)
+    finally:
+        # don't run anything the supervisor would run when it exits
+        os._exit(exit_code or 0)
+
+def restart_shards(pids, started, waiting, start, daemonize=False):
+    """
+    Wait for the shard processes that have died, and start them again
+    with start(index) once RESTART_SECONDS have passed since they were
+    last started.  pids maps the live shards' pids to their indexes, 
+    started maps indexes to when they were started, and waiting maps the
+    dead ones' indexes to when they can be started again.
+    """
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError, e:
+            # there aren't any children left if they all died
+            if e.errno != errno.ECHILD:
+                raise
+            break
+        if not pid:
+            break
+        if pid in pids:
+            index = pids.pop(pid)
+            waiting[index] = started[index] + RESTART_SECONDS
+            if not daemonize:
+                print >>sys.stderr, "Shard %d (pid %d) died with status " \
+                        "%d, starting it again" % (index, pid, status)
+    for index, restart_time in waiting.items():
+        if time.time() >= restart_time:
+            del waiting[index]
+            start(index)
+
+def supervise_shards(workers, milliseconds, rate, daemonize, mode, 
+        lockfile_name):
+    """
+    Start a process for each of workers shards, start them again if they
+    die, refresh the cached frontpage when they take requests from the
+    rerank queue (or every NEWS_FRONTPAGE_REFRESH_SECONDS), and
+    print their progress.  Stops them all when it is stopped.
+    """
+    from news.conf import NEWS_FRONTPAGE_REFRESH_SECONDS
+    from news.caching import refresh_frontpage_cache, \
+            write_frontpage_snapshot
+    from django import db
+
+    pids = {}
+    started = {}
+
+    def start(index):
+        """ Start shard number index. """
+        pid = run_shard(index, workers, milliseconds, rate, daemonize, mode,
+                lockfile_name)
+        pids[pid] = index
+        started[index] = time.time()
+
+    def stop(signum, frame):
+        """ Stop on SIGTERM like on ctrl-c. """
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(workers):
+        start(index)
+
+    waiting = {}
+    last_queued = 0
+    last_passes = 0
+    last_frontpage_refresh = 0
+    last_snapshot = 0
+    last_report = time.time()
+    last_report_updated = {}
+    try:
+        while True:
+            try:
+                # start the shards that died again
+                restart_shards(pids, started, waiting, start, daemonize)
+
+                progress = [read_progress(shard_lockfile(lockfile_name, i))
+                        for i in range(workers)]
+                num_queued = sum([p['queued'] for p in progress if p])
+                num_passes = sum([p['passes'] for p in progress if p])
+
+                # the frontpage order might have changed (this is when 
+                # rank_forever() refreshes it without shards)
+                if num_queued != last_queued or \
+                        (mode in ('vectorized', 'sql') and 
+                        num_passes != last_passes) or \
+                        time.time() - last_frontpage_refresh >= \
+                        NEWS_FRONTPAGE_REFRESH_SECONDS:
+                    refresh_frontpage_cache()
+                    last_queued = num_queued
+                    last_passes = num_passes
+                    last_frontpage_refresh = time.time()
+                    db.reset_queries()
 
-    def do_update(rankable):
-        """ Do the update and pause for the set time. """
-        rankable.update_ranking()
+                # the snapshot is on its own, slower timer
+                if time.time() - last_snapshot >= snapshot_seconds():
+                    write_frontpage_snapshot()
+                    last_snapshot = time.time()
+                    db.reset_queries()
+
+                elapsed = time.time() - last_report
+                if elapsed >= PROGRESS_SECONDS:
+                    for index, p in enumerate(progress):
+                        if p is None:
+                            if not daemonize:
+                                print >>sys.stderr, "shard %d/%d: " \
+                                        "starting" % (index, workers)
+                            continue
+                        rate_updated = (p['updated'] - 
+                                last_report_updated.get(p['pid'], 0)) / elapsed
+                        last_report_updated[p['pid']] = p['updated']
+                        if not daemonize:
+                            print >>sys.stderr, "shard %s (pid %d): %d " \
+                                    "passes, %d updated, %.0f/s, last pass " \
+                                    "%.1f ms" % (p['shard'], p['pid'], 
+                                    p['passes'], p['updated'], rate_updated,
+                                    p['last_pass_ms'])
+                    last_report = time.time()
+
+                time.sleep(milliseconds / float(1000))
+
+            except KeyboardInterrupt:
+                raise
+
+            except:
+                # Print stack trace and just keep going for any other type of exception
+                if not daemonize:
+                    print >>sys.stderr, "\nException in update_ranking.py:"
+                    print >>sys.stderr, '-'*60
+                    traceback.print_exc(file=sys.stderr)
+                    print >>sys.stderr, '-'*60
+                time.sleep(milliseconds / float(1000))
+
+    except KeyboardInterrupt:
+        # exit gracefully on ctrl-c
         if not daemonize:
-            print >>sys.stderr, "Updated " + unicode(rankable)
-        time.sleep(milliseconds / float(1000))
+            print >>sys.stderr, "\nStopping %d shards" % len(pids)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        sys.exit(0)
+
+def rank_forever(milliseconds=500, rate=None, daemonize=False, 
+        mode='per-object', shard=None, progress_file=None):
+    """
+    The main loop of update_ranking().  With shard, only the rankables
+    in that shard are updated, the supervisor refreshes the frontpage
+    instead of this, and the progress is written to progress_file after
+    every pass.
+    """
+    from news.models import Comment
+    from news.helpers import update_thread_paths, datetime_ago, \
+            MAX_IN_CLAUSE_IDS
+    from news.conf import NEWS_USE_COMMENT_PATHS, \
+            NEWS_FRONTPAGE_REFRESH_SECONDS
+    from news.ranking import rerank_window, rerank_window_sql, \
+            RerankScheduler, drain_rerank_queue, filter_shard
+    from news.caching import refresh_frontpage_cache, \
+            write_frontpage_snapshot
+    from django import db
+
 
-    def do_random_update_from_query(querymanager):
-        """ Update a random rankable within querymanager. """
-        num_rankables = querymanager.count()
-        random_rankable = querymanager[randint(0, num_rankables-1)]
-        do_update(random_rankable)
+    if rate is None:
+        rate = 1000.0 / milliseconds
+    scheduler = RerankScheduler(weeks=4, shard=shard)
+    last_frontpage_refresh = 0
+    last_snapshot = 0
+    # the supervisor prints the progress of shards
+    verbose = not daemonize and shard is None
+    passes = 0
+    total_queued = 0
+    num_updated = 0
+
+    def do_queued_updates():
+        """ 
+        Update everything in the rerank queue.  Returns the number 
+        of requests in the queue.
+        """
+        num_requests, rankable_ids = drain_rerank_queue(shard=shard)
+
+        # the comments' places in their threads might have changed
+        if NEWS_USE_COMMENT_PATHS and rankable_ids:
+            rankable_ids = list(rankable_ids)
+            news_item_ids = set()
+            for i in range(0, len(rankable_ids), MAX_IN_CLAUSE_IDS):
+                news_item_ids.update(Comment.objects.filter(
+                        id__in=rankable_ids[i:i + MAX_IN_CLAUSE_IDS]
+                        ).values_list('news_item', flat=True))
+            for news_item_id in news_item_ids:
+                update_thread_paths(news_item_id)
+
+        if num_requests and verbose:
+            print >>sys.stderr, "Updated %d rankables from %d queued " \
+                    "requests" % (len(rankable_ids), num_requests)
+        return num_requests, len(rankable_ids)
+
+    def do_scheduled_update():
+        """ 
+        Update the rankable that most needs it, and pause long enough
+        to keep to rate updates a second.  Returns the number updated.
+        """
+        start = time.time()
+        rankable_id = scheduler.rerank_next()
+        if rankable_id is not None:
+            # the comment's place in its thread might have changed
+            if NEWS_USE_COMMENT_PATHS:
+                for news_item_id in Comment.objects.filter(
+                        id=rankable_id).values_list('news_item', flat=True):
+                    update_thread_paths(news_item_id)
+            if verbose:
+                print >>sys.stderr, "Updated rankable " + str(rankable_id)
+        time.sleep(max(0, 1.0 / rate - (time.time() - start)))
+        return int(rankable_id is not None)
+
+    def do_bulk_update(rerank):
+        """ 
+        Update all the recent rankables with rerank and pause for the 
+        set time.  Returns the number updated.
+        """
+        start = time.time()
+        num_rankables = rerank(weeks=4, shard=shard)
+        elapsed = time.time() - start
+
+        # the comments' places in their threads might have changed (each
+        # shard does the threads of the news items in it)
+        if NEWS_USE_COMMENT_PATHS:
+            news_item_ids = filter_shard(Comment.objects.filter(
+                    date_posted__gt=datetime_ago(weeks=4)), shard, 
+                    'news_item_id').values_list('news_item', 
+                    flat=True).distinct()
+            for news_item_id in news_item_ids:
+                update_thread_paths(news_item_id)
+
+        if verbose:
+            print >>sys.stderr, "Updated %d rankables in %.3f seconds " \
+                    "(%.0f rows/s)" % (num_rankables, elapsed, 
+                    num_rankables / max(elapsed, 0.000001))
+        time.sleep(milliseconds / float(1000))
+        return num_rankables
 
     while True:
         try:
-            # update a random rankable
-            do_random_update_from_query(Rankable.objects.all())
+            pass_start = time.time()
+            num_queued, num_pass_updated = do_queued_updates()
+
+            if mode == 'consume':
+                if not num_queued:
+                    time.sleep(milliseconds / float(1000))
+            elif mode == 'vectorized':
+                num_pass_updated += do_bulk_update(rerank_window)
+            elif mode == 'sql':
+                num_pass_updated += do_bulk_update(rerank_window_sql)
+            else:
+                num_pass_updated += do_scheduled_update()
 
-            # update least recently ranked rankable
-            old_rankable = Rankable.objects.all().order_by('last_ranked_date')[0]
-            do_update(old_rankable)
+            passes += 1
+            total_queued += num_queued
+            num_updated += num_pass_updated
+            if progress_file is not None:
+                write_progress(progress_file, shard, passes, total_queued,
+                        num_updated, time.time() - pass_start)
 
-            # update random top 50 frontpage rankable
-            do_random_update_from_query(get_frontpage_querymanager())
+            # the frontpage order might have changed
+            if shard is None and (num_queued or 
+                    mode in ('vectorized', 'sql') or 
+                    time.time() - last_frontpage_refresh >= 
+                    NEWS_FRONTPAGE_REFRESH_SECONDS):
+                refresh_frontpage_cache()
+                last_frontpage_refresh = time.time()
+
+            # rewriting the snapshot on every refresh would be a lot of 
+            # writes for nothing
+            if shard is None and \
+                    time.time() - last_snapshot >= snapshot_seconds():
+                write_frontpage_snapshot()
+                last_snapshot = time.time()
 
             # this is needed to Django doesn't hog memory if we are running under
             # DEBUG = True
@@ -126,7 +556,7 @@ def update_ranking(milliseconds=500, daemonize=False):
 
         except KeyboardInterrupt:
             # exit gracefully on ctrl-c
-            if not daemonize:
+            if verbose:
                 print >>sys.stderr, ""
             sys.exit(0)
 
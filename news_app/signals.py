@@ -1,4 +1,5 @@
 from django.core.signals import request_finished
+from django.db.models.signals import post_syncdb
 from django.core.mail import send_mail
 
 from paypal.standard.ipn.signals import payment_was_successful, payment_was_flagged
@@ -102,3 +103,22 @@ def process_err_ipn_signal(sender, **kwargs):
             [news_settings.NEWS_PAY_ERR_MAIL_TO])
 
 payment_was_flagged.connect(process_err_ipn_signal)
+
+
+def create_extra_indexes(sender, **kwargs):
+    """
+    Create the indexes in news.models.EXTRA_INDEXES after syncdb.  
+    It's safe to do this every time, since add_index() leaves indexes
+    that are already there alone.
+    """
+    from news.models import EXTRA_INDEXES
+    from news.schema import add_index
+
+    if kwargs.get('app') is None or kwargs['app'].__name__ != 'news.models':
+        return
+    for model, field_names in EXTRA_INDEXES:
+        if add_index(model, field_names) and kwargs.get('verbosity', 1) >= 1:
+            print "Installing extra index on %s (%s)" % (model._meta.db_table,
+                    ', '.join(field_names))
+
+post_syncdb.connect(create_extra_indexes)
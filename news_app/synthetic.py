@@ -0,0 +1,321 @@
+"""
+Made up data for capacity testing and benchmarks.
+
+generate_dataset() fills the database with users, news items, comments
+and votes that look roughly like a real site's:
+
+  - votes follow a Zipf distribution, so a few news items and comments
+    get most of them
+  - thread sizes follow a power law, so most news items get a couple of
+    comments and a few get hundreds
+  - some replies answer the last comment in their thread, which makes
+    long back and forth reply chains
+  - a share of the news items and comments are dead (deleted)
+  - everything is posted over the last few months
+
+Everything is worked out in python first (including the ratings,
+rankings, comment counts and thread paths), then written with one
+executemany() INSERT per batch of rows, each batch in its own
+transaction.  That is a lot faster than creating the objects one at a
+time, which runs a handful of queries for every comment.
+
+The same seed always gives the same data (apart from the dates, which
+are relative to end).  The ids are picked here instead of by the
+database, so nothing else should be writing to the database while this
+runs.  Don't run it on a production database.
+"""
+from django.contrib.auth.models import User, UNUSABLE_PASSWORD
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+
+import bisect, datetime, random
+
+from news.models import UserProfile, Rankable, NewsItem, Comment, Rated
+from news.helpers import calculate_thread_paths, hash_url
+from news.ranking import calculate_rankings, hours_since
+import news.conf as news_settings
+
+# how many rows are written with each INSERT (and each transaction)
+DEFAULT_BATCH_SIZE = 1000
+
+# the exponent for the Zipf distribution of votes
+VOTE_ZIPF_EXPONENT = 1.1
+# the shape of the power law for thread sizes (smaller is more skewed)
+THREAD_SIZE_ALPHA = 1.2
+# the chance that a comment answers the last comment in its thread
+REPLY_CHAIN_CHANCE = 0.35
+# the chance that a comment is posted right to the news item
+TOP_LEVEL_CHANCE = 0.4
+# the share of news items that are "Ask" posts (text, no url)
+ASK_CHANCE = 0.1
+# the share of votes on news items that are down votes
+DOWN_VOTE_CHANCE = 0.1
+# how long after its parent a comment is posted, on average
+MEAN_REPLY_HOURS = 6.0
+
+
+class SyntheticRankable(object):
+    """ A news item or comment that hasn't been written yet. """
+    __slots__ = ('id', 'kind', 'poster_id', 'date_posted', 'dead', 'rating',
+            'ranking', 'num_comments', 'num_live_comments', 'parent_id',
+            'news_item_id', 'thread_path')
+
+    def __init__(self, id, kind, poster_id, date_posted, dead,
+            parent_id=None, news_item_id=None):
+        self.id = id
+        self.kind = kind
+        self.poster_id = poster_id
+        self.date_posted = date_posted
+        self.dead = dead
+        # everyone votes for what they post
+        self.rating = 1
+        self.ranking = 0.0
+        self.num_comments = 0
+        self.num_live_comments = 0
+        self.parent_id = parent_id
+        self.news_item_id = news_item_id
+        self.thread_path = ''
+
+
+class WeightedChooser(object):
+    """ Picks from a list of things, each with its own weight. """
+
+    def __init__(self, things, weights, rand):
+        self.things = things
+        self.rand = rand
+        self.totals = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.totals.append(total)
+
+    def choose(self):
+        """ Return one of the things, picked by weight. """
+        index = bisect.bisect_right(self.totals,
+                self.rand.random() * self.totals[-1])
+        return self.things[min(index, len(self.things) - 1)]
+
+
+def get_next_id(model):
+    """ Return the id after the biggest one in model's table. """
+    return (model.objects.aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+
+@transaction.commit_on_success
+def insert_batch(sql, rows):
+    """ Write rows with one executemany(), in a transaction. """
+    connection.cursor().executemany(sql, rows)
+    transaction.set_dirty()
+
+def bulk_insert(model, rows, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert rows (dictionaries mapping the attnames of model's fields to
+    values) into model's table, batch_size at a time.  Fields that
+    aren't given get their defaults.  The rows have to have their ids.
+    """
+    qn = connection.ops.quote_name
+    fields = model._meta.local_fields
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (qn(model._meta.db_table),
+            ', '.join([qn(field.column) for field in fields]),
+            ', '.join(['%s'] * len(fields)))
+    for i in range(0, len(rows), batch_size):
+        insert_batch(sql, [[field.get_db_prep_save(row.get(field.attname,
+                field.get_default())) for field in fields]
+                for row in rows[i:i + batch_size]])
+
+def reset_sequences(models):
+    """
+    Tell the database about the ids that were picked here, so the next
+    object it creates doesn't get one of them (postgres needs this).
+    """
+    cursor = connection.cursor()
+    for sql in connection.ops.sequence_reset_sql(no_style(), models):
+        cursor.execute(sql)
+    transaction.commit_unless_managed()
+
+def random_date(rand, start, end):
+    """ Return a random datetime between start and end. """
+    delta = end - start
+    seconds = rand.random() * (delta.days * 86400 + delta.seconds)
+    return start + datetime.timedelta(seconds=int(seconds))
+
+def generate_dataset(news_items, comments=None, users=None, votes=None,
+        seed=0, months=6, dead_fraction=0.05, end=None,
+        batch_size=DEFAULT_BATCH_SIZE, verbose=False):
+    """
+    Write made up data to the database (see the top of this file).  By
+    default there are ten comments and twenty votes for every news item,
+    and one user for every ten news items.  Everything is posted in the
+    months months before end (now if it isn't given).  Returns a
+    dictionary with lists of the userprofile_ids, news_item_ids and
+    comment_ids created, and the number of votes.
+    """
+    if comments is None:
+        comments = news_items * 10
+    if users is None:
+        users = max(1, news_items // 10)
+    if votes is None:
+        votes = news_items * 20
+    if end is None:
+        end = datetime.datetime.now().replace(microsecond=0)
+    start = end - datetime.timedelta(days=30 * months)
+    rand = random.Random(seed)
+
+    def say(message):
+        if verbose:
+            print message
+
+    # users
+    first_user_id = get_next_id(User)
+    first_profile_id = get_next_id(UserProfile)
+    user_rows = []
+    profile_rows = []
+    profile_ids = []
+    for i in range(users):
+        joined = start - datetime.timedelta(days=rand.randint(1, 365))
+        user_rows.append({'id': first_user_id + i,
+                'username': 'synthetic_%d' % (first_user_id + i),
+                'password': UNUSABLE_PASSWORD, 'last_login': joined,
+                'date_joined': joined})
+        profile_rows.append({'id': first_profile_id + i,
+                'user_id': first_user_id + i, 'date_created': joined,
+                'comment_points': 1000})
+        profile_ids.append(first_profile_id + i)
+    # some users post a lot more than others
+    poster_chooser = WeightedChooser(profile_ids,
+            [1.0 / (rank + 1) for rank in range(users)], rand)
+
+    # news items, in the order they were posted
+    next_id = get_next_id(Rankable)
+    rankables = []
+    dates = sorted([random_date(rand, start, end) for i in range(news_items)])
+    for date_posted in dates:
+        rankables.append(SyntheticRankable(next_id, 'news_item',
+                poster_chooser.choose(), date_posted,
+                rand.random() < dead_fraction))
+        next_id += 1
+    all_news_items = list(rankables)
+    asks = set([news_item.id for news_item in all_news_items
+            if rand.random() < ASK_CHANCE])
+
+    # comments, spread over the news items by a power law
+    thread_chooser = WeightedChooser(all_news_items,
+            [rand.paretovariate(THREAD_SIZE_ALPHA) for news_item in
+            all_news_items], rand)
+    threads = dict([(news_item.id, [news_item]) for news_item in
+            all_news_items])
+    for i in range(comments):
+        news_item = thread_chooser.choose()
+        thread = threads[news_item.id]
+        chance = rand.random()
+        if chance < REPLY_CHAIN_CHANCE:
+            parent = thread[-1]
+        elif chance < REPLY_CHAIN_CHANCE + TOP_LEVEL_CHANCE:
+            parent = news_item
+        else:
+            parent = rand.choice(thread)
+        date_posted = min(end, parent.date_posted + datetime.timedelta(
+                hours=rand.expovariate(1.0 / MEAN_REPLY_HOURS)))
+        comment = SyntheticRankable(next_id, 'comment',
+                poster_chooser.choose(), date_posted,
+                rand.random() < dead_fraction, parent.id, news_item.id)
+        next_id += 1
+        thread.append(comment)
+        rankables.append(comment)
+    by_id = dict([(rankable.id, rankable) for rankable in rankables])
+
+    # votes, by a Zipf distribution over the rankables in a random order
+    popular = list(rankables)
+    rand.shuffle(popular)
+    vote_chooser = WeightedChooser(popular, [1.0 / (rank + 1) **
+            VOTE_ZIPF_EXPONENT for rank in range(len(popular))], rand)
+    voted = set([(rankable.id, rankable.poster_id) for rankable in
+            rankables])
+    vote_rows = []
+    attempts = 0
+    while len(vote_rows) < votes and attempts < votes * 3 and rankables:
+        attempts += 1
+        rankable = vote_chooser.choose()
+        voter_id = rand.choice(profile_ids)
+        if (rankable.id, voter_id) in voted:
+            continue
+        voted.add((rankable.id, voter_id))
+        direction = 'up'
+        if rankable.kind == 'news_item' and \
+                rand.random() < DOWN_VOTE_CHANCE:
+            direction = 'down'
+        rankable.rating += direction == 'up' and 1 or -1
+        vote_rows.append({'rankable_id': rankable.id, 'userprofile_id':
+                voter_id, 'direction': direction, 'date_rated':
+                random_date(rand, rankable.date_posted, end)})
+
+    # rankings, comment counts and thread paths
+    rankings = calculate_rankings([rankable.rating for rankable in rankables],
+            hours_since([rankable.date_posted for rankable in rankables], end))
+    for rankable, ranking in zip(rankables, rankings):
+        rankable.ranking = ranking
+    # replies always come after their parents, so going backwards adds up
+    # each comment's counts before its parent's
+    for rankable in reversed(rankables):
+        if rankable.parent_id is not None:
+            parent = by_id[rankable.parent_id]
+            parent.num_comments += rankable.num_comments + 1
+            parent.num_live_comments += rankable.num_live_comments + \
+                    (not rankable.dead and 1 or 0)
+    if news_settings.NEWS_USE_COMMENT_PATHS:
+        for news_item_id, thread in threads.items():
+            children = {}
+            for comment in sorted(thread[1:],
+                    key=lambda comment: comment.date_posted, reverse=True):
+                children.setdefault(comment.parent_id, []).append(comment)
+            for comment_id, path in calculate_thread_paths(children,
+                    news_item_id).items():
+                by_id[comment_id].thread_path = path
+
+    # now write it all
+    say("Writing %d users" % users)
+    bulk_insert(User, user_rows, batch_size)
+    bulk_insert(UserProfile, profile_rows, batch_size)
+
+    say("Writing %d news items and %d comments" % (news_items, comments))
+    bulk_insert(Rankable, [{'id': rankable.id, 'kind': rankable.kind,
+            'poster_id': rankable.poster_id,
+            'date_posted': rankable.date_posted, 'dead': rankable.dead,
+            'rating': rankable.rating, 'ranking': rankable.ranking,
+            'last_ranked_date': end, 'num_comments': rankable.num_comments,
+            'num_live_comments': rankable.num_live_comments}
+            for rankable in rankables], batch_size)
+    news_item_rows = []
+    for news_item in all_news_items:
+        row = {'rankable_ptr_id': news_item.id,
+                'title': 'Synthetic news item %d' % news_item.id}
+        if news_item.id in asks:
+            row['text'] = 'Ask: synthetic question %d' % news_item.id
+        else:
+            row['url'] = 'http://example.com/synthetic/%d' % news_item.id
+            row['url_hash'] = hash_url(row['url'])
+        news_item_rows.append(row)
+    bulk_insert(NewsItem, news_item_rows, batch_size)
+    bulk_insert(Comment, [{'rankable_ptr_id': comment.id,
+            'text': 'Synthetic comment %d' % comment.id,
+            'parent_id': comment.parent_id,
+            'news_item_id': comment.news_item_id,
+            'thread_path': comment.thread_path}
+            for comment in rankables[news_items:]], batch_size)
+
+    say("Writing %d votes" % (len(rankables) + len(vote_rows)))
+    first_rated_id = get_next_id(Rated)
+    rated_rows = [{'rankable_id': rankable.id,
+            'userprofile_id': rankable.poster_id, 'direction': 'up',
+            'date_rated': rankable.date_posted} for rankable in rankables]
+    rated_rows.extend(vote_rows)
+    for i, row in enumerate(rated_rows):
+        row['id'] = first_rated_id + i
+    bulk_insert(Rated, rated_rows, batch_size)
+
+    reset_sequences([User, UserProfile, Rankable, Rated])
+
+    return {'userprofile_ids': profile_ids,
+            'news_item_ids': [news_item.id for news_item in all_news_items],
+            'comment_ids': [comment.id for comment in rankables[news_items:]],
+            'num_votes': len(vote_rows)}
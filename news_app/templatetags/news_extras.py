@@ -4,9 +4,16 @@ from django import template
 from django.template.defaultfilters import timesince as django_timesince
 from django.template.defaulttags import IfEqualNode
 from django.template import TemplateSyntaxError, Node, NodeList
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 
 from urlparse import urlparse
 
+from news.models import Rated
+from news.helpers import MAX_IN_CLAUSE_IDS
+from news.caching import get_thread_fragment_key, add_user_to_thread
+import news.conf as news_settings
+
 register = template.Library()
 
 @register.filter
@@ -261,8 +268,19 @@ class IfAlreadyVoted(Node):
     def render(self, context):
         rankable = self.var1.resolve(context, True)
         userprofile = self.var2.resolve(context, True)
-        if (self.negate and not rankable.already_voted(userprofile)) or \
-                (not self.negate and rankable.already_voted(userprofile)):
+        # Views that show a lot of rankables put the ids of the ones the 
+        # logged in user has voted on in 'voted_ids' (see 
+        # news.helpers.get_voted_ids), so we don't need a query here.
+        try:
+            voted_ids = context['voted_ids']
+        except KeyError:
+            voted_ids = None
+        if voted_ids is None:
+            already_voted = rankable.already_voted(userprofile)
+        else:
+            already_voted = rankable.id in voted_ids
+        if (self.negate and not already_voted) or \
+                (not self.negate and already_voted):
             return self.nodelist_true.render(context)
         return self.nodelist_false.render(context)
 
@@ -383,3 +401,72 @@ def ifnotcanpostcomment(parser, token):
     See ifcanpostcomment.
     """
     return do_ifcanpostcomment(parser, token, True)
+
+
+
+
+class CacheThreadNode(Node):
+    def __init__(self, news_item_id, path, nodelist):
+        self.news_item_id, self.path = news_item_id, path
+        self.nodelist = nodelist
+
+    def __repr__(self):
+        return "<CacheThreadNode>"
+
+    def render(self, context):
+        if not news_settings.NEWS_THREAD_CACHE_SECONDS:
+            return self.nodelist.render(context)
+
+        news_item_id = self.news_item_id.resolve(context, True)
+        path = self.path.resolve(context, True)
+        key = get_thread_fragment_key(news_item_id, path)
+        html = cache.get(key)
+        if html is None:
+            # render it the way someone who isn't logged in sees it, with 
+            # the bits that depend on the user marked
+            context.update({'user': AnonymousUser(), 'thread_fragment': True})
+            try:
+                html = self.nodelist.render(context)
+            finally:
+                context.pop()
+            cache.set(key, html, news_settings.NEWS_THREAD_CACHE_SECONDS)
+
+        comments = [com_data['comment'] for com_data in 
+                context.get('child_comments', [])]
+        user = context.get('user')
+        if user is None or not user.is_authenticated():
+            return add_user_to_thread(html, comments, None, None, path)
+
+        userprofile = user.get_profile()
+        voted_ids = context.get('voted_ids')
+        if voted_ids is None:
+            comment_ids = [com.id for com in comments]
+            voted_ids = set()
+            for i in range(0, len(comment_ids), MAX_IN_CLAUSE_IDS):
+                voted_ids.update(Rated.objects.filter(userprofile=userprofile,
+                        rankable__in=comment_ids[i:i + MAX_IN_CLAUSE_IDS]
+                        ).values_list('rankable', flat=True))
+        return add_user_to_thread(html, comments, userprofile, voted_ids, path)
+
+
+@register.tag
+def cachethread(parser, token):
+    """
+    Caches the thread of comments under the news item with the given id,
+    as it is shown on the page at the given path, until one of its 
+    comments changes (see news/caching.py).  The arrows and the edit and 
+    delete links are filled in for the logged in user each time.
+
+    Example::
+
+        {% cachethread thread_id next %}
+            ...
+        {% endcachethread %}
+    """
+    bits = list(token.split_contents())
+    if len(bits) != 3:
+        raise TemplateSyntaxError, "%r takes two arguments" % bits[0]
+    nodelist = parser.parse(('endcachethread',))
+    parser.delete_first_token()
+    return CacheThreadNode(parser.compile_filter(bits[1]), 
+            parser.compile_filter(bits[2]), nodelist)
@@ -3,20 +3,44 @@ This holds the unit tests for this app.
 """
 from django.core.urlresolvers import reverse
 from django.contrib.sessions.backends.db import SessionStore
-from django.http import QueryDict, Http404
-from django.test import TestCase
+from django.http import QueryDict, Http404, HttpRequest, HttpResponse
+from django.template import Template, Context
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase
+from django.db import transaction
+from django.utils import simplejson
 
 from urlparse import urlsplit
+import datetime, re
 
-from news.models import UserProfile, NewsItem, Comment
+from news.models import UserProfile, NewsItem, Comment, Rankable, \
+        RerankRequest, Rated, FrontpageSnapshot, FrontpageEntry
 from django.contrib.auth.models import User 
 from news.validation import valid_comment_text, valid_email, \
         valid_next_redirect, valid_password, valid_text, valid_title, \
         valid_url, valid_username
 from news.conf import *
 from news.helpers import get_frontpage_querymanager, get_child_comments, \
-        get_next_with_pages, datetime_ago, improve_url, assert_or_404
+        get_next_with_pages, datetime_ago, improve_url, assert_or_404, \
+        update_thread_paths, get_keyset_page, canonicalize_url, hash_url
+from news.ranking import ranking_for, calculate_rankings, hours_since, \
+        rerank_window, rerank_window_sql, RerankScheduler, queue_rerank, \
+        drain_rerank_queue, drain_rerank_queue_batch, filter_shard
+from news.votes import record_vote, record_votes, VOTED, ALREADY_VOTED, \
+        NOT_ENOUGH_POINTS, INVALID
+from news.caching import get_frontpage_ids, get_frontpage_page, \
+        refresh_frontpage_cache, invalidate_frontpage_cache, \
+        write_frontpage_snapshot, get_snapshot_page, SnapshotNewsItem, \
+        purge_thread_pages, bump_thread_version
 from news.views.news_items import check_submission
+from news.schema import get_hot_queries, find_full_scans
+from news.middleware import InstrumentationMiddleware, get_view_stats, \
+        reset_view_stats, get_current_stats
+from news.synthetic import generate_dataset
+from news.query_budgets import load_budget_file, seed_benchmark_data, \
+        get_routes, get_url_view_names, measure_routes, find_over_budget
+from news.replay import parse_access_log, build_request_mix, percentile, \
+        get_accounts, Report
 
 
 
@@ -37,9 +61,24 @@ class NewsBaseTestCase(TestCase):
 
     def setUp(self):
         """
-        Make sure no one is logged in.
+        Make sure no one is logged in, and that the frontpage isn't 
+        cached from another test.  Pages and threads aren't cached at 
+        all unless a test turns it on, because cached pages don't have a 
+        context and tests change comments behind the cache's back.
         """
         self.assertNotLoggedIn(self.client)
+        invalidate_frontpage_cache()
+        import news.conf
+        self.page_cache_seconds = news.conf.NEWS_PAGE_CACHE_SECONDS
+        self.thread_cache_seconds = news.conf.NEWS_THREAD_CACHE_SECONDS
+        news.conf.NEWS_PAGE_CACHE_SECONDS = 0
+        news.conf.NEWS_THREAD_CACHE_SECONDS = 0
+
+    def tearDown(self):
+        """ Put the cache settings back. """
+        import news.conf
+        news.conf.NEWS_PAGE_CACHE_SECONDS = self.page_cache_seconds
+        news.conf.NEWS_THREAD_CACHE_SECONDS = self.thread_cache_seconds
 
     def followRedirect(self, response, expected_url=None):
         """
@@ -200,6 +239,45 @@ class NewsCommentTests(NewsBaseTestCase):
         # make sure the page contains our new comment
         self.assert_(comment_text in redirect_response.content)
 
+    def testEditComment(self):
+        """ Test that editing a comment only changes its text. """
+        Comment.objects.filter(id=10).update(date_posted=datetime_ago())
+        self.login_user(self.client, 'ice', 'iceiceice', '/')
+        Rankable.objects.filter(id=10).update(rating=7)
+        response = self.client.post(reverse('news.views.comments.edit_comment',
+                args=(10,)), {'comment_text': 'edited text'})
+        self.assertEquals(response.status_code, 302)
+        com = Comment.objects.get(id=10)
+        self.assertEquals(com.text, 'edited text')
+        self.assertEquals(com.rating, 7)
+
+    def testSubmitCommentPoints(self):
+        """ Test that posting a comment only takes its cost off. """
+        import news.conf
+        cost = news.conf.NEWS_COST_RESPOND_NEWS_ITEM
+        news.conf.NEWS_COST_RESPOND_NEWS_ITEM = 2
+        try:
+            self.login_user(self.client, 'ice', 'iceiceice', '/')
+            submit_com_view = reverse('news.views.comments.submit_comment') 
+            UserProfile.objects.filter(user__username='ice').update(
+                    comment_points=3)
+            self.client.post(submit_com_view, 
+                    {'parent_id': 1, 'comment_text': 'abcdefghijklmnop'})
+            self.assertEquals(UserProfile.objects.get(
+                    user__username='ice').comment_points, 1)
+
+            # without enough points, nothing is posted
+            num_comments = Comment.objects.count()
+            response = self.client.post(submit_com_view, 
+                    {'parent_id': 1, 'comment_text': 'abcdefghijklmnop'})
+            self.assertEquals(self.client.session['comment_posting_error'],
+                    "Insufficient comment points")
+            self.assertEquals(Comment.objects.count(), num_comments)
+            self.assertEquals(UserProfile.objects.get(
+                    user__username='ice').comment_points, 1)
+        finally:
+            news.conf.NEWS_COST_RESPOND_NEWS_ITEM = cost
+
     def testSubmitComment(self):
         """
         Test comment submission functionality.
@@ -396,6 +474,24 @@ class NewsLoginTests(NewsBaseTestCase):
         self.assertUserLoggedIn(self.client, "ice")
 
 
+    def testEditUser(self):
+        """ Test that editing a profile doesn't write its comment points. """
+        self.login_user(self.client, 'ice', 'iceiceice', '/')
+        UserProfile.objects.filter(user__username='ice').update(
+                comment_points=123)
+        response = self.client.post(reverse('news.views.users.user', 
+                args=('ice',)), {'email_address': 'ice@example.com', 
+                'website': 'http://example.com/', 'about': 'about ice',
+                'option_show_dead': 'on'})
+        self.assertEquals(response.status_code, 302)
+        ice = UserProfile.objects.get(user__username='ice')
+        self.assertEquals((ice.website, ice.about, ice.user.email), 
+                ('http://example.com/', 'about ice', 'ice@example.com'))
+        self.assert_(ice.option_show_dead)
+        self.assertFalse(ice.option_show_email)
+        self.assertEquals(ice.comment_points, 123)
+
+
 class NewsValidationTests(NewsBaseTestCase):
     """ Test the validation of different fields. """
         
@@ -537,15 +633,327 @@ class NewsHelperTests(NewsBaseTestCase):
     def testGetChildComments(self):
         """ Test get_child_comments(). """
         newsitem = NewsItem.objects.get(id=1)
-        child_comments = get_child_comments(newsitem.child_set)
+        child_comments = get_child_comments(newsitem)
         for com_data in child_comments:
             self.assert_(com_data['comment'] in Comment.objects.all())
 
+        # every comment in the thread is there, at the right depth,
+        # and it comes after its parent
+        expected_depths = {4: 0, 5: 1, 6: 1, 10: 1, 7: 2, 11: 2, 8: 2, 9: 3}
+        self.assertEquals(len(child_comments), len(expected_depths))
+        seen = [newsitem.id]
+        for com_data in child_comments:
+            com = com_data['comment']
+            self.assertEquals(com_data['depth'], expected_depths[com.id])
+            self.assert_(com.parent_id in seen)
+            seen.append(com.id)
+
+        # the depth is relative to the comment we start from
+        com = Comment.objects.get(id=6)
+        self.assertEquals([(d['comment'].id, d['depth']) for d in
+                           get_child_comments(com, 1)], [(8, 1), (9, 2)])
+
+        # dead comments are left out, but their children are not
+        com.dead = True
+        com.save()
+        live_ids = [d['comment'].id for d in
+                    get_child_comments(newsitem, return_dead=False)]
+        self.assert_(6 not in live_ids)
+        self.assert_(8 in live_ids and 9 in live_ids)
+
+
+    def testGetChildCommentsByPath(self):
+        """ Test get_child_comments() with NEWS_USE_COMMENT_PATHS. """
+        import news.conf
+        newsitem = NewsItem.objects.get(id=1)
+        com = Comment.objects.get(id=5)
+        com.ranking = 10
+        com.save()
+
+        def thread(parent, **kwargs):
+            return [(d['comment'].id, d['depth']) for d in 
+                    get_child_comments(parent, **kwargs)]
+        expected = thread(newsitem)
+        expected_sub_thread = thread(com, depth=2)
+
+        use_comment_paths = news.conf.NEWS_USE_COMMENT_PATHS
+        news.conf.NEWS_USE_COMMENT_PATHS = True
+        try:
+            # it still works when the paths haven't been worked out
+            self.assertEquals(thread(newsitem), expected)
+
+            update_thread_paths(newsitem.id)
+            self.assertEquals(Comment.objects.get(id=4).thread_path, '000000')
+            self.assertEquals(Comment.objects.get(id=5).thread_path, 
+                              '000000000000')
+            self.assertEquals(thread(newsitem), expected)
+            self.assertEquals(thread(com, depth=2), expected_sub_thread)
+        finally:
+            news.conf.NEWS_USE_COMMENT_PATHS = use_comment_paths
+
+    def testGetVotedIds(self):
+        """ Test get_voted_ids(). """
+        news_item_view = reverse('news.views.news_items.news_item', args=(1,))
+
+        # nothing is looked up if no one is logged in
+        response = self.client.get(news_item_view)
+        self.assertEquals(response.context['voted_ids'], None)
+
+        # ice voted on the news item and some of the comments
+        self.login_user(self.client, 'ice', 'iceiceice', news_item_view)
+        response = self.client.get(news_item_view)
+        self.assertEquals(response.context['voted_ids'], set([1, 4, 5, 10, 11]))
+
+        # it is the same as asking each rankable
+        ice = UserProfile.objects.get(user__username='ice')
+        for com in Comment.objects.filter(news_item=1):
+            self.assertEquals(com.already_voted(ice), 
+                              com.id in response.context['voted_ids'])
+
+    def testFrontpageCache(self):
+        """ Test that the frontpage order is cached until it changes. """
+        NewsItem.objects.filter(id__in=[1, 2, 3]).update(
+                date_posted=datetime_ago(hours=1))
+        NewsItem.objects.filter(id=1).update(ranking=3)
+        NewsItem.objects.filter(id=2).update(ranking=2, dead=True)
+        NewsItem.objects.filter(id=3).update(ranking=1)
+        self.assertEquals(get_frontpage_ids(), [1, 3])
+        self.assertEquals(get_frontpage_ids(show_dead=True), [1, 2, 3])
+
+        # the lists stay the same until they are refreshed
+        NewsItem.objects.filter(id=3).update(ranking=4)
+        self.assertEquals(get_frontpage_ids(), [1, 3])
+        refresh_frontpage_cache()
+        self.assertEquals(get_frontpage_ids(), [3, 1])
+        self.assertEquals(get_frontpage_ids(show_dead=True), [3, 1, 2])
+
+        # the frontpage shows the cached order
+        response = self.client.get(reverse('news.views.news_items.index'))
+        self.assertEquals([item.id for item in
+                response.context['news_item_list']], [3, 1])
+
+        # deleted news items are left out until the list is refreshed
+        NewsItem.objects.filter(id=3).delete()
+        self.assertEquals([item.id for item in 
+                get_frontpage_page().object_list], [1])
+        invalidate_frontpage_cache()
+        self.assertEquals(get_frontpage_ids(), [1])
+
+    def testFrontpageSnapshot(self):
+        """ Test that the frontpage is read from the snapshot table. """
+        import news.conf
+        snapshot_seconds = news.conf.NEWS_FRONTPAGE_SNAPSHOT_SECONDS
+        snapshot_size = news.conf.NEWS_FRONTPAGE_SNAPSHOT_SIZE
+        news.conf.NEWS_FRONTPAGE_SNAPSHOT_SECONDS = 60
+        news.conf.NEWS_FRONTPAGE_SNAPSHOT_SIZE = 2
+        try:
+            NewsItem.objects.filter(id__in=[1, 2, 3]).update(
+                    date_posted=datetime_ago(hours=1))
+            NewsItem.objects.filter(id=1).update(ranking=3)
+            NewsItem.objects.filter(id=2).update(ranking=2, dead=True)
+            NewsItem.objects.filter(id=3).update(ranking=1)
+            write_frontpage_snapshot()
+            previous = write_frontpage_snapshot()
+            snapshot = write_frontpage_snapshot()
+            self.assertEquals((snapshot.num_live, snapshot.num_with_dead), 
+                    (2, 3))
+            # the one before the newest is kept too, for requests that 
+            # have just picked it
+            self.assertEquals([s.id for s in 
+                    FrontpageSnapshot.objects.order_by('id')], 
+                    [previous.id, snapshot.id])
+            self.assertEquals(FrontpageEntry.objects.count(), 8)
+            self.assertEquals(len(get_snapshot_page(previous).object_list), 
+                    2)
+            # a page past the end is left to the cached lists
+            self.assertEquals(get_snapshot_page(snapshot, page=9999), None)
+
+            # the frontpage shows the snapshot, not what changed since
+            NewsItem.objects.filter(id=1).update(title='changed title')
+            index = reverse('news.views.news_items.index')
+            response = self.client.get(index)
+            news_items = response.context['news_item_list']
+            self.assertEquals([item.id for item in news_items], [1, 3])
+            self.assert_(isinstance(news_items[0], SnapshotNewsItem))
+            self.assert_('changed title' not in response.content)
+            self.assert_(news_items[0].title in response.content)
+            self.assert_(reverse('news.views.users.user', 
+                    args=(news_items[0].poster.username,)) in 
+                    response.content)
+
+            first = get_frontpage_page(objs_per_page=1)
+            second = get_frontpage_page(after=first.next_token, 
+                    objs_per_page=1)
+            self.assertEquals([item.id for item in second.object_list], [3])
+            self.assert_(isinstance(second.object_list[0], SnapshotNewsItem))
+            self.assertFalse(second.has_next())
+
+            # pages past the end of the snapshot come from the cache
+            first = get_frontpage_page(show_dead=True, objs_per_page=2)
+            self.assertEquals([item.id for item in first.object_list], [1, 2])
+            second = get_frontpage_page(show_dead=True, 
+                    after=first.next_token, objs_per_page=2)
+            self.assertEquals([item.id for item in second.object_list], [3])
+            self.assert_(isinstance(second.object_list[0], NewsItem))
+
+            # a snapshot whose entries were deleted after it was picked
+            # doesn't give an empty page
+            FrontpageEntry.objects.filter(snapshot=previous).delete()
+            self.assertEquals(get_snapshot_page(previous), None)
+            first = get_frontpage_page(objs_per_page=1)
+            self.assertEquals(get_snapshot_page(previous, 
+                    after=first.next_token, objs_per_page=1), None)
+
+            # every page comes from the cache once the snapshot is too old
+            FrontpageSnapshot.objects.update(date_created=datetime_ago(
+                    hours=1))
+            self.assert_('changed title' in self.client.get(index).content)
+        finally:
+            news.conf.NEWS_FRONTPAGE_SNAPSHOT_SECONDS = snapshot_seconds
+            news.conf.NEWS_FRONTPAGE_SNAPSHOT_SIZE = snapshot_size
+
+    def testPageCache(self):
+        """ Test that pages are cached for people who aren't logged in. """
+        import news.conf
+        news.conf.NEWS_PAGE_CACHE_SECONDS = 60
+        news_item_view = reverse('news.views.news_items.news_item', args=(1,))
+        comment_view = reverse('news.views.comments.comment', args=(5,))
+        purge_thread_pages(Comment.objects.get(id=7))
+
+        # the second time, the view isn't run (so there's no context)
+        self.assert_(self.client.get(news_item_view).context)
+        self.assertEquals(self.client.get(news_item_view).context, None)
+        self.assert_(self.client.get(comment_view).context)
+        com = Comment.objects.get(id=7)
+        com.text = 'edited com4'
+        com.save()
+        self.assert_('edited com4' not in 
+                self.client.get(news_item_view).content)
+
+        # purging a comment's thread gets the new page 
+        purge_thread_pages(com)
+        self.assert_('edited com4' in self.client.get(news_item_view).content)
+        self.assert_('edited com4' in self.client.get(comment_view).content)
+
+        # logged in users always get a new page
+        self.login_user(self.client, 'ice', 'iceiceice', news_item_view)
+        self.assert_(self.client.get(news_item_view).context)
+        self.assert_(self.client.get(news_item_view).context)
+
+    def testThreadCache(self):
+        """ Test that threads are cached and filled in for each user. """
+        import news.conf
+        news.conf.NEWS_THREAD_CACHE_SECONDS = 300
+        news_item_view = reverse('news.views.news_items.news_item', args=(1,))
+        bump_thread_version(1)
+        Comment.objects.filter(id=10).update(date_posted=datetime_ago())
+
+        self.assert_('this is com2' in self.client.get(news_item_view).content)
+        Comment.objects.filter(id=5).update(text='edited com2')
+        content = self.client.get(news_item_view).content
+        self.assert_('this is com2' in content)
+        self.assert_('/edit_comment/' not in content)
+
+        # ice voted on 5 and can still edit 10
+        self.login_user(self.client, 'ice', 'iceiceice', news_item_view)
+        content = self.client.get(news_item_view).content
+        self.assert_('this is com2' in content)
+        self.assert_('id=5&amp;direction=up' not in content)
+        self.assert_('id=6&amp;direction=up' in content)
+        self.assert_(reverse('news.views.comments.edit_comment', args=(10,))
+                in content)
+        self.assert_(reverse('news.views.comments.edit_comment', args=(11,))
+                not in content)
+
+        # voting on a comment throws the thread away
+        ice = UserProfile.objects.get(id=1)
+        ice.comment_points = NEWS_COST_VOTE_NORMAL_COMMENT
+        ice.save()
+        self.assertEquals(record_vote(Comment.objects.get(id=6), ice, 'up'), 
+                VOTED)
+        content = self.client.get(news_item_view).content
+        self.assert_('edited com2' in content)
+        self.assert_('id=6&amp;direction=up' not in content)
+
+        # the filled in thread looks just like one rendered without the 
+        # cache (apart from the marks and whitespace)
+        def strip(content):
+            return re.sub(r'<!--.*?-->|\s+', '', content)
+        news.conf.NEWS_THREAD_CACHE_SECONDS = 0
+        self.assertEquals(strip(content), 
+                strip(self.client.get(news_item_view).content))
 
     def testGetNextWithPages(self):
         """ Test get_next_with_pages(). """
         self.assertEquals(get_next_with_pages('/', 1), '/')
         self.assertEquals(get_next_with_pages('/', 2), '%2F%3Fpage%3D2')
+        self.assertEquals(get_next_with_pages('/', 1, '4_5'), 
+                '%2F%3Fafter%3D4_5')
+
+    def testGetKeysetPage(self):
+        """ Test get_keyset_page() and the frontpage's keyset pages. """
+        # all the comments were posted in the same second, so the ids
+        # have to keep them in order
+        comments = Comment.objects.all()
+        expected = list(comments.order_by('-date_posted', '-id'))
+        pages = [get_keyset_page(comments, ['date_posted', 'id'], 
+                objs_per_page=3)]
+        while pages[-1].has_next():
+            pages.append(get_keyset_page(comments, ['date_posted', 'id'], 
+                    pages[-1].next_token, objs_per_page=3))
+        self.assertEquals([len(p.object_list) for p in pages], [3, 3, 2])
+        self.assertEquals([p.start_index() for p in pages], [1, 4, 7])
+        self.assertEquals(sum([p.object_list for p in pages], []), expected)
+
+        # page numbers still work, and bad tokens give the first page
+        self.assertEquals(get_keyset_page(comments, ['date_posted', 'id'], 
+                page=2, objs_per_page=3).object_list, expected[3:6])
+        self.assertEquals(get_keyset_page(comments, ['date_posted', 'id'], 
+                'x_y', objs_per_page=3).object_list, expected[:3])
+        # and a page past the end gives the last page
+        last_page = get_keyset_page(comments, ['date_posted', 'id'], 
+                page=9999, objs_per_page=3)
+        self.assertEquals(last_page.object_list, expected[6:])
+        self.assertEquals(last_page.start_index(), 7)
+        self.assertFalse(last_page.has_next())
+
+        # dates with microseconds (two of them the same) come back out of
+        # the token exactly, so no row is skipped or shown twice
+        posted = datetime_ago(hours=1).replace(microsecond=123456)
+        for i, com in enumerate(comments.order_by('id')):
+            Comment.objects.filter(id=com.id).update(date_posted=posted + 
+                    datetime.timedelta(microseconds=(i // 2) * 999))
+        expected = list(comments.order_by('-date_posted', '-id'))
+        pages = [get_keyset_page(comments, ['date_posted', 'id'], 
+                objs_per_page=1)]
+        while pages[-1].has_next():
+            pages.append(get_keyset_page(comments, ['date_posted', 'id'], 
+                    pages[-1].next_token, objs_per_page=1))
+        self.assertEquals(sum([p.object_list for p in pages], []), expected)
+
+        # the frontpage gives the same pages from the cache and without it
+        import news.conf
+        NewsItem.objects.update(date_posted=datetime_ago(hours=1))
+        for cache_seconds in (60, 0):
+            news.conf.NEWS_FRONTPAGE_CACHE_SECONDS = cache_seconds
+            try:
+                invalidate_frontpage_cache()
+                first = get_frontpage_page(objs_per_page=2)
+                self.assertEquals([item.id for item in first.object_list], 
+                        [3, 2])
+                second = get_frontpage_page(after=first.next_token, 
+                        objs_per_page=2)
+                self.assertEquals([item.id for item in second.object_list], 
+                        [1])
+                self.assertEquals(second.start_index(), 3)
+                self.assertFalse(second.has_next())
+                last_page = get_frontpage_page(page=9999, objs_per_page=2)
+                self.assertEquals([item.id for item in 
+                        last_page.object_list], [1])
+                self.assertEquals(last_page.start_index(), 3)
+            finally:
+                news.conf.NEWS_FRONTPAGE_CACHE_SECONDS = \
+                        NEWS_FRONTPAGE_CACHE_SECONDS
 
     def testDatetimeAgo(self):
         """ Test datetime_ago(). """
@@ -556,12 +964,664 @@ class NewsHelperTests(NewsBaseTestCase):
         self.assertEquals(improve_url('http://google.com'), 'http://google.com')
         self.assertEquals(improve_url('google.com'), 'http://google.com')
 
+    def testCanonicalizeURL(self):
+        """ Test canonicalize_url() and hash_url(). """
+        self.assertEquals(canonicalize_url('http://google.com'), 
+                'http://google.com')
+        for url in ('google.com', 'http://www.google.com/', 
+                'HTTP://Google.COM:80', 'http://google.com/#top',
+                'http://google.com/?utm_source=rss&utm_medium=feed'):
+            self.assertEquals(canonicalize_url(url), 'http://google.com')
+            self.assertEquals(hash_url(url), hash_url('http://google.com'))
+        self.assertEquals(canonicalize_url('http://google.com/a/?b=2&a=1'), 
+                'http://google.com/a?a=1&b=2')
+        self.assertNotEquals(hash_url('http://google.com/a'), 
+                hash_url('http://google.com/b'))
+        self.assertNotEquals(hash_url('http://google.com/?q=a'), 
+                hash_url('http://google.com/?q=b'))
+
     def testMyAssert(self):
         """ Test assert_or_404(). """
         self.assertRaises(Http404, assert_or_404, False)
         assert_or_404(True)
 
 
+class NewsSchemaTests(NewsBaseTestCase):
+    """ Test the database layout. """
+
+    def testHotQueriesUseIndexes(self):
+        """ Test that none of the hot queries read a whole table. """
+        # some more rows, so the database has a reason to use the indexes
+        bob = UserProfile.objects.get(id=2)
+        for i in range(50):
+            item = NewsItem.objects.create(poster=bob, title='item %d' % i,
+                    url='http://example.com/%d' % i)
+            Comment.objects.create(poster=bob, text='comment %d' % i, 
+                    parent=item)
+
+        for name, queryset in get_hot_queries():
+            self.assertEquals((name, find_full_scans(queryset)), (name, []))
+
+
+class NewsInstrumentationTests(NewsBaseTestCase):
+    """ Test the instrumentation middleware. """
+
+    def testInstrumentationMiddleware(self):
+        """ Test that queries and rendering are counted for each view. """
+        import news.conf
+        from news.views.news_items import index
+        debug = settings.DEBUG
+        repeated_query_limit = news.conf.NEWS_REPEATED_QUERY_LIMIT
+        settings.DEBUG = True
+        news.conf.NEWS_REPEATED_QUERY_LIMIT = 2
+        reset_view_stats()
+        try:
+            middleware = InstrumentationMiddleware()
+            request = HttpRequest()
+            middleware.process_request(request)
+            middleware.process_view(request, index, (), {})
+            # the same query three times, like a loop over news items
+            for news_item_id in (1, 2, 3):
+                NewsItem.objects.get(id=news_item_id)
+            Rated.objects.filter(rankable__in=[1, 2]).count()
+            Template('{{ x }}').render(Context({'x': 1}))
+            self.assertEquals(get_current_stats().num_queries, 4)
+            response = middleware.process_response(request, HttpResponse())
+
+            # nothing is counted after the response
+            self.assertEquals(get_current_stats(), None)
+            NewsItem.objects.get(id=1)
+
+            self.assertEquals(response['X-News-View'], 
+                    'news.views.news_items.index')
+            self.assertEquals(response['X-News-Queries'], '4')
+            self.assertEquals(response['X-News-Repeated-Queries'], '1')
+            self.assert_(response['X-News-Render-Time'].endswith('ms'))
+
+            stats = get_view_stats()['news.views.news_items.index']
+            self.assertEquals(stats['requests'], 1)
+            self.assertEquals(stats['queries'], 4)
+            self.assertEquals(stats['repeated'], 1)
+            self.assert_(stats['total_time'] >= stats['db_time'])
+
+            # no headers without DEBUG, but it still adds up the totals
+            settings.DEBUG = False
+            middleware.process_request(request)
+            middleware.process_view(request, index, (), {})
+            response = middleware.process_response(request, HttpResponse())
+            self.assert_('X-News-Queries' not in response)
+            self.assertEquals(
+                    get_view_stats()['news.views.news_items.index']['requests'],
+                    2)
+        finally:
+            settings.DEBUG = debug
+            news.conf.NEWS_REPEATED_QUERY_LIMIT = repeated_query_limit
+            reset_view_stats()
+
+
+class NewsReplayTests(NewsBaseTestCase):
+    """ Test making up and reading the requests for a replay. """
+
+    def testParseAccessLog(self):
+        """ Test that the GETs in an access log are read. """
+        lines = [
+            '1.2.3.4 - - [20/Jul/2009:10:00:00 -0700] "GET / HTTP/1.1" 200 5',
+            '1.2.3.4 - - [20/Jul/2009:10:00:01 -0700] '
+                '"GET http://example.com/news_item/2?x=1 HTTP/1.1" 200 5 '
+                '"-" "Mozilla/5.0"',
+            '1.2.3.4 - - [20/Jul/2009:10:00:02 -0700] '
+                '"GET /vote/?id=1&direction=up&next=/ HTTP/1.0" 302 0',
+            '1.2.3.4 - - [20/Jul/2009:10:00:03 -0700] '
+                '"POST /submit_comment/ HTTP/1.1" 302 0',
+            '1.2.3.4 - - [20/Jul/2009:10:00:04 -0700] "GET /logout/ HTTP/1.1" '
+                '302 0',
+            '1.2.3.4 - - [20/Jul/2009:10:00:05 -0700] "GET /nowhere HTTP/1.1" '
+                '404 0',
+            'not a log line',
+        ]
+        requests, num_skipped = parse_access_log(lines)
+        self.assertEquals(num_skipped, 3)
+        self.assertEquals([(request.route, request.path, request.logged_in)
+                for request in requests],
+                [('news.views.news_items.index', '/', False),
+                 ('news.views.news_items.news_item', '/news_item/2?x=1', 
+                     False),
+                 ('news.views.voting.vote', '/vote/?id=1&direction=up&next=/',
+                     True),
+                 ('unknown', '/nowhere', False)])
+
+    def testBuildRequestMix(self):
+        """ Test that made up requests go to things that are there. """
+        requests = build_request_mix(300, seed=1)
+        self.assertEquals(len(requests), 300)
+        self.assertEquals([request.path for request in requests],
+                [request.path for request in build_request_mix(300, seed=1)])
+
+        routes = set()
+        for request in requests:
+            routes.add(request.route)
+            self.assertEquals(request.logged_in, request.route in (
+                    'news.views.voting.vote', 'news.views.voting.vote_batch',
+                    'news.views.comments.submit_comment'))
+            if request.route == 'news.views.news_items.news_item':
+                NewsItem.objects.get(id=request.path.split('/')[-1])
+            elif request.route == 'news.views.voting.vote':
+                Rankable.objects.get(id=request.params['id'])
+            elif request.route == 'news.views.comments.submit_comment':
+                self.assertEquals(request.method, 'POST')
+                Rankable.objects.get(id=request.params['parent_id'])
+        self.assert_('news.views.news_items.index' in routes)
+        self.assert_('news.views.comments.submit_comment' in routes)
+
+        # without comments there is nothing to vote on
+        Comment.objects.all().delete()
+        self.assertEquals([request for request in build_request_mix(100)
+                if request.route == 'news.views.voting.vote'], [])
+
+    def testReport(self):
+        """ Test the percentiles and the accounts for logging in. """
+        self.assertEquals(percentile([], 50), None)
+        self.assertEquals(percentile([1], 99), 1)
+        values = range(1, 101)
+        self.assertEquals(percentile(values, 50), 50)
+        self.assertEquals(percentile(values, 90), 90)
+        self.assertEquals(percentile(values, 100), 100)
+
+        report = Report()
+        for latency in (0.1, 0.2, 0.3):
+            report.record('front', 200, latency)
+        report.record('front', 500, 0.4)
+        report.record('vote', None, 1.0)
+        report.elapsed = 2.0
+        stats = dict(report.get_route_stats())
+        self.assertEquals(stats['front']['requests'], 4)
+        self.assertEquals(stats['front']['errors'], 1)
+        self.assertEquals(stats['front']['per_second'], 2.0)
+        self.assertEquals(stats['front']['p50_ms'], 200)
+        self.assertEquals(stats['vote']['errors'], 1)
+        self.assert_('5 requests in 2.0 seconds' in report.format())
+
+        accounts = get_accounts(2)
+        self.assertEquals(accounts, get_accounts(2))
+        for username, password in accounts:
+            self.assert_(self.client.login(username=username, 
+                password=password))
+
+
+class NewsSyntheticTests(TestCase):
+    """ Test the made up data generator. """
+
+    def testGenerateDataset(self):
+        """ Test that generate_dataset() makes consistent data. """
+        import news.conf
+        use_comment_paths = news.conf.NEWS_USE_COMMENT_PATHS
+        news.conf.NEWS_USE_COMMENT_PATHS = True
+        try:
+            end = datetime.datetime(2009, 7, 20)
+            dataset = generate_dataset(30, users=10, seed=3, end=end, 
+                    dead_fraction=0.2, batch_size=7)
+            # the same seed makes the same data, with new ids
+            again = generate_dataset(30, users=10, seed=3, end=end,
+                    dead_fraction=0.2)
+        finally:
+            news.conf.NEWS_USE_COMMENT_PATHS = use_comment_paths
+
+        self.assertEquals(len(dataset['userprofile_ids']), 10)
+        self.assertEquals(len(dataset['news_item_ids']), 30)
+        self.assertEquals(len(dataset['comment_ids']), 300)
+        self.assertEquals(Rated.objects.filter(rankable__in=
+                dataset['news_item_ids'] + dataset['comment_ids']).count(),
+                330 + dataset['num_votes'])
+        self.assert_(Rankable.objects.filter(dead=True).count() > 0)
+        self.assertEquals(Rankable.objects.filter(id__in=
+                dataset['news_item_ids'] + dataset['comment_ids'],
+                date_posted__gt=end).count(), 0)
+
+        offset = again['news_item_ids'][0] - dataset['news_item_ids'][0]
+        first = Rankable.objects.filter(id__in=dataset['comment_ids']
+                ).order_by('id').values_list('rating', 'dead', 'num_comments')
+        second = Rankable.objects.filter(id__in=again['comment_ids']
+                ).order_by('id').values_list('rating', 'dead', 'num_comments')
+        self.assertEquals(list(first), list(second))
+        self.assertEquals([id + offset for id in Comment.objects.filter(
+                id__in=dataset['comment_ids']).order_by('id').values_list(
+                'parent', flat=True)], list(Comment.objects.filter(
+                id__in=again['comment_ids']).order_by('id').values_list(
+                'parent', flat=True)))
+
+        for news_item in NewsItem.objects.filter(
+                id__in=dataset['news_item_ids']):
+            thread = Comment.objects.filter(news_item=news_item)
+            self.assertEquals(news_item.num_comments, thread.count())
+            self.assertEquals(news_item.num_live_comments, 
+                    thread.filter(dead=False).count())
+            # the paths are the same as the ones update_thread_paths() makes
+            paths = list(thread.order_by('id').values_list('thread_path'))
+            update_thread_paths(news_item.id)
+            self.assertEquals(paths, 
+                    list(thread.order_by('id').values_list('thread_path')))
+
+        for rankable in Rankable.objects.filter(id__in=dataset['comment_ids']):
+            ups = Rated.objects.filter(rankable=rankable, direction='up')
+            downs = Rated.objects.filter(rankable=rankable, direction='down')
+            self.assertEquals(rankable.rating, ups.count() - downs.count())
+
+        # new objects don't get the ids that were used
+        user = User.objects.create_user('after', '', 'after')
+        self.assert_(UserProfile.objects.create(user=user).id > 
+                max(again['userprofile_ids']))
+
+
+class NewsQueryBudgetTests(TestCase):
+    """
+    Test that every url stays within its query budget (see 
+    news/query_budgets.py).  This doesn't use the fixtures, so the 
+    database is the same as when the budgets were written.
+    """
+
+    def testQueryBudgets(self):
+        """ 
+        Test that no url runs more queries than its budget, or returns a
+        different status.
+        """
+        budget_file = load_budget_file()
+        data = seed_benchmark_data(**dict([(str(key), value)
+                for key, value in budget_file['dataset'].items()]))
+
+        # every url gets measured
+        measured = set([view_name for view_name, method, path, params in 
+                get_routes(data)])
+        self.assertEquals(set(get_url_view_names()) - measured, set())
+
+        results = measure_routes(data)
+        self.assertEquals(find_over_budget(results, budget_file['budgets'], 
+                budget_file['statuses']), [])
+
+        # a url that returns something else (like a 404) fails, even 
+        # though it runs fewer queries
+        self.assertEquals(len(find_over_budget([('index anonymous', 
+                {'status': 404, 'queries': 0})], {'index anonymous': 5}, 
+                {'index anonymous': 200})), 1)
+
+
+class NewsModelTests(NewsBaseTestCase):
+    """ Test the models. """
+
+    def testCommentNewsItem(self):
+        """ Test that comments know what news item they are posted to. """
+        newsitem = NewsItem.objects.get(id=1)
+        deep_com = Comment.objects.get(id=9)
+        self.assertEquals(deep_com.get_newsitem(), newsitem)
+        self.assertEquals(deep_com.get_parent_news_item(), newsitem)
+
+        # news_item is filled in when a comment is posted
+        com = Comment.objects.create(poster=deep_com.poster, text='reply',
+                parent=deep_com)
+        self.assertEquals(com.news_item_id, newsitem.id)
+        self.assertEquals(com.find_newsitem(), newsitem)
+
+        # it still works if news_item hasn't been filled in
+        com.news_item = None
+        self.assertEquals(com.get_newsitem(), newsitem)
+
+    def testRankableKind(self):
+        """ Test that rankables know whether they are news items or comments. """
+        newsitem = NewsItem.objects.get(id=1)
+        self.assertEquals(Rankable.objects.get(id=1).kind, 'news_item')
+        self.assertEquals(Rankable.objects.get(id=4).kind, 'comment')
+
+        rankable = Rankable.objects.get(id=4)
+        self.assert_(rankable.is_comment())
+        self.assertFalse(rankable.is_news_item())
+        self.assertEquals(rankable.downcast(), Comment.objects.get(id=4))
+        self.assert_(isinstance(rankable.downcast(), Comment))
+        self.assert_(isinstance(Rankable.objects.get(id=1).downcast(), NewsItem))
+        self.assert_(newsitem.downcast() is newsitem)
+
+        # kind is filled in when a news item or comment is posted
+        com = Comment.objects.create(poster=newsitem.poster, text='reply',
+                parent=newsitem)
+        self.assertEquals(Rankable.objects.get(id=com.id).kind, 'comment')
+        item = NewsItem.objects.create(poster=newsitem.poster, title='title',
+                url='http://example.com')
+        self.assertEquals(Rankable.objects.get(id=item.id).kind, 'news_item')
+
+        # rankables without a kind still work
+        Rankable.objects.filter(id__in=[1, 4]).update(kind='')
+        self.assert_(Rankable.objects.get(id=1).is_news_item())
+        self.assert_(Rankable.objects.get(id=4).is_comment())
+        self.assertEquals(Rankable.objects.get(id=4).get_parent_news_item(),
+                newsitem)
+
+    def testCommentCounts(self):
+        """ Test that the comment counts are kept up to date. """
+        def counts():
+            return [(r.num_comments, r.num_live_comments) for r in
+                    Rankable.objects.filter(id__in=[1, 4, 6, 8]).order_by('id')]
+
+        self.assertEquals(counts(), [(8, 8), (7, 7), (2, 2), (1, 1)])
+        self.assertEquals(NewsItem.objects.get(id=1).num_child_comments(), 8)
+        self.assert_(Comment.objects.get(id=8).has_nondead_children())
+        self.assert_(not Comment.objects.get(id=9).has_children())
+
+        # posting a comment adds it to everything above it
+        deep_com = Comment.objects.get(id=9)
+        self.assertEquals(deep_com.get_ancestor_ids(), [8, 6, 4, 1])
+        com = Comment.objects.create(poster=deep_com.poster, text='reply',
+                parent=deep_com)
+        self.assertEquals(counts(), [(9, 9), (8, 8), (3, 3), (2, 2)])
+        self.assert_(Comment.objects.get(id=9).has_children())
+
+        # killing it only takes it off the live counts, and only once
+        self.assert_(com.kill())
+        self.assert_(not Comment.objects.get(id=com.id).kill())
+        self.assertEquals(counts(), [(9, 8), (8, 7), (3, 2), (2, 1)])
+        self.assert_(Comment.objects.get(id=9).has_children())
+        self.assert_(not Comment.objects.get(id=9).has_nondead_children())
+
+
+class NewsRankingTests(NewsBaseTestCase):
+    """ Test updating the rankings in bulk. """
+
+    def testCalculateRankings(self):
+        """ Test that the bulk rankings match Rankable.calculate_ranking(). """
+        self.assertEquals(calculate_rankings([], []), [])
+        self.assertEquals(calculate_rankings([1, 5], [0, 10]),
+                [ranking_for(1, 0), ranking_for(5, 10)])
+
+        rankable = Rankable.objects.get(id=1)
+        now = datetime.datetime.now()
+        bulk_ranking = calculate_rankings([rankable.rating],
+                hours_since([rankable.date_posted], now))[0]
+        self.assertAlmostEqual(bulk_ranking, rankable.calculate_ranking(), 4)
+
+    def testRerankWindow(self):
+        """ Test updating all the recent rankings at once. """
+        recent = datetime_ago(hours=3)
+        Rankable.objects.filter(id__in=[1, 4]).update(date_posted=recent,
+                ranking=-1)
+        Rankable.objects.exclude(id__in=[1, 4]).update(
+                date_posted=datetime_ago(weeks=5), ranking=-1)
+
+        self.assertEquals(rerank_window(weeks=4, batch_size=1), 2)
+
+        for rankable in Rankable.objects.filter(id__in=[1, 4]):
+            self.assertAlmostEqual(rankable.ranking,
+                    rankable.calculate_ranking(), 4)
+            self.assert_(rankable.last_ranked_date > recent)
+        # old rankables aren't touched
+        self.assertEquals(Rankable.objects.filter(ranking=-1).count(),
+                Rankable.objects.count() - 2)
+
+    def testRerankWindowSql(self):
+        """ Test updating all the recent rankings with one UPDATE. """
+        Rankable.objects.filter(id__in=[1, 4]).update(
+                date_posted=datetime_ago(hours=3), rating=5, ranking=-1)
+        Rankable.objects.exclude(id__in=[1, 4]).update(
+                date_posted=datetime_ago(weeks=5), ranking=-1)
+
+        self.assertEquals(rerank_window_sql(weeks=4), 2)
+
+        for rankable in Rankable.objects.filter(id__in=[1, 4]):
+            self.assertAlmostEqual(rankable.ranking,
+                    rankable.calculate_ranking(), 3)
+        self.assertEquals(Rankable.objects.filter(ranking=-1).count(),
+                Rankable.objects.count() - 2)
+
+
+    def testUpdateRanking(self):
+        """ Test that update_ranking() only writes the ranking. """
+        rankable = Rankable.objects.get(id=4)
+        # a vote that happens after rankable was loaded
+        Rankable.objects.filter(id=4).update(rating=rankable.rating + 5)
+        rankable.update_ranking()
+        self.assertEquals(Rankable.objects.get(id=4).rating, 
+                rankable.rating + 5)
+        self.assertEquals(Rankable.objects.get(id=4).ranking, 
+                rankable.ranking)
+
+    def testRerankScheduler(self):
+        """ Test that the rankings that have drifted most are updated first. """
+        Rankable.objects.update(date_posted=datetime_ago(weeks=5), ranking=0)
+        Rankable.objects.filter(id=1).update(date_posted=datetime_ago(days=3),
+                rating=10)
+        Rankable.objects.filter(id=2).update(date_posted=datetime_ago(hours=1),
+                rating=10)
+        Rankable.objects.filter(id=3).update(date_posted=datetime_ago(hours=1),
+                rating=10, dead=True)
+        # this one hasn't been voted on, so its ranking is already right
+        Rankable.objects.filter(id=4).update(date_posted=datetime_ago(hours=1),
+                rating=1)
+
+        scheduler = RerankScheduler(weeks=4, min_drift=0.0001)
+        self.assertEquals(scheduler.rerank_next(), 2)
+        self.assertEquals(scheduler.rerank_next(), 1)
+        self.assertEquals(scheduler.rerank_next(), None)
+
+        rankable = Rankable.objects.get(id=2)
+        self.assertAlmostEqual(rankable.ranking, rankable.calculate_ranking(), 3)
+
+        # once they are up to date, nothing needs re-ranking
+        scheduler.refresh()
+        self.assertEquals(scheduler.heap, [])
+
+
+    def testRerankQueue(self):
+        """ Test that queued reranks are done once for each rankable. """
+        Rankable.objects.filter(id__in=[1, 2]).update(
+                date_posted=datetime_ago(hours=3), rating=5, ranking=-1)
+        for rankable_id in (1, 1, 1, 2):
+            queue_rerank(rankable_id)
+
+        self.assertEquals(drain_rerank_queue_batch(batch_size=2), (2, set([1])))
+        self.assertEquals(drain_rerank_queue(batch_size=2), (2, set([1, 2])))
+        self.assertEquals(RerankRequest.objects.count(), 0)
+        self.assertEquals(drain_rerank_queue(), (0, set()))
+        for rankable in Rankable.objects.filter(id__in=[1, 2]):
+            self.assertAlmostEqual(rankable.ranking,
+                    rankable.calculate_ranking(), 3)
+
+    def testRerankShards(self):
+        """ Test that the shards split up the rankables between them. """
+        Rankable.objects.update(date_posted=datetime_ago(hours=3), rating=5,
+                ranking=-1)
+        ids = list(Rankable.objects.values_list('id', flat=True))
+        shards = [(index, 3) for index in range(3)]
+        shard_ids = [set(filter_shard(Rankable.objects.all(), 
+                shard).values_list('id', flat=True)) for shard in shards]
+        self.assertEquals(sorted(shard_ids[0] | shard_ids[1] | shard_ids[2]),
+                sorted(ids))
+        self.assertEquals(sum([len(s) for s in shard_ids]), len(ids))
+        self.assertEquals(shard_ids[1], set([i for i in ids if i % 3 == 1]))
+
+        # each shard only re-ranks its own rankables
+        self.assertEquals(rerank_window(weeks=4, shard=shards[0]),
+                len(shard_ids[0]))
+        self.assertEquals(rerank_window_sql(weeks=4, shard=shards[1]),
+                len(shard_ids[1]))
+        self.assertEquals(set(Rankable.objects.filter(ranking=-1
+                ).values_list('id', flat=True)), shard_ids[2])
+        self.assert_(RerankScheduler(weeks=4, shard=shards[2]
+                ).rerank_next() in shard_ids[2])
+
+        # and only takes the requests for them off the queue
+        for rankable_id in ids:
+            queue_rerank(rankable_id)
+        num_requests, rankable_ids = drain_rerank_queue(shard=shards[2])
+        self.assertEquals(rankable_ids, shard_ids[2])
+        self.assertEquals(set(RerankRequest.objects.values_list('rankable',
+                flat=True)), shard_ids[0] | shard_ids[1])
+
+    def testRestartShards(self):
+        """ Test that dead shards are started again, even if none are left. """
+        import os, time
+        from news.scripts.update_ranking import restart_shards, \
+                RESTART_SECONDS
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        started_indexes = []
+        pids = {pid: 0}
+        started = {0: time.time() - RESTART_SECONDS}
+        waiting = {}
+        while pids:
+            restart_shards(pids, started, waiting, started_indexes.append,
+                    daemonize=True)
+        self.assertEquals(started_indexes, [0])
+        self.assertEquals(waiting, {})
+
+        # with no children at all, the ones waiting still get started
+        waiting[1] = time.time()
+        restart_shards({}, started, waiting, started_indexes.append,
+                daemonize=True)
+        self.assertEquals(started_indexes, [0, 1])
+        self.assertEquals(waiting, {})
+
+    def testVoteQueuesRerank(self):
+        """ Test that voting puts the rankable in the rerank queue. """
+        self.login_user(self.client, 'bob', 'bobbobbob', '/')
+        self.client.get(reverse('news.views.voting.vote'),
+                {'id': 1, 'direction': 'up', 'next': '/'})
+        self.assertEquals(Rankable.objects.get(id=1).rating, 2)
+        self.assertEquals(list(RerankRequest.objects.values_list('rankable',
+                flat=True)), [1])
+
+
+    def testViewQueuesRerank(self):
+        """ Test that looking at a news item doesn't write to it. """
+        import news.ranking
+        news.ranking._view_rerank_times.clear()
+        # whole seconds, so it reads back from the database exactly
+        ranked_date = datetime_ago(hours=1).replace(microsecond=0)
+        Rankable.objects.filter(id=1).update(last_ranked_date=ranked_date)
+        news_item_view = reverse('news.views.news_items.news_item', args=(1,))
+
+        # the ranking is old, so it gets queued, but only once
+        self.client.get(news_item_view)
+        self.client.get(news_item_view)
+        self.assertEquals(list(RerankRequest.objects.values_list('rankable',
+                flat=True)), [1])
+        self.assertEquals(Rankable.objects.get(id=1).last_ranked_date,
+                ranked_date)
+
+        # a ranking that was just updated doesn't get queued
+        drain_rerank_queue()
+        news.ranking._view_rerank_times.clear()
+        self.client.get(news_item_view)
+        self.assertEquals(RerankRequest.objects.count(), 0)
+
+
+class NewsPurgeTests(TransactionTestCase):
+    """
+    Test that cached pages are only purged once the change is committed,
+    so a request in between can't cache the old page again.  This needs
+    real transactions.
+    """
+    fixtures = ['test_fixtures.json']
+
+    def testPurgeAfterCommit(self):
+        """ Test that nothing is left to commit when pages are purged. """
+        import news.views.comments, news.views.rankables
+        dirty = []
+        def purge_thread_pages(comment):
+            dirty.append(transaction.is_dirty())
+        old_purges = (news.views.comments.purge_thread_pages,
+                news.views.rankables.purge_thread_pages)
+        news.views.comments.purge_thread_pages = purge_thread_pages
+        news.views.rankables.purge_thread_pages = purge_thread_pages
+        try:
+            UserProfile.objects.filter(user__username='ice').update(
+                    comment_points=100)
+            self.assert_(self.client.login(username='ice', 
+                    password='iceiceice'))
+            self.client.post(reverse('news.views.comments.submit_comment'),
+                    {'parent_id': 1, 'comment_text': 'abcdefghijklmnop'})
+            com = Comment.objects.get(text='abcdefghijklmnop')
+            self.client.post(reverse('news.views.comments.edit_comment',
+                    args=(com.id,)), {'comment_text': 'edited text'})
+            self.client.post(reverse('news.views.rankables.delete_rankable',
+                    args=(com.id,)), {'submitvalue': 'yes'})
+        finally:
+            (news.views.comments.purge_thread_pages, 
+                    news.views.rankables.purge_thread_pages) = old_purges
+        self.assertEquals(dirty, [False, False, False])
+        self.assert_(Comment.objects.get(id=com.id).dead)
+
+
+class NewsVoteTests(TransactionTestCase):
+    """ 
+    Test recording votes.  record_vote() rolls back its transaction
+    when a vote can't be recorded, so this needs real transactions.
+    """
+    fixtures = ['test_fixtures.json']
+
+    def testRecordVote(self):
+        """ Test that votes are only counted once and cost comment points. """
+        UserProfile.objects.filter(id=2).update(comment_points=1)
+        bob = UserProfile.objects.get(id=2)
+        com = Comment.objects.get(id=4)
+        rating = com.rating
+        self.assertEquals(com.vote_cost(bob), NEWS_COST_VOTE_NORMAL_COMMENT)
+
+        self.assertEquals(record_vote(com, bob, 'up'), VOTED)
+        self.assertEquals(record_vote(com, bob, 'up'), ALREADY_VOTED)
+        self.assertEquals(Rankable.objects.get(id=4).rating, rating + 1)
+        self.assertEquals(Rated.objects.filter(rankable=4,
+                userprofile=bob).count(), 1)
+        self.assertEquals(UserProfile.objects.get(id=2).comment_points,
+                1 - NEWS_COST_VOTE_NORMAL_COMMENT)
+        self.assertEquals(list(RerankRequest.objects.values_list('rankable',
+                flat=True)), [4])
+
+        # bob has no points left, so nothing changes
+        rating = Rankable.objects.get(id=5).rating
+        self.assertEquals(record_vote(Comment.objects.get(id=5), bob, 'up'),
+                NOT_ENOUGH_POINTS)
+        self.assertEquals(Rated.objects.filter(rankable=5,
+                userprofile=bob).count(), 0)
+        self.assertEquals(Rankable.objects.get(id=5).rating, rating)
+
+        # news items can be voted down
+        news_item = NewsItem.objects.get(id=2)
+        self.assertEquals(record_vote(news_item, bob, 'down'), VOTED)
+        self.assertEquals(Rankable.objects.get(id=2).rating, 
+                news_item.rating)
+
+    def testRecordVotes(self):
+        """ Test recording a lot of votes at once. """
+        UserProfile.objects.filter(id=1).update(
+                comment_points=NEWS_COST_VOTE_NORMAL_COMMENT)
+        ice = UserProfile.objects.get(id=1)
+        results = record_votes(ice, [(3, 'down'), (6, 'up'), (7, 'up'),
+                (4, 'up'), (8, 'down'), (1000, 'up'), (3, 'up')])
+        # ice already voted on 4 and can only pay for one comment vote
+        self.assertEquals(results, {3: VOTED, 6: VOTED, 
+                7: NOT_ENOUGH_POINTS, 4: ALREADY_VOTED, 8: INVALID, 
+                1000: INVALID})
+        self.assertEquals(Rankable.objects.get(id=3).rating, 0)
+        self.assertEquals(Rankable.objects.get(id=6).rating, 2)
+        self.assertEquals(Rankable.objects.get(id=7).rating, 1)
+        self.assertEquals(Rated.objects.filter(userprofile=ice).count(), 8)
+        self.assertEquals(UserProfile.objects.get(id=1).comment_points, 0)
+        self.assertEquals(ice.comment_points, 0)
+        self.assertEquals(sorted(RerankRequest.objects.values_list(
+                'rankable', flat=True)), [3, 6])
+
+        # the view does the same thing for logged in users
+        vote_batch_view = reverse('news.views.voting.vote_batch')
+        response = self.client.post(vote_batch_view, {'votes': ['7:up']})
+        self.assertEquals(response.status_code, 403)
+        self.client.login(username='ice', password='iceiceice')
+        response = self.client.post(vote_batch_view, 
+                {'votes': ['6:up', '2:down']})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(simplejson.loads(response.content), 
+                {'results': {'6': ALREADY_VOTED, '2': ALREADY_VOTED}, 
+                 'comment_points': 0})
+        response = self.client.post(vote_batch_view, {'votes': ['x:up']})
+        self.assertEquals(response.status_code, 404)
+
+
 class NewsNewsItemTests(NewsBaseTestCase):
     """ Test the news item views. """
 
@@ -593,5 +1653,27 @@ class NewsNewsItemTests(NewsBaseTestCase):
                 check_submission('title', 'http:/google.com', ''),
                 'URL not valid')
 
+    def testSubmitDuplicateURL(self):
+        """ Test that submitting a url that is already posted votes on it. """
+        submit_view = reverse('news.views.news_items.submit')
+        index_view = reverse('news.views.news_items.index')
+        self.login_user(self.client, 'ice', 'iceiceice', index_view)
+        num_news_items = NewsItem.objects.count()
+
+        # the same as news item 1 (http://google.com), once it's cleaned up
+        response = self.client.post(submit_view, {'title': 'google again', 
+                'url': 'WWW.Google.com/?utm_source=feed', 'text': ''})
+        self.assertEquals(response.status_code, 302)
+        self.assert_('id=1&' in response['Location'])
+        self.assertEquals(NewsItem.objects.count(), num_news_items)
+
+        # a different page on the same site is a new news item
+        response = self.client.post(submit_view, {'title': 'google search', 
+                'url': 'http://google.com/search?q=news', 'text': ''})
+        self.assertEquals(NewsItem.objects.count(), num_news_items + 1)
+        news_item = NewsItem.objects.order_by('-id')[0]
+        self.assertEquals(news_item.url_hash, 
+                hash_url('http://www.google.com/search/?q=news#top'))
+
 
 
@@ -22,6 +22,7 @@ urlpatterns = patterns('news.views',
     (r'^change_password/?$', 'login.change_password'),
 
     (r'^vote/?$', 'voting.vote'),
+    (r'^vote_batch/?$', 'voting.vote_batch'),
 
     (r'^buy_points/?$', 'payment.buy_points'),
     (r'^receive_ipn/?$', include('paypal.standard.ipn.urls')),
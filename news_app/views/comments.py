@@ -7,10 +7,17 @@ from django.http import HttpResponseRedirect, HttpResponse
 from django.shortcuts import render_to_response
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
+from django.db import transaction
+from django.db.models import F
 
-from news.models import NewsItem, Comment, Rated, Rankable
+import news.conf as news_settings
+
+from news.models import NewsItem, Comment, Rated, Rankable, UserProfile
 from news.helpers import get_child_comments, assert_or_404, \
-    get_paginator_page, get_pagenum, get_next_with_pages
+    get_keyset_page, get_pagenum, get_next_with_pages, \
+    update_thread_paths, get_voted_ids, get_in_order
+from news.ranking import queue_rerank, rerank_from_view
+from news.caching import cache_page_for_anonymous, purge_thread_pages
 from news.validation import valid_comment_text, valid_next_redirect
 from news.shortcuts import get_object_or_404, \
     get_from_POST_or_404, get_from_session, del_from_session
@@ -22,32 +29,44 @@ def new_comments(request):
 
     Only responds to GETs.
     """
-    querymanager = Comment.objects.filter(dead=False).order_by('-date_posted')
+    # This goes through Rankable, so the database can use the index on
+    # (kind, date_posted) for the whole thing.
+    querymanager = Rankable.objects.filter(kind='comment', dead=False)
     page = get_pagenum(request)
-    latest_page = get_paginator_page(querymanager, page)
+    after = request.GET.get('after')
+    latest_page = get_keyset_page(querymanager, ['date_posted', 'id'], 
+            after, page)
+    # the list shows each comment's parent and news item too
+    latest_page.object_list = get_in_order(Comment, 
+            [rankable.id for rankable in latest_page.object_list],
+            related=('poster__user', 'parent', 'news_item'))
 
     header = 'New Comments'
 
     this = reverse('news.views.comments.new_comments')
-    next = get_next_with_pages(reverse('news.views.comments.new_comments'), page)
+    next = get_next_with_pages(reverse('news.views.comments.new_comments'), 
+            page, after)
 
     return render_to_response('news/comment_list.html',
             {'latest_comments': latest_page.object_list,
              'paginator_page': latest_page,
+             'voted_ids': get_voted_ids(request, latest_page.object_list),
              'header': header,
              'next': next,
              'this': this},
             context_instance=RequestContext(request))
 
 
+@cache_page_for_anonymous
 def comment(request, comment_id):
     """
     View for a comment.
 
     Only responds to GETS.
     """
-    top_comment = get_object_or_404(Comment, pk=comment_id)
-    child_comments = get_child_comments(top_comment.child_set, 0)
+    top_comment = get_object_or_404(
+            Comment.objects.select_related('poster__user'), pk=comment_id)
+    child_comments = get_child_comments(top_comment)
 
     header = 'Comment'
 
@@ -66,11 +85,15 @@ def comment(request, comment_id):
     next = reverse('news.views.comments.comment', 
                    args=(top_comment.id,))
 
-    top_comment.update_ranking()
+    rerank_from_view(top_comment)
+
+    voted_ids = get_voted_ids(request, [top_comment] + 
+            [com_data['comment'] for com_data in child_comments])
 
     return render_to_response('news/comment.html',
             {'top_comment': top_comment,
              'child_comments': child_comments,
+             'voted_ids': voted_ids,
              'header': header,
              'comment_posting_error': comment_posting_error,
              'comment_text': comment_text,
@@ -78,6 +101,7 @@ def comment(request, comment_id):
             context_instance=RequestContext(request))
 
 
+@transaction.commit_on_success
 def submit_comment(request):
     """
     View for submitting a comment.
@@ -132,13 +156,34 @@ def submit_comment(request):
 
     userprofile = request.user.get_profile()
 
-    # post comment  
+    # take the cost off in the database, and only if they still have 
+    # enough points (like record_vote() does), so a vote at the same 
+    # time doesn't get written over
+    cost = parent.comment_cost(userprofile)
+    if cost and not UserProfile.objects.filter(id=userprofile.id,
+            comment_points__gte=cost).update(
+            comment_points=F('comment_points') - cost):
+        request.session['comment_posting_error'] = "Insufficient comment points"
+        request.session['comment_text_for_id'] = parent.id
+        request.session['comment_text'] = comment_text
+        return HttpResponseRedirect(next)
+    userprofile.comment_points -= cost
+
+    # post comment (saving it adds it to the comment counts above it)
     com = Comment.objects.create(poster=userprofile,
             text=comment_text, parent=parent)
     Rated.objects.create(rankable=com, userprofile=userprofile, 
                             direction='up')
-    userprofile.comment_points -= com.comment_cost(userprofile)
-    userprofile.save()
+
+    if news_settings.NEWS_USE_COMMENT_PATHS:
+        update_thread_paths(com.news_item_id)
+    if news_settings.NEWS_QUEUE_RERANKS:
+        queue_rerank(com.id)
+
+    # commit before purging, or a request in between could cache the 
+    # pages again from before the comment was posted
+    transaction.commit()
+    purge_thread_pages(com)
 
 
     # I don't think this is needed, because these keys should already
@@ -152,6 +197,7 @@ def submit_comment(request):
     # if there is a parent, return the comment view for that parent
     return HttpResponseRedirect(next)
 
+@transaction.commit_on_success
 def edit_comment(request, comment_id):
     """
     View for editing a comment.
@@ -207,8 +253,12 @@ def edit_comment(request, comment_id):
         request.session['comment_text'] = comment_text
         return HttpResponseRedirect(next)
 
+    # only the text, so a vote or a reply since com was loaded isn't undone
+    Comment.objects.filter(id=com.id).update(text=comment_text)
     com.text = comment_text
-    com.save()
+    # commit before purging (see submit_comment())
+    transaction.commit()
+    purge_thread_pages(com)
 
     return HttpResponseRedirect(from_page)
 
@@ -9,10 +9,14 @@ from django.template import RequestContext
 
 import news.conf as news_settings
 
-from news.models import NewsItem, Rated
+from news.models import NewsItem, Rated, Rankable
 from news.helpers import datetime_ago, get_child_comments, \
-        improve_url, get_pagenum, get_paginator_page, \
-        get_next_with_pages, get_frontpage_querymanager
+        improve_url, get_pagenum, get_keyset_page, \
+        get_next_with_pages, get_voted_ids, shows_dead, get_in_order, \
+        hash_url
+from news.ranking import rerank_from_view
+from news.caching import get_frontpage_page, invalidate_frontpage_cache, \
+        cache_page_for_anonymous, purge_list_pages
 from news.validation import valid_text, valid_title, valid_url
 from news.shortcuts import get_object_or_404, get_from_POST_or_404, \
         get_from_session, get_from_GET_or_404
@@ -21,35 +25,34 @@ import datetime
 import urllib
 
 
+@cache_page_for_anonymous
 def index(request):
     """
     View for the front page.
 
     Only responds to GET requests.
     """
-    render_start = datetime.datetime.now()
-
-    querymanager = get_frontpage_querymanager(request)
     page = get_pagenum(request)
-    front_page = get_paginator_page(querymanager, page)
+    after = request.GET.get('after')
+    front_page = get_frontpage_page(page, shows_dead(request), after)
 
     header = 'Front Page'
 
-    next = get_next_with_pages(reverse('news.views.news_items.index'), page)
+    next = get_next_with_pages(reverse('news.views.news_items.index'), page,
+            after)
     this = reverse('news.views.news_items.index')
 
-    render_end = datetime.datetime.now()
-
     return render_to_response('news/news_item_list.html',
             {'news_item_list': front_page.object_list,
              'paginator_page': front_page,
+             'voted_ids': get_voted_ids(request, front_page.object_list),
              'header': header,
-             #'render_time': render_end - render_start,
              'next': next,
              'this': this},
             context_instance=RequestContext(request))
 
 
+@cache_page_for_anonymous
 def new_news_items(request):
     """
     View for the new news items.
@@ -57,36 +60,45 @@ def new_news_items(request):
     Only responds to GET requests.
     """
 
-    if request.user.is_authenticated() and request.user.get_profile().option_show_dead:
-        querymanager = NewsItem.objects.all().order_by('-date_posted')
-    else:
-        querymanager = NewsItem.objects.filter(dead=False).order_by('-date_posted')
+    # This goes through Rankable, so the database can use the index on
+    # (kind, date_posted) for the whole thing.
+    querymanager = Rankable.objects.filter(kind='news_item')
+    if not shows_dead(request):
+        querymanager = querymanager.filter(dead=False)
 
     page = get_pagenum(request)
-    latest_page = get_paginator_page(querymanager, page)
+    after = request.GET.get('after')
+    latest_page = get_keyset_page(querymanager, ['date_posted', 'id'], 
+            after, page)
+    latest_page.object_list = get_in_order(NewsItem, 
+            [rankable.id for rankable in latest_page.object_list])
 
     header = 'New'
 
     this = reverse('news.views.news_items.new_news_items')
-    next = get_next_with_pages(reverse('news.views.news_items.new_news_items'), page)
+    next = get_next_with_pages(reverse('news.views.news_items.new_news_items'), 
+            page, after)
 
     return render_to_response('news/news_item_list.html',
             {'news_item_list': latest_page.object_list,
              'paginator_page': latest_page,
+             'voted_ids': get_voted_ids(request, latest_page.object_list),
              'header': header,
              'next': next,
              'this': this},
             context_instance=RequestContext(request))
 
 
+@cache_page_for_anonymous
 def news_item(request, news_item_id=None):
     """
     View for a news item.
 
     Only responds to GET requests.
     """
-    top_news_item = get_object_or_404(NewsItem, pk=news_item_id)
-    child_comments = get_child_comments(top_news_item.child_set, 0)
+    top_news_item = get_object_or_404(
+            NewsItem.objects.select_related('poster__user'), pk=news_item_id)
+    child_comments = get_child_comments(top_news_item)
 
     header = 'News Item'
 
@@ -103,11 +115,15 @@ def news_item(request, news_item_id=None):
     next = reverse('news.views.news_items.news_item', 
                    args=(top_news_item.id,))
 
-    top_news_item.update_ranking()
+    rerank_from_view(top_news_item)
+
+    voted_ids = get_voted_ids(request, [top_news_item] + 
+            [com_data['comment'] for com_data in child_comments])
 
     return render_to_response('news/news_item.html',
             {'top_news_item': top_news_item,
              'child_comments': child_comments,
+             'voted_ids': voted_ids,
              'header': header,
              'comment_posting_error':comment_posting_error,
              'comment_text': comment_text,
@@ -176,9 +192,12 @@ def submit(request):
                     reverse('news.views.login.login_view') +
                     '?next=' + next)
 
-    # if the url has already been posted, just vote up this story
-    if url and NewsItem.objects.filter(url=url):
-        newsitem = NewsItem.objects.filter(url=url)[0]
+    # if the url has already been posted (or one that goes to the same 
+    # place), just vote up this story
+    already_posted = url and list(NewsItem.objects.filter(
+            url_hash=hash_url(url))[:1])
+    if already_posted:
+        newsitem = already_posted[0]
         news_item_next = reverse('news.views.news_items.news_item', 
                             args=(newsitem.id,))
         vote_next = reverse('news.views.voting.vote') + '?' + \
@@ -196,6 +215,8 @@ def submit(request):
                             title=title, url=url, text=text)
     Rated.objects.create(rankable=newsitem, userprofile=request.user.get_profile(), 
                             direction='up')
+    invalidate_frontpage_cache()
+    purge_list_pages()
 
     return HttpResponseRedirect(
             reverse('news.views.news_items.news_item', 
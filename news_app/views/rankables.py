@@ -6,14 +6,18 @@ from django.http import HttpResponseRedirect
 from django.shortcuts import render_to_response
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
+from django.db import transaction
 
 from news.models import NewsItem, Comment, Rated, Rankable
 from news.helpers import assert_or_404
 from news.shortcuts import get_object_or_404, \
     get_from_POST_or_404, get_from_session, del_from_session
 from news.validation import valid_next_redirect
+from news.caching import invalidate_frontpage_cache, purge_thread_pages, \
+        purge_pages, purge_list_pages
 
 
+@transaction.commit_on_success
 def delete_rankable(request, rankable_id):
     """
     View for deleting a news item or comment.
@@ -54,9 +58,9 @@ def delete_rankable(request, rankable_id):
         news_item = None
         comment = None
         if rankable.is_comment():
-            comment = rankable.comment
+            comment = rankable.downcast()
         elif rankable.is_news_item():
-            news_item = rankable.newsitem
+            news_item = rankable.downcast()
         return render_to_response('news/delete_rankable.html',
                 {'news_item': news_item,
                  'comment': comment,
@@ -70,7 +74,17 @@ def delete_rankable(request, rankable_id):
     submitvalue = get_from_POST_or_404(request, 'submitvalue')
 
     if submitvalue == "yes":
-        rankable.dead = True
-        rankable.save()
+        # this also takes the comment off the comment counts above it
+        rankable.kill()
+        # commit before purging, or a request in between could cache the
+        # pages again with the rankable still there
+        transaction.commit()
+        if rankable.is_news_item():
+            invalidate_frontpage_cache()
+            purge_pages([reverse('news.views.news_items.news_item', 
+                    args=(rankable.id,))])
+            purge_list_pages()
+        else:
+            purge_thread_pages(rankable.downcast())
 
     return HttpResponseRedirect(from_page)
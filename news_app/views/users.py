@@ -6,6 +6,8 @@ from django.http import HttpResponseRedirect
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 
+from django.contrib.auth.models import User
+
 from news.models import UserProfile
 from news.shortcuts import get_object_or_404, get_from_POST_or_404, \
         get_from_session
@@ -73,7 +75,12 @@ def user(request, username):
     else:
         userprofile.option_show_dead = True
     
-    userprofile.save()
+    # only write the fields that changed, so the comment points loaded
+    # with userprofile don't go back over a vote's
+    UserProfile.objects.filter(id=userprofile.id).update(
+            option_use_javascript=userprofile.option_use_javascript,
+            option_show_email=userprofile.option_show_email,
+            option_show_dead=userprofile.option_show_dead)
     
     if email_address and not valid_email(email_address):
         request.session['userprofile_posting_error'] = "Email address too long"
@@ -106,8 +113,9 @@ def user(request, username):
     userprofile.about = about
     userprofile.user.email = email_address
 
-    userprofile.save()
-    userprofile.user.save()
+    UserProfile.objects.filter(id=userprofile.id).update(website=website,
+            about=about)
+    User.objects.filter(id=userprofile.user_id).update(email=email_address)
 
     return HttpResponseRedirect(
             reverse('news.views.users.user', args=(userprofile.username,)))
@@ -1,15 +1,21 @@
 """
 Views for dealing with voting (rating comments and news items).
 """
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponseRedirect, HttpResponse, \
+    HttpResponseForbidden, Http404
 from django.core.urlresolvers import reverse
+from django.utils import simplejson
 
 from news.models import NewsItem, Comment, Rated, Rankable
 from news.helpers import assert_or_404
+from news.votes import record_vote, record_votes, NOT_ENOUGH_POINTS
 from news.validation import valid_next_redirect
 from news.shortcuts import get_object_or_404, \
     get_from_GET_or_404 
 
+# the most votes vote_batch() takes at once
+MAX_VOTES_PER_BATCH = 100
+
 
 def vote(request):
     """
@@ -37,31 +43,48 @@ def vote(request):
     
     userprofile = request.user.get_profile()
 
-    if rankable.already_voted(userprofile):
-        return HttpResponseRedirect(next)
+    if direction == 'down':
+        assert_or_404(rankable.can_be_downvoted())
 
-    if not rankable.can_vote(userprofile):
+    # If they already voted on this, the vote is just ignored.
+    if record_vote(rankable, userprofile, direction) == NOT_ENOUGH_POINTS:
         request.session['voting_error'] = "Not enough comment points"
         return HttpResponseRedirect(reverse('news.views.payment.buy_points'))
 
+    return HttpResponseRedirect(next)
 
-    if direction == 'up':
-        rankable.rating += 1
-    elif direction == 'down':
-        assert_or_404(rankable.can_be_downvoted())
-        rankable.rating -= 1
-    else:
-        raise Http404
+def vote_batch(request):
+    """
+    This view takes a lot of votes at once, for javascript clients.
+    Each vote is a "votes" POST variable that looks like "id:direction",
+    for instance "votes=12:up&votes=13:down".
+
+    It returns JSON like this: 
+      {"results": {"12": "voted", "13": "already voted"}, 
+       "comment_points": 40}
+    The results are the ones from news.votes.record_votes().
+    """
+    assert_or_404(request.method == 'POST')
 
-    rankable.update_ranking()
-    rankable.save()
-    Rated.objects.create(rankable=rankable, userprofile=userprofile, 
-                            direction=direction)
+    if not request.user.is_authenticated():
+        return HttpResponseForbidden(
+                simplejson.dumps({'error': 'not logged in'}),
+                mimetype='application/json')
 
-    userprofile.comment_points -= rankable.vote_cost(userprofile)
-    userprofile.save()
+    votes = []
+    for vote in request.POST.getlist('votes'):
+        rankable_id, sep, direction = vote.partition(':')
+        assert_or_404(rankable_id.isdigit())
+        votes.append((int(rankable_id), direction))
+    assert_or_404(0 < len(votes) <= MAX_VOTES_PER_BATCH)
 
+    userprofile = request.user.get_profile()
+    results = record_votes(userprofile, votes)
 
-    return HttpResponseRedirect(next)
+    response = {'results': dict([(str(rankable_id), result) 
+                    for rankable_id, result in results.items()]),
+                'comment_points': userprofile.comment_points}
+    return HttpResponse(simplejson.dumps(response), 
+            mimetype='application/json')
 
 
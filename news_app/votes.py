@@ -0,0 +1,242 @@
+"""
+Recording votes on news items and comments.
+"""
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+
+import datetime
+
+from news.models import UserProfile, Rated, Rankable, NewsItem, Comment
+from news.helpers import MAX_IN_CLAUSE_IDS
+from news.ranking import queue_rerank, queue_reranks, rerank_ids
+from news.caching import invalidate_frontpage_cache, bump_thread_version
+import news.conf as news_settings
+
+# what record_vote() and record_votes() return
+VOTED = 'voted'
+ALREADY_VOTED = 'already voted'
+NOT_ENOUGH_POINTS = 'not enough points'
+# record_votes() only
+INVALID = 'invalid'
+
+
+@transaction.commit_on_success
+def record_vote(rankable, userprofile, direction):
+    """
+    Record userprofile's vote on rankable.  direction is 'up' or 'down'.
+    
+    This is all done in one transaction, without reading anything
+    back first, so votes happening at the same time can't step on 
+    each other:
+      - the Rated row is inserted (the database won't let someone 
+        vote on something twice),
+      - the vote's cost is taken off userprofile's comment points, 
+        but only if they have enough,
+      - the rating is changed in the database, not in python.
+
+    Returns VOTED, ALREADY_VOTED or NOT_ENOUGH_POINTS.  If it isn't
+    VOTED, nothing is changed.
+    """
+    cost = rankable.vote_cost(userprofile)
+    if direction == 'up':
+        delta = 1
+    else:
+        delta = -1
+
+    try:
+        Rated.objects.create(rankable_id=rankable.id, 
+                userprofile_id=userprofile.id, direction=direction)
+    except IntegrityError:
+        transaction.rollback()
+        return ALREADY_VOTED
+
+    if cost and not UserProfile.objects.filter(id=userprofile.id,
+            comment_points__gte=cost).update(
+            comment_points=F('comment_points') - cost):
+        transaction.rollback()
+        return NOT_ENOUGH_POINTS
+
+    Rankable.objects.filter(id=rankable.id).update(
+            rating=F('rating') + delta)
+
+    # update_ranking.py updates the ranking when it gets to the queue
+    if news_settings.NEWS_QUEUE_RERANKS:
+        queue_rerank(rankable.id)
+    else:
+        rerank_ids([rankable.id])
+        # the frontpage order might have changed
+        if rankable.is_news_item():
+            invalidate_frontpage_cache()
+
+    # the comment's new rating needs to show up in its thread
+    if rankable.is_comment():
+        bump_thread_version(rankable.downcast().news_item_id)
+
+    # keep the objects we were given up to date too
+    userprofile.comment_points -= cost
+    rankable.rating += delta
+    return VOTED
+
+def get_vote_costs(rankable_ids, userprofile):
+    """
+    Work out what voting on each of the rankables with rankable_ids would
+    cost userprofile, and whether they can be voted down, without looking 
+    at them one at a time.  Returns a dictionary mapping each rankable id
+    to a (cost, can be voted down, news item id) tuple, where the news 
+    item id is the one the thread is under.  Ids that aren't news items 
+    or comments are left out.
+    """
+    comment_news_items = {}
+    news_item_texts = {}
+    for i in range(0, len(rankable_ids), MAX_IN_CLAUSE_IDS):
+        chunk = rankable_ids[i:i + MAX_IN_CLAUSE_IDS]
+        comment_news_items.update(Comment.objects.filter(id__in=chunk
+                ).values_list('id', 'news_item'))
+        news_item_texts.update(NewsItem.objects.filter(id__in=chunk
+                ).values_list('id', 'text'))
+
+    # the news items the comments are posted to
+    thread_ids = list(set(comment_news_items.values()) - 
+            set(news_item_texts) - set([None]))
+    for i in range(0, len(thread_ids), MAX_IN_CLAUSE_IDS):
+        news_item_texts.update(NewsItem.objects.filter(
+                id__in=thread_ids[i:i + MAX_IN_CLAUSE_IDS]
+                ).values_list('id', 'text'))
+
+    # this is the same as Rankable.vote_cost()
+    costs = {}
+    for rankable_id in rankable_ids:
+        if rankable_id in comment_news_items:
+            news_item_id = comment_news_items[rankable_id]
+            if news_item_id is None:
+                # an old comment that doesn't know its news item
+                cost = Comment.objects.get(id=rankable_id).vote_cost(
+                        userprofile)
+            elif news_item_texts[news_item_id]:
+                cost = news_settings.NEWS_COST_VOTE_ASK_SN_COMMENT
+            else:
+                cost = news_settings.NEWS_COST_VOTE_NORMAL_COMMENT
+            costs[rankable_id] = (cost, False, news_item_id)
+        elif rankable_id in news_item_texts:
+            if news_item_texts[rankable_id]:
+                cost = news_settings.NEWS_COST_VOTE_ASK_SN
+            else:
+                cost = news_settings.NEWS_COST_VOTE_NEWS_ITEM
+            costs[rankable_id] = (cost, True, rankable_id)
+    return costs
+
+def record_votes(userprofile, votes):
+    """
+    Record a lot of votes by userprofile at once.  votes is a list of
+    (rankable id, direction) pairs.  Returns a dictionary mapping each 
+    rankable id to what record_vote() would have returned for it, or 
+    INVALID if it can't be voted on that way.
+
+    The votes are checked with a few big queries, and then they are
+    all saved in one transaction: one INSERT for the Rated rows, one
+    UPDATE for the comment points, and one UPDATE for the ratings that 
+    go up and one for the ones that go down.  If someone else changes 
+    things in the meantime (votes at the same time, for instance), 
+    this falls back to saving the votes one at a time with record_vote().
+    """
+    results = {}
+    # only the first vote on each rankable counts
+    wanted = []
+    for rankable_id, direction in votes:
+        if rankable_id in results:
+            continue
+        if direction not in ('up', 'down'):
+            results[rankable_id] = INVALID
+            continue
+        results[rankable_id] = None
+        wanted.append((rankable_id, direction))
+
+    rankable_ids = [rankable_id for rankable_id, direction in wanted]
+    costs = get_vote_costs(rankable_ids, userprofile)
+    voted_ids = set()
+    for i in range(0, len(rankable_ids), MAX_IN_CLAUSE_IDS):
+        voted_ids.update(Rated.objects.filter(userprofile=userprofile, 
+                rankable__in=rankable_ids[i:i + MAX_IN_CLAUSE_IDS]
+                ).values_list('rankable', flat=True))
+
+    points = UserProfile.objects.filter(id=userprofile.id).values_list(
+            'comment_points', flat=True)[0]
+    total_cost = 0
+    accepted = []
+    for rankable_id, direction in wanted:
+        if rankable_id not in costs or \
+                (direction == 'down' and not costs[rankable_id][1]):
+            results[rankable_id] = INVALID
+        elif rankable_id in voted_ids:
+            results[rankable_id] = ALREADY_VOTED
+        elif points - total_cost - costs[rankable_id][0] < 0:
+            results[rankable_id] = NOT_ENOUGH_POINTS
+        else:
+            total_cost += costs[rankable_id][0]
+            accepted.append((rankable_id, direction))
+
+    if accepted:
+        if save_votes(userprofile, accepted, total_cost):
+            # the frontpage order might have changed (news items are the 
+            # only things that can be voted down)
+            if not news_settings.NEWS_QUEUE_RERANKS and [rankable_id for
+                    rankable_id, direction in accepted 
+                    if costs[rankable_id][1]]:
+                invalidate_frontpage_cache()
+            # and the comments' new ratings need to show up in their threads
+            for news_item_id in set([costs[rankable_id][2] for rankable_id, 
+                    direction in accepted if not costs[rankable_id][1]]):
+                bump_thread_version(news_item_id)
+            for rankable_id, direction in accepted:
+                results[rankable_id] = VOTED
+            userprofile.comment_points -= total_cost
+        else:
+            for rankable_id, direction in accepted:
+                results[rankable_id] = record_vote(
+                        Rankable.objects.get(id=rankable_id), userprofile,
+                        direction)
+    return results
+
+@transaction.commit_on_success
+def save_votes(userprofile, votes, total_cost):
+    """
+    Save votes (a list of (rankable id, direction) pairs) by userprofile
+    that have already been checked by record_votes(), and take total_cost
+    off their comment points.  Returns False (and saves nothing) if 
+    one of the votes is already there or they don't have enough points
+    any more.
+    """
+    qn = connection.ops.quote_name
+    opts = Rated._meta
+    sql = "INSERT INTO %s (%s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s)" % (
+            qn(opts.db_table), qn(opts.get_field('rankable').column),
+            qn(opts.get_field('userprofile').column), qn('date_rated'),
+            qn('direction'))
+    db_now = connection.ops.value_to_db_datetime(datetime.datetime.now())
+    try:
+        connection.cursor().executemany(sql, [(rankable_id, userprofile.id,
+                db_now, direction) for rankable_id, direction in votes])
+    except IntegrityError:
+        transaction.rollback()
+        return False
+    transaction.set_dirty()
+
+    if total_cost and not UserProfile.objects.filter(id=userprofile.id,
+            comment_points__gte=total_cost).update(
+            comment_points=F('comment_points') - total_cost):
+        transaction.rollback()
+        return False
+
+    for direction, delta in (('up', 1), ('down', -1)):
+        ids = [rankable_id for rankable_id, vote_direction in votes 
+                if vote_direction == direction]
+        for i in range(0, len(ids), MAX_IN_CLAUSE_IDS):
+            Rankable.objects.filter(id__in=ids[i:i + MAX_IN_CLAUSE_IDS]
+                    ).update(rating=F('rating') + delta)
+
+    rankable_ids = [rankable_id for rankable_id, direction in votes]
+    if news_settings.NEWS_QUEUE_RERANKS:
+        queue_reranks(rankable_ids)
+    else:
+        rerank_ids(rankable_ids)
+    return True